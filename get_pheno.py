@@ -7,21 +7,29 @@ import configparser
 import csv
 import gc
 import hashlib
+import io
+import itertools
 import os
 import pickle
 import random
 import re
+import shutil
 import socket
 import sqlite3
 import subprocess
 import sys
 import uuid
 import warnings
+import zipfile
 import logging
 import datetime
+import multiprocessing
+import threading
+import time
 from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta
+from functools import partial
 from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 import json
 
@@ -44,6 +52,14 @@ import pandas as pd
 from packaging.version import Version, parse
 from pandas.errors import ParserWarning
 import psutil
+# Optional: pyarrow enables Parquet input with column projection and predicate pushdown
+# (see --BuildParquet). CSV/STATA inputs do not need it.
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_dataset
+except ImportError:
+    pa = None
+    pa_dataset = None
 
 #-------------------------------------------------------------------------------
 # Pre-compiled regex for splitting ICD strings.
@@ -671,40 +687,79 @@ def match_codes_old(series, codes, exact=False):
     else:
         return series.apply(lambda d: any(d.startswith(p) for p in codes))
     
+def compile_code_patterns(codes, exact=False, upper_prefixes=False):
+    """
+    Compile requested codes into an exact-match set and a sorted, prefix-free array of prefixes.
+
+    Codes ending in "*" are always prefixes; all other codes are exact matches if `exact` is set
+    and prefixes otherwise. Prefixes that are covered by a shorter prefix are dropped, so any
+    value can only be matched by its sorted predecessor in the array (one binary search).
+    """
+    exact_set, prefixes = set(), set()
+    for code in (codes if codes is not None else []):
+        if code is None:
+            continue
+        c = str(code).strip()
+        if c.endswith('*'):
+            prefixes.add(c[:-1].upper() if upper_prefixes else c[:-1])
+        elif exact:
+            exact_set.add(c)
+        else:
+            prefixes.add(c.upper() if upper_prefixes else c)
+    pruned = []
+    for p in sorted(prefixes):
+        if pruned and p.startswith(pruned[-1]):
+            continue
+        pruned.append(p)
+    return {"exact": exact_set, "prefixes": np.array(pruned, dtype=object)}
+
+def match_compiled_codes(values, compiled):
+    """
+    Evaluate compiled code patterns on a (string) Series; missing values never match.
+    Meant to run on the unique code vocabulary, not on every row (see vocabulary_code_mask).
+    """
+    values = pd.Series(values, dtype="string") if not isinstance(values, pd.Series) else values
+    hits = np.zeros(len(values), dtype=bool)
+    if compiled["exact"]:
+        hits |= values.isin(compiled["exact"]).to_numpy(dtype=bool, na_value=False)
+    prefixes = compiled["prefixes"]
+    if len(prefixes):
+        valid = values.notna().to_numpy(dtype=bool)
+        if prefixes[0] == "":
+            return hits | valid
+        vals = values[valid].to_numpy(dtype=object)
+        pos = np.searchsorted(prefixes, vals, side="right") - 1
+        cand = prefixes[np.maximum(pos, 0)]
+        ok = np.fromiter((v.startswith(c) for v, c in zip(vals, cand)), dtype=bool, count=len(vals)) & (pos >= 0)
+        hits[np.flatnonzero(valid)] |= ok
+    return hits
+
+def vocabulary_code_mask(series, compiled, normalize=None):
+    """
+    Row mask for compiled code patterns, computed on the unique values of `series` only.
+
+    The series is factorized once; `normalize` (Series -> Series, or list of such callables whose
+    results are OR-ed) is applied to the vocabulary before matching, and the per-code result
+    is mapped back to the rows through the integer codes.
+    """
+    codes, uniques = pd.factorize(series, sort=False)
+    vocab = pd.Series(uniques, dtype="object").astype("string")
+    normalizers = normalize if isinstance(normalize, (list, tuple)) else [normalize]
+    hits = np.zeros(len(vocab), dtype=bool)
+    for fn in normalizers:
+        hits |= match_compiled_codes(fn(vocab) if fn is not None else vocab, compiled)
+    # factorize marks missing values with -1; append a False slot so they never match
+    return np.append(hits, False)[codes]
+
 def match_codes(series, codes, exact=False):
     """Match codes in a series with support for exact matches and prefix matching."""
     if codes is None or len(codes) == 0:
         return pd.Series([True] * len(series), index=series.index)
     
-    # Normalize codes to list of strings
-    codes_list = [str(c).strip() for c in codes if c is not None]
-    
-    # Separate exact matches and prefix matches (wildcards)
-    exact_set = set()
-    prefixes = []
-    
-    for code in codes_list:
-        if code.endswith('*'):
-            prefixes.append(code[:-1])  # Remove wildcard for prefix matching
-        elif exact:
-            exact_set.add(code)
-        else:
-            prefixes.append(code)  # Default to prefix matching if not exact
-    
-    # Apply matching logic
-    s = series.astype(str).str.strip().str.upper()
-    
-    if exact and exact_set:
-        mask = s.isin(exact_set)
-    else:
-        mask = pd.Series([False] * len(s), index=s.index)
-    
-    # Add prefix matches
-    if prefixes:
-        for prefix in prefixes:
-            mask |= s.str.startswith(prefix.upper(), na=False)
-    
-    return mask
+    # Exact codes are compared as given, prefixes case-insensitively (values are upper-cased)
+    compiled = compile_code_patterns(codes, exact=exact, upper_prefixes=True)
+    mask = vocabulary_code_mask(series, compiled, normalize=lambda v: v.str.strip().str.upper())
+    return pd.Series(mask, index=series.index)
 
 def generate_readme(flags_used, default_args, multiplePhenotypes=False, disclaimer_text="", additional_cols=[], selected_pickle=False, selected_PLINK=False, selected_FastGWA=False, Exclusions=False, phenotypes=[], ExDep=False, checksum_file="checksums.sha256"):
     def parse_argstring_to_dict(argstring):
@@ -976,6 +1031,10 @@ def _split_input_paths(paths):
     return [path.strip() for path in str(paths).split(",") if path.strip()]
 
 def _read_input_header(path, sep=","):
+    if is_parquet_path(path):
+        if pa_dataset is not None:
+            return list(pa_dataset.dataset(path, format="parquet").schema.names)
+        return pd.read_parquet(path).columns.tolist()
     if path.lower().endswith((".dta", ".stata")):
         try:
             with pd.read_stata(path, iterator=True) as reader:
@@ -1152,7 +1211,7 @@ def write_checksum_file(files_to_checksum, checksum_file):
     os.replace(tmp_file, checksum_file)
     return checksum_file
 
-def _to_datetime_series(s: pd.Series, *, fmt: str, dayfirst: bool) -> pd.Series:
+def _to_datetime_series_robust(s: pd.Series, *, fmt: str, dayfirst: bool) -> pd.Series:
     """
     Robust parser:
     - trims whitespace and strips trailing '.0'
@@ -1186,6 +1245,53 @@ def _to_datetime_series(s: pd.Series, *, fmt: str, dayfirst: bool) -> pd.Series:
 
     return out
 
+# Formats tried on a column sample when no DateFormat is given (see infer_date_format)
+DATE_FORMAT_CANDIDATES = ("%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%Y%m%d", "%d-%m-%Y", "%d.%m.%Y", "%Y/%m/%d",
+                          "%Y-%m-%d %H:%M:%S", "%d%b%Y")
+DATE_FORMAT_SAMPLE_SIZE = 1000
+# (file, column, DateFormat, DayFirst) -> inferred format (None: use the robust parser)
+_DATE_FORMAT_CACHE: Dict[Tuple[Any, ...], Optional[str]] = {}
+
+def infer_date_format(s: pd.Series, *, fmt: str, dayfirst: bool, sample_size: int = DATE_FORMAT_SAMPLE_SIZE) -> Optional[str]:
+    """
+    A format that parses an evenly spread sample of the text column `s` exactly like
+    _to_datetime_series_robust (`fmt` itself if given, else the first fitting DATE_FORMAT_CANDIDATES
+    entry), or None if no format fits at least half of the sample.
+    """
+    if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+        return None
+    values = s.dropna()
+    if values.empty:
+        return None
+    sample = values.iloc[::max(1, len(values) // sample_size)].iloc[:sample_size]
+    expected = _to_datetime_series_robust(sample, fmt=fmt, dayfirst=dayfirst)
+    for candidate in ([fmt] if fmt else DATE_FORMAT_CANDIDATES):
+        got = pd.to_datetime(sample, format=candidate, errors="coerce")
+        if got.notna().mean() >= 0.5 and (got.isna() | (got == expected)).all():
+            return candidate
+    return None
+
+def _to_datetime_series(s: pd.Series, *, fmt: str, dayfirst: bool, cache_key: Optional[Tuple[Any, ...]] = None) -> pd.Series:
+    """
+    Parse a date column like _to_datetime_series_robust, but with one vectorized to_datetime call in
+    the format infer_date_format finds on a sample; only values that format cannot parse go through
+    the robust parser. With cache_key (e.g. (file, column)) the format is inferred once per key.
+    """
+    key = None if cache_key is None else (*cache_key, fmt, dayfirst)
+    if key is not None and key in _DATE_FORMAT_CACHE:
+        date_format = _DATE_FORMAT_CACHE[key]
+    else:
+        date_format = infer_date_format(s, fmt=fmt, dayfirst=dayfirst)
+        if key is not None:
+            _DATE_FORMAT_CACHE[key] = date_format
+    if date_format is None or not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+        return _to_datetime_series_robust(s, fmt=fmt, dayfirst=dayfirst)
+    out = pd.to_datetime(s, format=date_format, errors="coerce")
+    rest = (out.isna() & s.notna()).to_numpy()
+    if rest.any():
+        out[rest] = _to_datetime_series_robust(s[rest], fmt=fmt, dayfirst=dayfirst).to_numpy()
+    return out
+
 def _as_list(x: Any) -> List[Any]:
     if isinstance(x, list):
         seq = x
@@ -1200,6 +1306,81 @@ def _to_dt_list(x: Any) -> List[pd.Timestamp]:
     ts = pd.to_datetime(arr, errors="coerce")
     return [t for t in ts if not pd.isna(t)]
 
+def _as_item_list(x: Any) -> List[Any]:
+    """Like _as_list, but also splits comma-separated strings and treats NaN/"" as empty (exclusion inputs)."""
+    if isinstance(x, list):
+        seq = x
+    elif isinstance(x, (tuple, set)):
+        seq = list(x)
+    elif pd.isna(x) or x == "":
+        seq = []
+    elif isinstance(x, str) and "," in x:
+        seq = [s for s in (i.strip() for i in x.split(",")) if s != ""]
+    else:
+        seq = [x]
+    return [item for item in seq if str(item).strip() != ""]
+
+def _long_list_column(values: pd.Series, normalize=_as_list, as_dates: bool = False) -> pd.DataFrame:
+    """
+    Explode a column of per-row lists into long format: row (position of the row in `values`),
+    pos (position in the row's list) and value. Items are normalized with `normalize`; with as_dates
+    the values are int32 day numbers (day-number lists are used directly, the rest of the column is
+    parsed once) and unparsable items are dropped before positions are numbered, as _to_dt_list does
+    per row.
+    """
+    cells = list(values)
+    is_days = np.fromiter((as_dates and is_day_list(x) for x in cells), dtype=bool, count=len(cells))
+    lists = [x if d else normalize(x) for x, d in zip(cells, is_days)]
+    lengths = np.fromiter((len(items) for items in lists), dtype=np.int64, count=len(lists))
+    row = np.repeat(np.arange(len(lists), dtype=np.int64), lengths)
+    if as_dates:
+        # day-number lists are taken as they are; only the other items are parsed
+        item_is_days = np.repeat(is_days, lengths)
+        value = np.empty(len(row), dtype=np.int32)
+        if is_days.any():
+            value[item_is_days] = np.concatenate([lists[i] for i in np.flatnonzero(is_days)])
+        value[~item_is_days] = dates_to_day_numbers(
+            pd.Series([item for items, d in zip(lists, is_days) if not d for item in items], dtype=object))
+        keep = value != DAY_NUMBER_NA
+        row, value = row[keep], value[keep]
+    else:
+        value = pd.Series([item for items in lists for item in items], dtype=object)
+    long = pd.DataFrame({"row": row, "value": value})
+    long["pos"] = long.groupby("row").cumcount().to_numpy()
+    return long
+
+def _collapse_long(long: pd.DataFrame, n_rows: int, column: str = "value") -> List[list]:
+    """Inverse of _long_list_column: one list per row (in row/pos order), [] for rows without items."""
+    counts = np.bincount(long["row"].to_numpy(dtype=np.int64), minlength=n_rows)
+    values = long[column].to_numpy(dtype=object)
+    return [part.tolist() for part in np.split(values, np.cumsum(counts)[:-1])]
+
+def _format_days(days, date_format: str) -> np.ndarray:
+    """Day numbers as date strings in `date_format`."""
+    return day_numbers_to_dates(np.asarray(days)).dt.strftime(date_format).to_numpy()
+
+def _nearest_date_gap(left: pd.DataFrame, right: pd.DataFrame, direction: str) -> pd.Series:
+    """
+    For every (row, day number) in the long frame `left`, the absolute gap in days to the nearest day of
+    the same row in `right` that lies before/at it (direction="backward") or at/after it ("forward");
+    NaN if none. Aligned with `left`.
+    """
+    if left.empty or right.empty:
+        return pd.Series(np.nan, index=left.index)
+    lhs = left[["row", "value"]].assign(_order=np.arange(len(left))).sort_values("value", kind="mergesort")
+    rhs = right[["row", "value"]].rename(columns={"value": "_match"}).sort_values("_match", kind="mergesort")
+    merged = pd.merge_asof(lhs, rhs, left_on="value", right_on="_match", by="row", direction=direction)
+    gap = (merged["value"] - merged["_match"]).abs()
+    out = np.empty(len(left), dtype=np.float64)
+    out[merged["_order"].to_numpy()] = gap.to_numpy(dtype=np.float64)
+    return pd.Series(out, index=left.index)
+
+def _first_date_per_row(values: pd.Series) -> pd.Series:
+    """Earliest parsable date of every row's list (NaT if none), aligned with `values`."""
+    long = _long_list_column(values, as_dates=True)
+    first = long.groupby("row")["value"].min().reindex(np.arange(len(values)), fill_value=DAY_NUMBER_NA)
+    return pd.Series(day_numbers_to_dates(first.to_numpy()).to_numpy(), index=values.index)
+
 def normalize_iid_series(s, target="str"):
     """
     Normalize an IID column that may contain strings/floats like '100.0'.
@@ -1359,6 +1540,73 @@ def convert_if_not_datetime(val):
     # Otherwise, convert using the specified format with error coercion
     return pd.to_datetime(val, format=DateFormat, errors='coerce')
 
+def convert_dates_once(s: pd.Series) -> pd.Series:
+    """
+    Column-wise convert_if_not_datetime: string columns are parsed in one to_datetime call with
+    DateFormat (invalid -> NaT); columns holding datetime objects keep the per-value conversion.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    if pd.api.types.infer_dtype(s, skipna=True) in ("string", "empty"):
+        return pd.to_datetime(s, format=DateFormat, errors='coerce')
+    return s.apply(lambda x: convert_if_not_datetime(x) if pd.notnull(x) else pd.NaT)
+
+DAY_NUMBER_NA = np.iinfo(np.int32).min
+
+def dates_to_day_numbers(values) -> np.ndarray:
+    """Dates as int32 days since 1970-01-01 (time of day dropped); NaT becomes DAY_NUMBER_NA."""
+    dt = pd.to_datetime(pd.Series(values), errors='coerce')
+    days = dt.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").astype(np.int64)
+    days[dt.isna().to_numpy()] = DAY_NUMBER_NA
+    return days.astype(np.int32)
+
+def day_numbers_to_dates(days) -> pd.Series:
+    """Inverse of dates_to_day_numbers (datetime64[ns], DAY_NUMBER_NA -> NaT)."""
+    days = np.asarray(days, dtype=np.int32)
+    out = days.astype(np.int64).astype("datetime64[D]").astype("datetime64[ns]")
+    out[days == DAY_NUMBER_NA] = np.datetime64("NaT")
+    return pd.Series(out)
+
+def dates_have_time_of_day(values) -> bool:
+    """True if any date carries a time of day or time zone, i.e. day numbers would not round-trip it."""
+    dt = pd.to_datetime(pd.Series(values), errors='coerce')
+    if getattr(dt.dt, "tz", None) is not None:
+        return True
+    dt = dt.dropna()
+    return bool((dt != dt.dt.normalize()).any())
+
+def is_day_list(value) -> bool:
+    """True for a per-IID date list kept as int32 day numbers (see merge_IIDs)."""
+    return isinstance(value, np.ndarray) and value.dtype == np.int32
+
+def split_day_lists(days, counts) -> List[np.ndarray]:
+    """Consecutive runs of `days` with the given lengths; all runs are views into the one int32 buffer."""
+    days = np.asarray(days, dtype=np.int32)
+    return np.split(days, np.cumsum(counts)[:-1]) if len(counts) else []
+
+def format_day_list_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Day-number list cells in the form the Timestamp lists they stand for are written in
+    ("[Timestamp('2020-01-05 00:00:00'), NaT]"); other cells are left alone. Used just before writing.
+    """
+    out = df
+    for col in df.columns[(df.dtypes == object).to_numpy()]:
+        cells = df[col].to_numpy()
+        is_days = np.fromiter((is_day_list(x) for x in cells), dtype=bool, count=len(cells))
+        if not is_days.any():
+            continue
+        lists = cells[is_days]
+        days = np.concatenate(list(lists))
+        text = np.where(days == DAY_NUMBER_NA, "NaT",
+                        ("Timestamp('" + day_numbers_to_dates(days).dt.strftime("%Y-%m-%d") + " 00:00:00')").to_numpy())
+        parts = np.split(text, np.cumsum([len(x) for x in lists])[:-1])
+        formatted = cells.copy()
+        formatted[np.flatnonzero(is_days)] = ["[" + ", ".join(part) + "]" for part in parts]
+        if out is df:
+            out = df.copy()
+        out[col] = formatted
+    return out
+
 # Function to remove duplicates while preserving order
 def remove_duplicates_preserve_order(lst):
     seen = set()
@@ -1417,9 +1665,9 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
          ctype_excl, ctype_incl, ctype_col, lifetime_exclusions_file, post_exclusions_file, oneYearPrior_exclusions_file, exclCHBcontrols, Filter_YoB, 
          Filter_Gender, verbose_arg, Build_Test_Set, test_run, MatchFI, skip_icd_update, DateFormat_in, iidstatus_col, iidstatusdate, selectIIDs, remove_point_in_diag_request, 
          num_threads, main_pheno_name, BuildEntryExitDates, build_ophold, write_pickle, write_fastGWA_format, write_Plink2_format, lpr_cols_to_read_as_date, 
-         stam_cols_to_read_as_date, MinMaxAge, ICDCM, load_precreated_phenotypes, RegisterRun, lowMem, verylowMem, batchsize, noLeadingICD, lpr2nd_file, lpr_recnummer, lpr2nd_recnummer, 
+         stam_cols_to_read_as_date, MinMaxAge, ICDCM, load_precreated_phenotypes, RegisterRun, lowMem, verylowMem, batchsize, spill_batches, noLeadingICD, lpr2nd_file, lpr_recnummer, lpr2nd_recnummer, 
          diagnostic2nd_col, atc_file, atc_diag_col, atc_date, atc_datecols, runLPRonly, runPSYKonly, opholdsep, ophold_file, inifile, only_ICD8_arg, only_ICD9_arg, only_ICD10_arg, 
-         BuildIndex, IndexDtypes, icdprefix, argstring, defaultargs, default_argstring):
+         BuildIndex, IndexDtypes, BuildParquet, UpdateIndex, InputCache, InputCacheGB, InputThreads, icdprefix, argstring, defaultargs, default_argstring):
     
     ## Add global variables
     global min_Age
@@ -1438,6 +1686,8 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
     global DayFirst
     global logger
     global ATC_Requested
+    global INPUT_CACHE_DIR
+    global INPUT_CACHE_MAX_BYTES
 
     ATC_Requested = "NotSet"
     
@@ -1449,10 +1699,13 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
     only_ICD8 = only_ICD8_arg
     verbose = verbose_arg
     DateFormat = DateFormat_in
+    INPUT_CACHE_DIR = InputCache
+    INPUT_CACHE_MAX_BYTES = int(float(InputCacheGB) * 1024**3)
     logger = setup_logger(script_name, to_console=verbose, to_file=outfile+".log")
 
     ## Initialize local variables
     num_threads = int(num_threads)
+    input_threads = int(InputThreads)
     dta_input=False
     runPSYKonly = False
     runLPRonly = False
@@ -1462,6 +1715,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
     atc_cols_to_read_as_date = []
     cluster_run = "Default"
     h5_exist = False
+    h5_2nd_file = ""
 
     
     logger.info(disclaimer_text)
@@ -1810,20 +2064,37 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
         logger.info("[main] Mem before loading all input:")
         usage()
 
-    if BuildIndex:
-        print("[main] Building Index")
-        index_diag_file(
-            input_csv=lpr_file,
-            separator=fsep,
-            index_columns=[iidcol,diagnostic_col],
-            dtypes = index_dtypes
-        )
+    if BuildIndex or UpdateIndex:
+        print("[main] Updating Index" if UpdateIndex else "[main] Building Index")
+        # all -f and --atc files go into one pool, so e.g. PSYK, LPR and ATC are indexed side by side
+        index_jobs = [(path.strip(), [iidcol, diagnostic_col]) for path in lpr_file.split(",")]
         if (atc_file != ""):
-            index_diag_file(atc_file,fsep,atc_diag_col)
+            index_jobs += [(path.strip(), [iidcol, atc_diag_col]) for path in atc_file.split(",")]
+        index_diag_files(index_jobs, workers=num_threads, separator=fsep, dtypes=index_dtypes, update=UpdateIndex)
+        if (lpr2nd_file != ""):
+            # secondary diagnoses are indexed as their recnum join with the -f records (see build_secondary_join_index)
+            lpr_paths = [path.strip() for path in lpr_file.split(",")]
+            lpr2nd_paths = [path.strip() for path in lpr2nd_file.split(",")]
+            if len(lpr_paths) != len(lpr2nd_paths):
+                logger.info("[main] ERROR: --BuildIndex needs one --f2 file per -f file, given in the same order.")
+                sys.exit(1)
+            for lprpath, lpr2ndpath in zip(lpr_paths, lpr2nd_paths):
+                joined_h5 = build_secondary_join_index(lprpath, lpr2ndpath, fsep, iidcol, diagnostic_col, lpr_recnummer,
+                                                       lpr2nd_recnummer, diagnostic2nd_col, dtypes=index_dtypes)
+                if joined_h5:
+                    print(f"  → wrote secondary diagnosis join: {joined_h5}")
+        sys.exit()
+
+    if BuildParquet:
+        print("[main] Building Parquet input files")
+        convert_to_parquet(lpr_file, fsep, lpr_cols_to_read_as_date, iidcol=iidcol)
         if (lpr2nd_file != ""):
-            logger.info("[main] WARNING: --BuildIndex only works with -f and --atc, but not with --f2.")
-            sys.exit()
-            #index_diag_file(lpr2nd_file,fsep,diagnostic2nd_col)
+            convert_to_parquet(lpr2nd_file, fsep, lpr_cols_to_read_as_date, iidcol=iidcol)
+        if (atc_file != ""):
+            convert_to_parquet(atc_file, fsep, atc_cols_to_read_as_date, iidcol=iidcol)
+        convert_to_parquet(stam_file, isep, stam_cols_to_read_as_date, iidcol=iidcol)
+        if (addition_information_file != ""):
+            convert_to_parquet(addition_information_file, jsep, stam_cols_to_read_as_date, iidcol=iidcol)
         sys.exit()
 
 
@@ -1885,49 +2156,32 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
         if verbose:
             logger.info("[main] Mem after loading pheno_request input:")
             usage()
-        # Load STAM file (-i)
-        df3 = load_data_file(data_file=stam_file, sep=isep, birthdatecol=birthdatecol, diagnostic_col=diagnostic_col, sexcol = sexcol, stam_cols_to_read_as_date = stam_cols_to_read_as_date, iidcol=iidcol)
-        logger.info("[main] Finished loading -i file(s)")
-        if not verbose:
-            print("[main] Finished loading -i file(s)")
-        if verbose:
-            logger.info(f"[main] Header of your -i file: {df3.head(5)}")
-        logger.info(df3.head(5))
-        # Check if input is plausible (e.g. contains every IID only once)
-        if (len(df3) > len(df3[iidcol].unique())):
-            logger.info("[main] WARNING: Your input file -i contains duplicated IIDs. If this should not be the case, please check your input!")
-        if verbose:
-            logger.info(df3.columns)
-            logger.info("[main] Mem after loading data_file input:")
-            usage()
+        # Read the independent inputs (-i, -j, ophold) on up to --InputThreads threads while -f and --atc are
+        # loaded (-f with its own --nthreads shard threads); each result is collected where it is first needed. The arguments are bound now (partial), as main
+        # renames some of these variables before the results are collected.
+        input_loaders = {
+            "stam": partial(load_data_file, data_file=stam_file, sep=isep, birthdatecol=birthdatecol, diagnostic_col=diagnostic_col, sexcol = sexcol, stam_cols_to_read_as_date = stam_cols_to_read_as_date, iidcol=iidcol),
+        }
+        if (addition_information_file != ''):
+            input_loaders["addition"] = partial(load_data_file, data_file=addition_information_file, sep=jsep, birthdatecol=birthdatecol, diagnostic_col=diagnostic_col, sexcol = sexcol, stam_cols_to_read_as_date = stam_cols_to_read_as_date, iidcol=iidcol)
         if (cluster_run in DK_clusters):
             if (build_ophold):
-                try:
-                    if dta_input:
-                        ophold = pd.read_stata(ophold_file, sep=opholdsep, dtype=object)
-                    else:
-                        ophold = pd.read_csv(ophold_file, sep=opholdsep, dtype=object)
-                except TypeError:
-                    ophold = pd.read_csv(ophold_file, engine='python', sep=opholdsep, dtype=object)
-                df3 = process_ophold(ophold, df3, "", processed_ophold_file, birthdatecol, iidcol, verbose)
-            else:
-                if (os.path.isfile(processed_ophold_file)):
+                def _read_raw_ophold():
                     try:
-                        ophold = pd.read_csv(processed_ophold_file, sep=opholdsep, dtype=object)
+                        if dta_input:
+                            return pd.read_stata(ophold_file, sep=opholdsep, dtype=object)
+                        return pd.read_csv(ophold_file, sep=opholdsep, dtype=object)
                     except TypeError:
-                        ophold = pd.read_csv(processed_ophold_file, engine='python', sep=opholdsep, dtype=object)
-                    df3 = pd.merge(df3,ophold,how="left", on=iidcol)
-        n_stam_iids = df3[iidcol].nunique()
-        gc.collect()
-        # Initialize the additional data file
-        df4 = pd.DataFrame()
-        # Load the fourth file as a DataFrame(should be a file with additional rows of information. This will not be merged but appended to df1) 
-        if (addition_information_file != ''):
-            df4 = load_data_file(data_file=addition_information_file, sep=jsep, birthdatecol=birthdatecol, diagnostic_col=diagnostic_col, sexcol = sexcol, stam_cols_to_read_as_date = stam_cols_to_read_as_date, iidcol=iidcol)
-            if(("birthdate" in df3.columns) and "birthdate" in df4.columns):# or "birthdate" in df1.columns) and "birthdate" in df4.columns):
-                df4.drop("birthdate",inplace=True, axis=1)
-            if(("diagnosis" in df3.columns) and "diagnosis" in df4.columns):# or "diagnosis" in df1.columns) and "diagnosis" in df4.columns):
-                df4.drop("diagnosis",inplace=True, axis=1)
+                        return pd.read_csv(ophold_file, engine='python', sep=opholdsep, dtype=object)
+                input_loaders["ophold"] = _read_raw_ophold
+            elif (os.path.isfile(processed_ophold_file)):
+                def _read_ophold(path):
+                    try:
+                        return pd.read_csv(path, sep=opholdsep, dtype=object)
+                    except TypeError:
+                        return pd.read_csv(path, engine='python', sep=opholdsep, dtype=object)
+                input_loaders["ophold"] = partial(load_with_input_cache, processed_ophold_file, {"sep": opholdsep, "dtype": "object"}, _read_ophold)
+        input_loads = submit_input_loads(input_loaders, workers=input_threads)
         #in_pheno_codes, normalized_pheno = dict_update_icd_coding(in_pheno_codes, exact_match, skip_icd_update, remove_point_in_diag_request, ICDCM, noLeadingICD, icdprefix)
         pheno_request = in_pheno_codes
         if (use_predefined_exdep_exclusions):
@@ -2028,25 +2282,16 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
             atc_file = ""
             ATC_Requested = "None"
 
-        if selectIIDs != "" and os.path.exists(selectIIDs):
-            # read iid file
-            iids = pd.read_csv(selectIIDs, header=None)[0]
-            # normalize
-            iids = normalize_iid_series(iids, target="str").tolist()
-            # filter df3
-            df3 = df3[df3[iidcol].astype("string").isin(iids)]
-
-        else:
-            iids = df3[iidcol].unique()  # Get unique IIDs from df3
-            iids = normalize_iid_series(pd.Series(iids))
-            #iids = pd.to_numeric(pd.Series(iids), errors="coerce").dropna().astype(int).tolist()
-
-        if os.path.exists(lpr_file.rpartition('.')[0] + ".h5"):
+        h5_files, h5_2nd_files = h5_input_stores(lpr_file, lpr2nd_file)
+        if h5_files:
             h5_exist = True
-            h5_file = lpr_file.rpartition('.')[0] + ".h5"
+            h5_file = ",".join(h5_files)
             logger.info("[main] Identified an available h5 indexed input for the lpr -f file.")
             if not verbose:
                 print("[main] Identified an indexed h5 input for -f file")
+            if h5_2nd_files:
+                h5_2nd_file = ",".join(h5_2nd_files)
+                logger.info(f"[main] Identified an h5 indexed --f2 join: {h5_2nd_file}")
         pheno_requests = []
         pheno_requests_normalized = []
         pheno_requests_normalized.extend(set(map(str,normalized_pheno)))
@@ -2072,6 +2317,77 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
         logger.info(f"[main] Final ICD codes to call: {flattened_pheno_requests}, based on: {pheno_requests}")
         if not verbose:
             print(f"[main] Final ICD codes to call: {flattened_pheno_requests}, based on: {pheno_requests}")    
+        # Only the -f columns this run uses are loaded (see lpr_columns_needed)
+        lpr_usecols = lpr_columns_needed(iidcol, diagnostic_col, input_date_in_name, input_date_out_name, ctype_col,
+                                         lpr_recnummer, birthdatecol, lpr_cols_to_read_as_date, codes=pheno_requests)
+        if lpr_usecols is None:
+            logger.info("[main] Rule-based (main=/sub=/rule_out=) codes requested; reading every -f column.")
+        if not (h5_exist and not BuildEntryExitDates) and not lowMem:
+            # Keep only the -f rows the requested codes can match while reading, as the h5 path does.
+            # Entry/exit dates and --MatchFI need every record of an IID, so they read the full files.
+            lpr_prefilter = None
+            if not BuildEntryExitDates and not MatchFI:
+                lpr_prefilter = compile_lpr_prefilter(flattened_pheno_requests + pheno_requests)
+                if lpr_prefilter is not None:
+                    logger.info("[main] Prefiltering -f rows on the requested codes while loading.")
+            input_loads.update(submit_input_loads({"lpr": partial(process_lpr_data,
+                lpr_file, lpr2nd_file, dta_input, fsep, lpr_cols_to_read_as_date, 
+                DateFormat, potential_lpr_cols_to_read_as_date, diagnostic_col, diagnostic2nd_col, 
+                lpr_recnummer, lpr2nd_recnummer, iidcol = iidcol, usecols = lpr_usecols, prefilter = lpr_prefilter,
+                workers = num_threads
+            )}, workers=input_threads))
+        # The ATC file is read once and sliced per call of process_pheno_and_exclusions, except where each
+        # --lowmem batch can read just its own rows: CSV through the IID index, Parquet through the pushed-down filter
+        if (ATC_Requested == "All" or ATC_Requested == "Some") and atc_file != "" \
+                and not all(is_parquet_path(p) for p in atc_file.split(",")) and (not lowMem or dta_input):
+            input_loads.update(submit_input_loads({"atc": partial(load_data_file,
+                data_file=atc_file, sep=fsep, birthdatecol="", diagnostic_col=atc_diag_col, sexcol = "",
+                stam_cols_to_read_as_date = atc_cols_to_read_as_date, iidcol=iidcol
+            )}, workers=input_threads))
+        # Load STAM file (-i)
+        df3 = input_loads["stam"].result()
+        logger.info("[main] Finished loading -i file(s)")
+        if not verbose:
+            print("[main] Finished loading -i file(s)")
+        if verbose:
+            logger.info(f"[main] Header of your -i file: {df3.head(5)}")
+        logger.info(df3.head(5))
+        # Check if input is plausible (e.g. contains every IID only once)
+        if (len(df3) > len(df3[iidcol].unique())):
+            logger.info("[main] WARNING: Your input file -i contains duplicated IIDs. If this should not be the case, please check your input!")
+        if verbose:
+            logger.info(df3.columns)
+            logger.info("[main] Mem after loading data_file input:")
+            usage()
+        if (cluster_run in DK_clusters):
+            if (build_ophold):
+                df3 = process_ophold(input_loads["ophold"].result(), df3, "", processed_ophold_file, birthdatecol, iidcol, verbose)
+            elif "ophold" in input_loads:
+                df3 = pd.merge(df3,input_loads["ophold"].result(),how="left", on=iidcol)
+        n_stam_iids = df3[iidcol].nunique()
+        gc.collect()
+        # Initialize the additional data file
+        df4 = pd.DataFrame()
+        # Load the fourth file as a DataFrame(should be a file with additional rows of information. This will not be merged but appended to df1) 
+        if (addition_information_file != ''):
+            df4 = input_loads["addition"].result()
+            if(("birthdate" in df3.columns) and "birthdate" in df4.columns):# or "birthdate" in df1.columns) and "birthdate" in df4.columns):
+                df4.drop("birthdate",inplace=True, axis=1)
+            if(("diagnosis" in df3.columns) and "diagnosis" in df4.columns):# or "diagnosis" in df1.columns) and "diagnosis" in df4.columns):
+                df4.drop("diagnosis",inplace=True, axis=1)
+        if selectIIDs != "" and os.path.exists(selectIIDs):
+            # read iid file
+            iids = pd.read_csv(selectIIDs, header=None)[0]
+            # normalize
+            iids = normalize_iid_series(iids, target="str").tolist()
+            # filter df3
+            df3 = df3[df3[iidcol].astype("string").isin(iids)]
+
+        else:
+            iids = df3[iidcol].unique()  # Get unique IIDs from df3
+            iids = normalize_iid_series(pd.Series(iids))
+            #iids = pd.to_numeric(pd.Series(iids), errors="coerce").dropna().astype(int).tolist()
+
         #Keep only unique entries and sort them
         planned_output_columns = None
         if lowMem:
@@ -2091,6 +2407,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                 atc_requested=ATC_Requested,
             )
             logger.info(f"[main] Precomputed low-memory output schema with {len(planned_output_columns)} columns: {planned_output_columns}")
+        atc_data = input_loads["atc"].result() if "atc" in input_loads else None
         if h5_exist and not BuildEntryExitDates:
             logger.info(f"[main] ICD codes to call using the h5 indexed file: {flattened_pheno_requests}, based on: {pheno_requests}")
             del(pheno_requests)
@@ -2109,20 +2426,13 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                                   diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)
                 df1[iidcol] = normalize_iid_series(df1[iidcol], target="str")
                 df3[iidcol] = normalize_iid_series(df3[iidcol], target="str")
-                if lpr2nd_file:
+                if lpr2nd_file and h5_2nd_file:
+                    df1 = pd.concat([df1, h5_load_df1(h5_file=h5_2nd_file, iids=IIDsToUse, iidcol=iidcol, flattened_pheno_requests=flattened_pheno_requests, exact_match=exact_match,
+                                                       BuildEntryExitDates=BuildEntryExitDates, diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)],
+                                    ignore_index=True, sort=False)
+                elif lpr2nd_file:
                     recs = df1[lpr_recnummer].dropna().unique()
-                    rows_to_keep = load_mapping_rows(
-                        file_path=lpr2nd_file,
-                        iidcol=lpr2nd_recnummer,
-                        target_iids=recs,
-                        sep=fsep,
-                        suffix_search=False,
-                    )
-                    df_lpr2nd = pd.read_csv(
-                        lpr2nd_file,
-                        sep=fsep,
-                        skiprows=lambda idx: idx not in rows_to_keep,
-                    )
+                    df_lpr2nd = read_rows_with_keys(lpr2nd_file, lpr2nd_recnummer, recs, sep=fsep)
                     df_lpr2nd = finalize_lpr_data(
                         df1=df_lpr2nd,
                         diagnostic_col=diagnostic2nd_col,
@@ -2149,6 +2459,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                         df3[iidcol] = normalize_iid_series(df3[iidcol], target="str")
                     except Exception as e:
                         logger.info(f"[main] Warning: failed to normalize df3 IID column: {e}")
+                df1 = categorize_code_columns(df1, verbose=verbose)
                 logger.info(f"[main] At the end of loading h5 with df1.head(5): {df1.head(5)}")
                 gc.collect()
                 logger.info(f"[main] Starting process_pheno_and_exclusions with df3: {df3.head(5)} and df1: {df1.head(5)}")
@@ -2165,7 +2476,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                                         write_Plink2_format=write_Plink2_format, write_fastGWA_format=write_fastGWA_format, write_pickle=write_pickle, n_stam_iids=n_stam_iids, 
                                         exclCHBcontrols=exclCHBcontrols, iidstatus_col=iidstatus_col, iidstatusdate=iidstatusdate, addition_information_file=addition_information_file, sexcol=sexcol, 
                                         input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, append=False, icdprefix=icdprefix, noLeadingICD=noLeadingICD, 
-                                        lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions, post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name)
+                                        lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions, post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name, atc_data=atc_data)
             elif lowMem and not verylowMem:
                 first_write = True  # Control whether to overwrite or append to the file
                 iids = df3[iidcol].unique()  # Get unique IIDs from df3
@@ -2180,20 +2491,13 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                 #                 diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)
                 df1[iidcol] = normalize_iid_series(df1[iidcol], target="str")
                 df3[iidcol] = normalize_iid_series(df3[iidcol], target="str")
-                if lpr2nd_file:
+                if lpr2nd_file and h5_2nd_file:
+                    df1 = pd.concat([df1, h5_load_df1(h5_file=h5_2nd_file, iids=[], iidcol=iidcol, flattened_pheno_requests=flattened_pheno_requests, exact_match=exact_match,
+                                                       BuildEntryExitDates=BuildEntryExitDates, diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)],
+                                    ignore_index=True, sort=False)
+                elif lpr2nd_file:
                     recs = df1[lpr_recnummer].dropna().unique()
-                    rows_to_keep = load_mapping_rows(
-                        file_path=lpr2nd_file,
-                        iidcol=lpr2nd_recnummer,
-                        target_iids=recs,
-                        sep=fsep,
-                        suffix_search=False,
-                    )
-                    df_lpr2nd = pd.read_csv(
-                        lpr2nd_file,
-                        sep=fsep,
-                        skiprows=lambda idx: idx not in rows_to_keep,
-                    )
+                    df_lpr2nd = read_rows_with_keys(lpr2nd_file, lpr2nd_recnummer, recs, sep=fsep)
                     df_lpr2nd = finalize_lpr_data(
                         df1=df_lpr2nd,
                         diagnostic_col=diagnostic2nd_col,
@@ -2220,6 +2524,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                         df3[iidcol] = normalize_iid_series(df3[iidcol], target="str")
                     except Exception as e:
                         logger.info(f"[main] Warning: failed to normalize df3 IID column: {e}")
+                df1 = categorize_code_columns(df1, verbose=verbose)
                 logger.info(f"[main] At the end of loading h5 with df1.head(5):{df1.head(5)}")
                 if not verbose:
                      print(f"[main] At the end of loading h5 with df1.head(5):{df1.head(5)}")
@@ -2254,7 +2559,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                     append=append_flag, icdprefix=icdprefix, noLeadingICD=noLeadingICD,
                     lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions,
                     post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name,
-                    output_columns=planned_output_columns
+                    output_columns=planned_output_columns, atc_data=atc_data
                 )
                 #End new 09.12.2025
                 # Old 01.10.2025
@@ -2308,20 +2613,14 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                                   diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)
                     df1 = subset_to_iid_batch(df1, iidcol, iid_batch)
                     df3[iidcol] = normalize_iid_series(df3[iidcol], target="str")
-                    if lpr2nd_file and not df1.empty and lpr_recnummer in df1.columns:
+                    if lpr2nd_file and h5_2nd_file:
+                        df1 = pd.concat([df1, h5_load_df1(h5_file=h5_2nd_file, iids=iid_batch, iidcol=iidcol, flattened_pheno_requests=flattened_pheno_requests, exact_match=exact_match,
+                                                           BuildEntryExitDates=BuildEntryExitDates, diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col)],
+                                        ignore_index=True, sort=False)
+                        df1 = subset_to_iid_batch(df1, iidcol, iid_batch)
+                    elif lpr2nd_file and not df1.empty and lpr_recnummer in df1.columns:
                         recs = df1[lpr_recnummer].dropna().unique()
-                        rows_to_keep = load_mapping_rows(
-                            file_path=lpr2nd_file,
-                            iidcol=lpr2nd_recnummer,
-                            target_iids=recs,
-                            sep=fsep,
-                            suffix_search=False,
-                        )
-                        df_lpr2nd = pd.read_csv(
-                            lpr2nd_file,
-                            sep=fsep,
-                            skiprows=lambda idx: idx not in rows_to_keep,
-                        )
+                        df_lpr2nd = read_rows_with_keys(lpr2nd_file, lpr2nd_recnummer, recs, sep=fsep)
                         df_lpr2nd = finalize_lpr_data(
                             df1=df_lpr2nd,
                             diagnostic_col=diagnostic2nd_col,
@@ -2341,6 +2640,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                     loaded_iids = df1[iidcol].nunique() if iidcol in df1.columns else 0
                     if loaded_iids > len(iid_batch):
                         logger.warning(f"[main] Batch {batch_num + 1}: df1 contains {loaded_iids} IIDs after loading, exceeding the requested batch size {len(iid_batch)}.")
+                    df1 = categorize_code_columns(df1, verbose=verbose)
                     logger.info(f"[main] At the end of loading current h5 batch {batch_num + 1} with df1.head(5):{df1.head(5)}")
                     gc.collect()
                     file_exists = os.path.exists(outfile)  # append when file already exists (lowMem runs may be incremental)
@@ -2378,7 +2678,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                         append=append_flag, icdprefix=icdprefix, noLeadingICD=noLeadingICD,
                         lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions,
                         post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name,
-                        output_columns=planned_output_columns
+                        output_columns=planned_output_columns, atc_data=atc_data
                     )
                     first_write = False
                 # Verify all IIDs were processed
@@ -2446,21 +2746,30 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
             if not verbose:
                 print("[main] Running in low memory mode. Processing df1 in batches.")
             df3backup, iids_list, batch_size, num_batches = prepare_iid_batches(df3, iidcol, batchsize)
+            # Optionally split -f once into per-batch part files (single scan instead of one lookup per batch)
+            spill_dir = ""
+            batch_lpr_files = None
+            if spill_batches and not dta_input and not any(is_parquet_path(p) for p in _split_input_paths(lpr_file)):
+                spill_dir = os.path.join(os.path.dirname(os.path.abspath(outfile)), f".{os.path.basename(outfile)}.spill_{uuid.uuid4().hex[:6]}")
+                try:
+                    batch_lpr_files = spill_lpr_by_iid_batch(lpr_file, iidcol, fsep, iids_list, batch_size, spill_dir, verbose=verbose)
+                    logger.info(f"[main] Split -f into {num_batches} IID batch part files in {spill_dir}")
+                except ValueError as e:
+                    logger.info(f"[main] WARNING: could not split -f by IID batch ({e}); loading each batch from -f instead.")
+                    shutil.rmtree(spill_dir, ignore_errors=True)
+                    batch_lpr_files = None
             
-            first_write = True  # Control whether to overwrite or append to the file
             # df1 = pd.DataFrame() # commented out 02.05.2025
             processed_iids = set()
 
-            for batch_num in range(num_batches):
+            def _run_batch(batch_num, batch_outfile, append_flag):
+                """Load, process and write one IID batch to batch_outfile; returns the batch IIDs."""
                 df1 = pd.DataFrame()
                 # Get the current batch of IIDs
                 start_idx = batch_num * batch_size
                 end_idx = start_idx + batch_size
                 iid_batch = iids_list[start_idx:end_idx]
         
-                # Track processed IIDs to verify we get them all
-                processed_iids.update(iid_batch)
-        
                 df3 = df3backup[df3backup[iidcol].astype(str).isin(set(iid_batch))].copy()
                 n_stam_iids = df3[iidcol].nunique()
                 logger.info(f"[main] Processing batch {batch_num + 1}/{num_batches} with {len(iid_batch)} IIDs... {iid_batch[:5]}")
@@ -2470,11 +2779,24 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                 #             iidcol = iidcol, iid_batch = iid_batch, batch_num = batch_num, fsep = fsep,
                 #             potential_lpr_cols_to_read_as_date = potential_lpr_cols_to_read_as_date, lpr_cols_to_read_as_date = lpr_cols_to_read_as_date,
                 #             verbose = verbose, dta_input = dta_input, DateFormat = DateFormat, diagnostic_col = diagnostic_col, diagnostic2nd_col = diagnostic2nd_col)
-                df1 =  batch_load_lprfile(df = df1, lprfile = lpr_file, lpr_recnummer = lpr_recnummer, lpr2nd_file = lpr2nd_file, lpr2nd_recnummer = lpr2nd_recnummer,
-                            iidcol = iidcol, iid_batch = iid_batch, batch_num = batch_num, sep = fsep,
-                            potential_lpr_cols_to_read_as_date = potential_lpr_cols_to_read_as_date, lpr_cols_to_read_as_date = lpr_cols_to_read_as_date,
-                            verbose = verbose, dta_input = dta_input, DateFormat = DateFormat, diagnostic_col = diagnostic_col, diagnostic2nd_col = diagnostic2nd_col,
-                            filter_on_diagcol = False, diags = flattened_pheno_requests) #diags = in_pheno_codes)
+                if batch_lpr_files is None:
+                    df1 =  batch_load_lprfile(df = df1, lprfile = lpr_file, lpr_recnummer = lpr_recnummer, lpr2nd_file = lpr2nd_file, lpr2nd_recnummer = lpr2nd_recnummer,
+                                iidcol = iidcol, iid_batch = iid_batch, batch_num = batch_num, sep = fsep,
+                                potential_lpr_cols_to_read_as_date = potential_lpr_cols_to_read_as_date, lpr_cols_to_read_as_date = lpr_cols_to_read_as_date,
+                                verbose = verbose, dta_input = dta_input, DateFormat = DateFormat, diagnostic_col = diagnostic_col, diagnostic2nd_col = diagnostic2nd_col,
+                                filter_on_diagcol = False, diags = flattened_pheno_requests, usecols = lpr_usecols) #diags = in_pheno_codes)
+                elif batch_lpr_files[batch_num] != "":
+                    # The part files hold only this batch's rows, so no further IID filtering is needed on load
+                    df1 =  batch_load_lprfile(df = df1, lprfile = batch_lpr_files[batch_num], lpr_recnummer = lpr_recnummer, lpr2nd_file = lpr2nd_file, lpr2nd_recnummer = lpr2nd_recnummer,
+                                iidcol = iidcol, iid_batch = None, batch_num = batch_num, sep = fsep,
+                                potential_lpr_cols_to_read_as_date = potential_lpr_cols_to_read_as_date, lpr_cols_to_read_as_date = lpr_cols_to_read_as_date,
+                                verbose = verbose, dta_input = dta_input, DateFormat = DateFormat, diagnostic_col = diagnostic_col, diagnostic2nd_col = diagnostic2nd_col,
+                                filter_on_diagcol = False, diags = flattened_pheno_requests, usecols = lpr_usecols)
+                    for part_file in batch_lpr_files[batch_num].split(","):
+                        try:
+                            os.remove(part_file)
+                        except OSError:
+                            pass
                 gc.collect()
                 logger.info(f"[main] After batch loading lpr file for batch {batch_num + 1} with df1.head(5):{df1.head(5)}; df3backup:{df3backup}; df3backup[df3backup[iidcol].isin(iid_batch)]:{df3backup[df3backup[iidcol].isin(iid_batch)].head(5)}; iid_batch: {iid_batch[:5]}; iidcol:{iidcol}")
                 if not verbose:
@@ -2490,10 +2812,11 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                         logger.info(f"[main] Warning: failed to normalize df1 IID column: {e}")
                 # End New 02.12.2025
                 df1 = subset_to_iid_batch(df1, iidcol, iid_batch)
+                df1 = categorize_code_columns(df1, verbose=verbose)
                 if exact_match and diagnostic_col in df1.columns:
                     logger.info("[main] Updating the diagnostic codes to be all Uppercase to be able to run --eM")
-                    # Ensure only strings are processed and apply the transformation in one go
-                    df1[diagnostic_col] = df1[diagnostic_col].apply(lambda x: x.upper() if isinstance(x, str) else x)
+                    # Upper-case the unique codes (categories) only instead of every row
+                    df1[diagnostic_col] = map_code_vocabulary(df1[diagnostic_col], str.upper)
                 loaded_iids = df1[iidcol].nunique() if iidcol in df1.columns else 0
                 if loaded_iids > len(iid_batch):
                     logger.warning(f"[main] Batch {batch_num + 1}: df1 contains {loaded_iids} IIDs after loading, exceeding the requested batch size {len(iid_batch)}.")
@@ -2506,12 +2829,6 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                 logger.info(f"[main] At the end of lowMem (no h5 file available) with df1.head(5):{df1.head(5)}")
                 if BuildEntryExitDates:
                     df3 = BuildEntryExitDate(df1, df3, iidcol, input_date_in_name, input_date_out_name, verbose)
-                file_exists = os.path.exists(outfile)
-                append_flag = not first_write
-                if first_write == True:
-                    append_flag = False
-                elif file_exists:
-                    append_flag = True
                 if len(df1) > 0:
                     logger.info(f"[main] Starting process_pheno_and_exclusions with df3:{df3.head(5)}; df1:{df1.head(5)}")
                     if not verbose:
@@ -2530,13 +2847,27 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                                          multi_inclusions=multi_inclusions, in_pheno_codes=in_pheno_codes, pheno_requestcol=pheno_requestcol, diagnostic_col=diagnostic_col, 
                                          atc_diag_col=atc_diag_col, birthdatecol=birthdatecol, atc_date_col=atc_date_col, atc_cols_to_read_as_date=atc_cols_to_read_as_date, 
                                          atc_file=atc_file, sep=fsep, BuildEntryExitDates=BuildEntryExitDates, lifetime_exclusions_file=lifetime_exclusions_file, 
-                                         post_exclusions_file=post_exclusions_file, oneYearPrior_exclusions_file=oneYearPrior_exclusions_file, outfile=outfile, 
+                                         post_exclusions_file=post_exclusions_file, oneYearPrior_exclusions_file=oneYearPrior_exclusions_file, outfile=batch_outfile, 
                                          write_Plink2_format=write_Plink2_format, write_fastGWA_format=write_fastGWA_format, write_pickle=write_pickle, n_stam_iids=n_stam_iids, 
                                          exclCHBcontrols=exclCHBcontrols, iidstatus_col=iidstatus_col, iidstatusdate=iidstatusdate, addition_information_file=addition_information_file, sexcol=sexcol, 
                                          input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, append=append_flag, icdprefix=icdprefix, noLeadingICD=noLeadingICD,
                                          lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions, post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name,
-                                         output_columns=planned_output_columns)
-                first_write = False
+                                         output_columns=planned_output_columns, atc_data=atc_data)
+                return iid_batch
+
+            if num_threads > 1 and num_batches > 1:
+                # The first batch runs here (writing the output header) and sizes the process pool for the rest
+                rss_before = psutil.Process(os.getpid()).memory_info().rss
+                first_iids, peak_rss = measure_peak_rss(_run_batch, 0, outfile, False)
+                processed_iids.update(first_iids)
+                per_batch_bytes = max(peak_rss - rss_before, 256 * 1024**2)
+                processed_iids.update(run_batches_in_process_pool(_run_batch, range(1, num_batches), outfile, num_threads, per_batch_bytes))
+            else:
+                for batch_num in range(num_batches):
+                    # Track processed IIDs to verify we get them all
+                    processed_iids.update(_run_batch(batch_num, outfile, append_flag=batch_num > 0))
+            if spill_dir:
+                shutil.rmtree(spill_dir, ignore_errors=True)
             # Verify all IIDs were processed
             missing_iids = set(iids_list) - processed_iids
             if missing_iids:
@@ -2546,11 +2877,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
             else:
                 logger.info(f"[main] SUCCESS: All {len(iids_list)} IIDs were processed across {num_batches} batches")
         else:            
-            df1 = process_lpr_data(
-                lpr_file, lpr2nd_file, dta_input, fsep, lpr_cols_to_read_as_date, 
-                DateFormat, potential_lpr_cols_to_read_as_date, diagnostic_col, diagnostic2nd_col, 
-                lpr_recnummer, lpr2nd_recnummer, iidcol = iidcol
-            )
+            df1 = input_loads["lpr"].result()
             
             df1 = finalize_lpr_data(df1=df1, diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col, verbose=verbose)
             # New 02.12.2025
@@ -2564,9 +2891,10 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
             # End New 02.12.2025
             diagnostic_col = "diagnosis"
             birthdatecol = "birthdate"
+            df1 = categorize_code_columns(df1, verbose=verbose)
             if(exact_match):
                 logger.info("[main] Updating the diagnostic codes to be all Uppercase to be able to run --eM")
-                df1[diagnostic_col] = df1[diagnostic_col].apply(lambda x: x.upper() if isinstance(x, str) else x)
+                df1[diagnostic_col] = map_code_vocabulary(df1[diagnostic_col], str.upper)
 
             if verbose:
                 logger.info(df1.columns)
@@ -2598,7 +2926,7 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
                                          write_Plink2_format=write_Plink2_format, write_fastGWA_format=write_fastGWA_format, write_pickle=write_pickle, n_stam_iids=n_stam_iids, 
                                          exclCHBcontrols=exclCHBcontrols, iidstatus_col=iidstatus_col, iidstatusdate=iidstatusdate, addition_information_file=addition_information_file, sexcol=sexcol, 
                                          input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, append=False, icdprefix=icdprefix, noLeadingICD=noLeadingICD,
-                                        lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions, post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name)
+                                        lifetime_exclusions=lifetime_exclusions, oneYearPrior_exclusions=oneYearPrior_exclusions, post_exclusions=post_exclusions, covariates=covariates, lowMem=lowMem, main_pheno_name=main_pheno_name, atc_data=atc_data)
 
         
     logger.info("[main] Finished the Phenotype definition(s). Producing checksums")
@@ -2641,7 +2969,144 @@ def main(lpr_file, pheno_request, stam_file, addition_information_file, use_pred
         print(disclaimer_text)
         print(f"[main] Your Arguments used to start this program:\n{argstring}")
 
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".zip", ".xz", ".zst")
+H5_ZONE_MAP_SUFFIX = "_zonemap"
+H5_ZONE_BLOCK_ROWS = 100_000
+H5_CODE_VOCAB_SUFFIX = "_codes"
+H5_POSTINGS_SUFFIX = "_postings"
+H5_POSTINGS_DIR_SUFFIX = "_postings_dir"
+# storer attribute holding the source file state (size/mtime/sha256) and build settings of an index
+H5_INDEX_META_ATTR = "getpheno_index_meta"
+
+def _index_source_meta(path, block_size=1 << 24):
+    """Size, mtime and SHA-256 of an index source file."""
+    st = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return {"source": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest.hexdigest()}
+
+def _update_h5_index(path, h5_store, table_name, index_columns, separator, chunksize, block_size=1 << 24):
+    """
+    Bring an existing index of `path` up to date without re-ingesting it. Returns True if the index is
+    current afterwards: the source is unchanged (same size and mtime, or same SHA-256), or it only grew,
+    i.e. the indexed bytes are an unchanged, newline-terminated prefix of the file. Then only the new
+    lines are parsed and appended (IID-sorted per chunk if the index is sorted), and the zone map and
+    code index are extended. Returns False if the file has to be indexed from scratch.
+    """
+    iidcol = index_columns[0] if index_columns else None
+    diagcol = index_columns[1] if len(index_columns) > 1 else None
+    if not os.path.exists(h5_store) or path.lower().endswith(COMPRESSED_SUFFIXES):
+        return False
+    with pd.HDFStore(h5_store, mode="a") as store:
+        if f"/{table_name}" not in store.keys():
+            return False
+        meta = getattr(store.get_storer(table_name).attrs, H5_INDEX_META_ATTR, None)
+        if not meta or meta.get("index_columns") != list(index_columns) or meta.get("separator") != separator:
+            logger.info(f"[index_diag_file] {h5_store} has no matching index metadata; re-indexing {path}.")
+            return False
+        st = os.stat(path)
+        if st.st_size == meta["size"] and st.st_mtime_ns == meta["mtime_ns"]:
+            print(f"  → {h5_store} is up to date, skipping")
+            return True
+        if st.st_size < meta["size"]:
+            logger.info(f"[index_diag_file] {path} shrank; re-indexing.")
+            return False
+
+        # Hash the indexed prefix; if it is unchanged, copy the new lines (with the header) to a delta file
+        delta_file = h5_store + ".delta.csv"
+        digest = hashlib.sha256()
+        with open(path, "rb") as src:
+            header = src.readline()
+            src.seek(0)
+            remaining, last = meta["size"], b""
+            while remaining > 0:
+                block = src.read(min(block_size, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+                last = block[-1:]
+            if remaining > 0 or digest.hexdigest() != meta["sha256"] or last != b"\n":
+                logger.info(f"[index_diag_file] Indexed part of {path} changed; re-indexing.")
+                return False
+            with open(delta_file, "wb") as out:
+                out.write(header)
+                for block in iter(lambda: src.read(block_size), b""):
+                    digest.update(block)
+                    out.write(block)
+
+        dtype_map = {c: (object if dt == "object" else dt) for c, dt in meta["dtype_map"].items()}
+        cols = list(dtype_map)
+        min_itemsize = {c: 256 for c, dt in dtype_map.items() if dt is object}
+        old_nrows = store.get_storer(table_name).nrows
+        written = old_nrows
+        try:
+            for chunk in pd.read_csv(delta_file, sep=separator, chunksize=chunksize):
+                chunk = chunk[cols].astype(dtype_map, copy=False)
+                for c, dt in dtype_map.items():
+                    if dt is object:
+                        chunk[c] = chunk[c].astype(str)
+                if meta.get("sorted"):
+                    chunk = _sort_index_chunk(chunk, [iidcol])
+                chunk.index = pd.RangeIndex(written, written + len(chunk))
+                written += len(chunk)
+                store.append(table_name, chunk, format="table", data_columns=index_columns, min_itemsize=min_itemsize)
+        finally:
+            os.remove(delta_file)
+
+        if written > old_nrows:
+            if h5_zone_map(store, table_name) is not None:
+                build_h5_zone_map(store, table_name, iidcol, diagcol,
+                                  block_rows=meta.get("zone_block_rows", H5_ZONE_BLOCK_ROWS), start_row=old_nrows)
+            if diagcol and f"/{table_name}{H5_CODE_VOCAB_SUFFIX}" in store.keys():
+                build_h5_code_index(store, table_name, diagcol, start_row=old_nrows)
+        meta.update(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=digest.hexdigest())
+        setattr(store.get_storer(table_name).attrs, H5_INDEX_META_ATTR, meta)
+    print(f"  → appended {written - old_nrows} new rows of {path} to {h5_store}")
+    return True
+
+def _iid_sorted_parts(path, separator, iidcol, rows_per_part, spill_dir):
+    """
+    Split a CSV into part files that each hold a consecutive range of sorted (normalized) IIDs,
+    about `rows_per_part` rows each, using spill_lpr_by_iid_batch (raw lines, file order kept).
+    Returns the non-empty parts in IID order, or None if the file cannot be split this way
+    (compressed input, rows without an IID, or records spanning several lines).
+    """
+    if path.lower().endswith(COMPRESSED_SUFFIXES):
+        logger.info(f"[index_diag_file] {path} is compressed; writing rows in file order.")
+        return None
+    try:
+        counts = pd.Series(dtype=np.int64)
+        total = 0
+        for ch in pd.read_csv(path, sep=separator, usecols=[iidcol], dtype=str, chunksize=5_000_000):
+            total += len(ch)
+            counts = counts.add(normalize_iid_series(ch[iidcol], target="str").value_counts(), fill_value=0)
+        if total == 0 or counts.sum() != total:
+            logger.info(f"[index_diag_file] {path} has rows without {iidcol}; writing rows in file order.")
+            return None
+        iids = sorted(counts.index.astype(str))
+        batch_size = max(1, int(len(iids) * rows_per_part // total))
+        parts = spill_lpr_by_iid_batch(path, iidcol, separator, iids, batch_size, spill_dir)
+    except (ValueError, KeyError, pd.errors.ParserError) as e:
+        logger.info(f"[index_diag_file] Cannot split {path} by IID ({e}); writing rows in file order.")
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        return None
+    return [p for p in parts if p]
+
+def _sort_index_chunk(chunk, sort_keys):
+    """Stable sort of an index part by normalized IID (then any further keys); file order is kept within ties."""
+    keys = chunk[sort_keys].astype(str)
+    keys[sort_keys[0]] = normalize_iid_series(keys[sort_keys[0]], target="str").astype(str)
+    order = np.lexsort([keys[c].to_numpy() for c in reversed(sort_keys)])
+    return chunk.iloc[order].reset_index(drop=True)
+
 # --- Indexing function with object dtype for strings to satisfy PyTables ---
+def _log_index_progress(path, rows, started):
+    elapsed = time.perf_counter() - started
+    logger.info(f"[index_diag_file] {path}: {rows:,} rows indexed ({rows / max(elapsed, 1e-9):,.0f} rows/s)")
+
 def index_diag_file(
     input_csv: str,
     index_columns: List[str],
@@ -2650,13 +3115,22 @@ def index_diag_file(
     complevel: int = 5,
     dtypes: Optional[Dict[str, str]] = None,
     table_name: str = "df",
-    separator: str = ","
+    separator: str = ",",
+    sort_rows: bool = True,
+    zone_block_rows: int = H5_ZONE_BLOCK_ROWS,
+    update: bool = False,
+    workers: int = 1,
 ) -> None:
     """
     Build one .h5 per CSV, storing all columns with a consistent schema,
     defaulting string-like columns to object dtype (PyTables-friendly),
     and indexing only `index_columns`.
 
+    With sort_rows, rows are written clustered by IID (index_columns[0]; rows
+    of one IID keep their file order) and a zone map with per-block min/max
+    IID and diagnosis (index_columns[1]) values is stored next to the table,
+    so IID batches and code requests only read the blocks that can match.
+
     Parameters
     ----------
     input_csv : str
@@ -2676,115 +3150,541 @@ def index_diag_file(
         Key under which the table is stored in each HDF5 file.
     separator : str
         Field separator for CSV parsing.
+    sort_rows : bool
+        Cluster rows by IID and write a zone map (see build_h5_zone_map).
+    zone_block_rows : int
+        Rows per zone map block.
+    update : bool
+        Keep existing indexes current instead of rewriting them: files whose size/mtime (or
+        SHA-256) match the index metadata are skipped, files that only grew get the new rows
+        appended (see _update_h5_index), all others are re-indexed.
+    workers : int
+        Number of files indexed at the same time (see index_diag_files).
     """
     paths = [p.strip() for p in input_csv.split(",")] if "," in input_csv else [input_csv]
+    index_diag_files([(path, index_columns) for path in paths], workers=workers, chunksize=chunksize,
+                     complib=complib, complevel=complevel, dtypes=dtypes, table_name=table_name,
+                     separator=separator, sort_rows=sort_rows, zone_block_rows=zone_block_rows, update=update)
 
-    for path in paths:
-        logger.info(f"[index_diag_file] Indexing file: {path}")
-        h5_store = path.rpartition('.')[0] + '.h5'
+def index_diag_files(jobs: List[Tuple[str, List[str]]], workers: int = 1, **options) -> None:
+    """
+    Index several files, e.g. the -f and --atc files, each (path, index_columns) pair in `jobs` with
+    _index_one_file(path, index_columns, **options). With workers > 1 the files are indexed by a pool of
+    forked processes (at most one per file and CPU); each file is written to its own .h5, so the results
+    equal a sequential run. Falls back to indexing sequentially when fork is unavailable.
+    """
+    workers = max(1, min(int(workers), len(jobs), os.cpu_count() or 1))
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for path, index_columns in jobs:
+            _index_one_file(path, index_columns, **options)
+    else:
+        logger.info(f"[index_diag_files] Indexing {len(jobs)} files on {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = {pool.submit(_index_one_file, path, index_columns, **options): path for path, index_columns in jobs}
+            for future in as_completed(futures):
+                # re-raises the worker's exception, so a failed file stops the build as it does sequentially
+                future.result()
+    print("All files indexed.")
+
+def _index_one_file(
+    path: str,
+    index_columns: List[str],
+    chunksize: int = 2_000_000,
+    complib: str = "zlib",
+    complevel: int = 5,
+    dtypes: Optional[Dict[str, str]] = None,
+    table_name: str = "df",
+    separator: str = ",",
+    sort_rows: bool = True,
+    zone_block_rows: int = H5_ZONE_BLOCK_ROWS,
+    update: bool = False,
+) -> None:
+    """Build (or with `update`, bring up to date) the .h5 index of one CSV; see index_diag_file."""
+    iidcol = index_columns[0] if index_columns else None
+    diagcol = index_columns[1] if len(index_columns) > 1 else None
+    started = time.perf_counter()
+
+    logger.info(f"[index_diag_file] Indexing file: {path}")
+    h5_store = path.rpartition('.')[0] + '.h5'
+    if update and _update_h5_index(path, h5_store, table_name, index_columns, separator, chunksize):
+        return
+    source_meta = _index_source_meta(path)
 
-        # 1) Read first chunk to infer schema
+    # 0) Optionally split the file into IID-ordered parts that are sorted one at a time
+    spill_dir = h5_store + ".sortparts"
+    parts = _iid_sorted_parts(path, separator, iidcol, chunksize, spill_dir) if sort_rows and iidcol else None
+    # file order is kept within an IID, so the per-IID code/date lists come out as for the CSV
+    sort_keys = [iidcol] if parts is not None else None
+
+    # 1) Read first chunk to infer schema
+    if parts is None:
         reader = pd.read_csv(
             path,
-            engine="python",
             compression="infer",
             sep=separator,
             chunksize=chunksize
         )
-        try:
-            first = next(reader)
-        except StopIteration:
-            print(f"  → {path} is empty, skipping")
-            continue
-
-        cols = first.columns.tolist()
-
-        # Default: object dtype for everything
-        dtype_map: Dict[str, object] = {col: object for col in cols}
-
-        # Override with user-specified dtypes
-        if dtypes:
-            for col, dt in dtypes.items():
-                if col in dtype_map:
-                    if dt.lower() in ("string", "object"):
-                        dtype_map[col] = object
-                    else:
-                        dtype_map[col] = dt
+    else:
+        # one whole part per chunk; parts hold consecutive IID ranges, so sorting each part sorts the file
+        reader = (pd.read_csv(part, sep=separator) for part in parts)
+    try:
+        first = next(reader)
+    except StopIteration:
+        print(f"  → {path} is empty, skipping")
+        return
 
-        # Cast first chunk consistently
-        first = first.astype(dtype_map, copy=False)
+    cols = first.columns.tolist()
 
-        # Force object columns explicitly to str
-        for c, dt in dtype_map.items():
-            if dt is object:
-                first[c] = first[c].astype(str)
+    # Default: object dtype for everything
+    dtype_map: Dict[str, object] = {col: object for col in cols}
 
-        # Fixed min_itemsize for object columns (safe for later chunks)
-        min_itemsize = {c: 256 for c, dt in dtype_map.items() if dt is object}
+    # Override with user-specified dtypes
+    if dtypes:
+        for col, dt in dtypes.items():
+            if col in dtype_map:
+                if dt.lower() in ("string", "object"):
+                    dtype_map[col] = object
+                else:
+                    dtype_map[col] = dt
+
+    # Cast first chunk consistently
+    first = first.astype(dtype_map, copy=False)
+
+    # Force object columns explicitly to str
+    for c, dt in dtype_map.items():
+        if dt is object:
+            first[c] = first[c].astype(str)
+    if sort_keys:
+        first = _sort_index_chunk(first, sort_keys)
+    written = len(first)
+
+    # Fixed min_itemsize for object columns (safe for later chunks)
+    min_itemsize = {c: 256 for c, dt in dtype_map.items() if dt is object}
+
+    # 2) Create HDF5 and write
+    with pd.HDFStore(h5_store, mode="w", complib=complib, complevel=complevel) as store:
+        store.append(
+            table_name,
+            first,
+            format="table",
+            data_columns=index_columns,
+            min_itemsize=min_itemsize
+        )
+        # Append remaining chunks
+        for chunk in reader:
+            chunk = chunk[cols].astype(dtype_map, copy=False)
+            for c, dt in dtype_map.items():
+                if dt is object:
+                    chunk[c] = chunk[c].astype(str)
+            if sort_keys:
+                chunk = _sort_index_chunk(chunk, sort_keys)
+                # keep a running row number as index, as the unsorted chunks have
+                chunk.index = pd.RangeIndex(written, written + len(chunk))
+            written += len(chunk)
+            _log_index_progress(path, written, started)
 
-        # 2) Create HDF5 and write
-        with pd.HDFStore(h5_store, mode="w", complib=complib, complevel=complevel) as store:
             store.append(
                 table_name,
-                first,
+                chunk,
                 format="table",
                 data_columns=index_columns,
                 min_itemsize=min_itemsize
             )
-            # Append remaining chunks
-            for chunk in reader:
-                chunk = chunk[cols].astype(dtype_map, copy=False)
-                for c, dt in dtype_map.items():
-                    if dt is object:
-                        chunk[c] = chunk[c].astype(str)
+        if sort_keys:
+            build_h5_zone_map(store, table_name, iidcol, diagcol, block_rows=zone_block_rows)
+        if diagcol:
+            n_codes = build_h5_code_index(store, table_name, diagcol)
+            logger.info(f"[index_diag_file] Code index of {h5_store}: {n_codes} distinct codes.")
+        setattr(store.get_storer(table_name).attrs, H5_INDEX_META_ATTR, {
+            **source_meta,
+            "separator": separator,
+            "index_columns": list(index_columns),
+            "dtype_map": {c: ("object" if dt is object else str(dt)) for c, dt in dtype_map.items()},
+            "sorted": bool(sort_keys),
+            "zone_block_rows": zone_block_rows,
+        })
+    if parts is not None:
+        shutil.rmtree(spill_dir, ignore_errors=True)
 
-                store.append(
-                    table_name,
-                    chunk,
-                    format="table",
-                    data_columns=index_columns,
-                    min_itemsize=min_itemsize
-                )
+    elapsed = time.perf_counter() - started
+    print(f"  → wrote indexed HDF5: {h5_store} ({written:,} rows in {elapsed:.1f}s, {written / max(elapsed, 1e-9):,.0f} rows/s)")
 
-        print(f"  → wrote indexed HDF5: {h5_store}")
-    print("All files indexed.")
+H5_SECONDARY_JOIN_SUFFIX = ".joined"
+SECONDARY_JOIN_BUCKET_BYTES = 1 << 30  # -f bytes per record-number bucket when materializing the --f2 join
 
-# --- Retrieval function with optimized filtering order ---  
-def select_by_iid_and_diag_optimized(
-    h5_path,
-    table_name,
-    iidcol,
-    iids,
-    diagcol,
-    diags,
-    *,
-    columns=None,
-    chunksize=200_000,
-    prefix_all=False,
-):
-    """
-    Reworked optimized reader that preserves the exact dtype / normalization
-    behaviour of select_by_iid_and_diag_old while keeping the early
-    diag-based chunk skipping optimisation.
+def h5_secondary_join_path(lpr2nd_file: str) -> str:
+    """Path of the .h5 holding the rows of an --f2 file joined to their -f records (see build_secondary_join_index)."""
+    return lpr2nd_file.rpartition('.')[0] + H5_SECONDARY_JOIN_SUFFIX + ".h5"
 
-    Behavioural invariants kept from the old implementation:
-    - supplied iids are coerced to the store's iid dtype (numeric vs string)
-    - chunk[iidcol] is normalized with normalize_iid_series(..., target='int')
-      (i.e. exactly like the old function) before membership checks
-    - diags==[] or iids==[] are treated as "no filter"
-    - need columns (iidcol, diagcol) are ensured in requested columns
+def h5_input_stores(lpr_file: str, lpr2nd_file: str = "") -> Tuple[List[str], List[str]]:
     """
-    def _norm_list(x):
-        if x is None:
-            return None
-        if isinstance(x, (pd.Series, pd.Index)):
-            vals = x.tolist()
-        elif isinstance(x, np.ndarray):
-            vals = x.tolist()
-        elif not hasattr(x, "__iter__") or isinstance(x, (str, bytes)):
-            vals = [x]
-        else:
-            vals = list(x)
+    The --BuildIndex stores a run reads instead of its -f and --f2 files: the .h5 of every -f file and,
+    pairing the files by position as --BuildIndex does, the join store (h5_secondary_join_path) of the
+    --f2 file given with it. Returns ([], []) unless every -f file has its .h5; the join stores are
+    returned only if every -f file has a --f2 file with one.
+    """
+    lpr_paths = [path.strip() for path in lpr_file.split(",") if path.strip()]
+    h5_files = [path.rpartition('.')[0] + ".h5" for path in lpr_paths]
+    if not h5_files or not all(os.path.exists(h5) for h5 in h5_files):
+        return [], []
+    lpr2nd_paths = [path.strip() for path in lpr2nd_file.split(",") if path.strip()] if lpr2nd_file else []
+    h5_2nd_files = [h5_secondary_join_path(path) for path in lpr2nd_paths]
+    if len(h5_2nd_files) != len(h5_files) or not all(os.path.exists(h5) for h5 in h5_2nd_files):
+        return h5_files, []
+    return h5_files, h5_2nd_files
+
+def _spill_by_recnum(path, separator, recnum_col, n_buckets, spill_dir, name, usecols=None, chunksize=2_000_000):
+    """Hash-partition the rows of a CSV on `recnum_col` into `n_buckets` CSVs (file order kept per bucket)."""
+    bucket_files = [os.path.join(spill_dir, f"{name}{b:04d}.csv") for b in range(n_buckets)]
+    for chunk in pd.read_csv(path, sep=separator, dtype=str, usecols=usecols, chunksize=chunksize):
+        bucket = pd.util.hash_pandas_object(chunk[recnum_col], index=False).to_numpy() % n_buckets
+        for b in np.unique(bucket):
+            chunk[bucket == b].to_csv(bucket_files[b], sep=separator, index=False,
+                                      header=not os.path.exists(bucket_files[b]), mode="a")
+    return bucket_files
+
+def build_secondary_join_index(
+    lpr_file: str,
+    lpr2nd_file: str,
+    separator: str,
+    iidcol: str,
+    diagnostic_col: str,
+    lpr_recnummer: str,
+    lpr2nd_recnummer: str,
+    diagnostic2nd_col: str,
+    n_buckets: Optional[int] = None,
+    chunksize: int = 2_000_000,
+    **options,
+) -> Optional[str]:
+    """
+    Materialize the record-number join of an --f2 file with its -f file, i.e. the secondary diagnosis rows
+    merge_secondary_diagnoses adds at run time, and index them like an -f file (IID and diagnosis columns,
+    IID clustered, zone map and code index) under h5_secondary_join_path(lpr2nd_file). Secondary diagnoses
+    can then be selected by IID and code without reading the --f2 file. Joined rows are selected by their
+    secondary code whether or not their -f record's own code was requested, as on the CSV path; without
+    the store, the h5 path only adds the secondary rows of -f records that were selected.
+
+    Both files are hash-partitioned on the record number into `n_buckets` buckets (default: one per
+    SECONDARY_JOIN_BUCKET_BYTES of the -f file), so only one bucket pair is joined in memory at a time.
+    `options` are passed on to _index_one_file. Returns the .h5 path, or None if no rows joined.
+    """
+    joined_h5 = h5_secondary_join_path(lpr2nd_file)
+    joined_csv = joined_h5[:-len(".h5")] + ".csv"
+    spill_dir = joined_h5 + ".buckets"
+    if n_buckets is None:
+        n_buckets = max(1, -(-os.path.getsize(lpr_file) // SECONDARY_JOIN_BUCKET_BYTES))
+    logger.info(f"[build_secondary_join_index] Joining {lpr2nd_file} to {lpr_file} on {lpr2nd_recnummer}/{lpr_recnummer} in {n_buckets} buckets")
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+    columns = None
+    try:
+        lpr_parts = _spill_by_recnum(lpr_file, separator, lpr_recnummer, n_buckets, spill_dir, "f", chunksize=chunksize)
+        lpr2nd_parts = _spill_by_recnum(lpr2nd_file, separator, lpr2nd_recnummer, n_buckets, spill_dir, "f2",
+                                        usecols=[lpr2nd_recnummer, diagnostic2nd_col], chunksize=chunksize)
+        for lpr_part, lpr2nd_part in zip(lpr_parts, lpr2nd_parts):
+            if not (os.path.exists(lpr_part) and os.path.exists(lpr2nd_part)):
+                continue
+            df1 = pd.read_csv(lpr_part, sep=separator, dtype=str)
+            merged = merge_secondary_diagnoses(df1, pd.read_csv(lpr2nd_part, sep=separator, dtype=str), diagnostic_col,
+                                               lpr_recnummer, lpr2nd_recnummer, diagnostic2nd_col)
+            joined = merged.iloc[len(df1):]
+            if joined.empty:
+                continue
+            columns = columns or joined.columns.tolist()
+            joined[columns].to_csv(joined_csv, sep=separator, index=False, header=not os.path.exists(joined_csv), mode="a")
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    if columns is None:
+        logger.info(f"[build_secondary_join_index] No rows of {lpr2nd_file} match a record of {lpr_file}.")
+        if os.path.exists(joined_h5):
+            os.remove(joined_h5)
+        return None
+    options.pop("update", None)  # the join is derived from two files; it is always rebuilt
+    try:
+        _index_one_file(joined_csv, [iidcol, diagnostic_col], separator=separator, chunksize=chunksize, **options)
+    finally:
+        os.remove(joined_csv)
+    return joined_h5
+
+def convert_to_parquet(
+    input_file: str,
+    separator: str,
+    cols_to_read_as_date: Iterable[str],
+    iidcol: Optional[str] = None,
+    row_group_size: int = 1_000_000
+) -> List[str]:
+    """
+    Write a typed Parquet copy (<name>.parquet, next to the source) of every CSV/STATA file in
+    `input_file` (comma-separated if multiple). The file is loaded with load_data_file, i.e. the same
+    type inference, date parsing and IID normalization as a normal run, so passing the .parquet file
+    later gives the same data without re-parsing the CSV. Existing Parquet files are overwritten.
+    Returns the written paths.
+    """
+    if pa is None:
+        logger.info("[convert_to_parquet] ERROR: --BuildParquet needs pyarrow (pip install pyarrow).")
+        print("[convert_to_parquet] ERROR: --BuildParquet needs pyarrow (pip install pyarrow).")
+        sys.exit(1)
+    written = []
+    for path in _split_input_paths(input_file):
+        if is_parquet_path(path):
+            logger.info(f"[convert_to_parquet] {path} is already a Parquet file, skipping")
+            continue
+        logger.info(f"[convert_to_parquet] Converting file: {path}")
+        df = load_data_file(data_file=path, sep=separator, birthdatecol="", diagnostic_col="", sexcol="",
+                            stam_cols_to_read_as_date=cols_to_read_as_date, iidcol=iidcol)
+        out_path = parquet_path_for(path)
+        try:
+            df.to_parquet(out_path, engine="pyarrow", index=False, row_group_size=row_group_size)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            # Mixed-type object columns cannot be typed by Arrow; store them as text
+            logger.info(f"[convert_to_parquet] Storing mixed-type columns of {path} as strings ({e})")
+            for c in df.select_dtypes(include=["object"]).columns:
+                df[c] = df[c].astype("string")
+            df.to_parquet(out_path, engine="pyarrow", index=False, row_group_size=row_group_size)
+        print(f"  → wrote Parquet: {out_path} ({len(df)} rows)")
+        written.append(out_path)
+        del df
+        gc.collect()
+    return written
+
+# ICD prefixes a stored code may carry in front of a requested code (see the diag normalizers below)
+H5_ICD_PREFIX_VARIANTS = [f"ICD{n}{sep}" for n in (8, 9, 10, 11) for sep in (":", "-", "")]
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """Smallest string greater than every string starting with `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _h5_code_forms(compiled_diags):
+    """Stored code prefixes that can satisfy the compiled codes (also behind ICD prefixes); None = match all."""
+    codes = sorted(compiled_diags["exact"]) + list(compiled_diags["prefixes"])
+    if any(c == "" for c in codes):
+        return None
+    forms = []
+    for code in codes:
+        forms.extend([code] if re.match(r"^ICD\d", code) else [code] + [p + code for p in H5_ICD_PREFIX_VARIANTS])
+    return forms
+
+def h5_candidate_coordinates(store, table_name, iidcol, iids_norm, diagcol, compiled_diags):
+    """
+    Row numbers of `table_name` that can match the requested codes/IIDs, found with range
+    queries on the indexed data columns instead of reading the table.
+
+    Every code (exact or prefix) becomes a range [code, next prefix) on `diagcol`, plus the same
+    range behind the common ICD prefixes when the code has none; without codes the IIDs give one
+    [min, max] range on `iidcol`. The result is a superset that the caller still filters in
+    memory. Returns None if nothing can be pushed down (no filters, a match-all prefix, or
+    non-indexed/non-string columns), in which case the table has to be streamed.
+    """
+    terms = []
+    if compiled_diags is not None:
+        forms = _h5_code_forms(compiled_diags)
+        if forms is None:
+            return None
+        terms.extend([f"{diagcol} >= {form!r}", f"{diagcol} < {_prefix_upper_bound(form)!r}"] for form in forms)
+    elif iids_norm:
+        lo, hi = min(iids_norm), max(iids_norm)
+        if isinstance(hi, str):
+            # stored IIDs are normalized (e.g. a trailing ".0" dropped) before matching
+            terms.append([f"{iidcol} >= {lo!r}", f"{iidcol} < {_prefix_upper_bound(hi)!r}"])
+        else:
+            terms.append([f"{iidcol} >= {lo!r}", f"{iidcol} <= {hi!r}"])
+    if not terms:
+        return None
+    try:
+        coords = [np.asarray(store.select_as_coordinates(table_name, where=t)) for t in terms]
+    except Exception as e:
+        logger.info(f"[h5_candidate_coordinates] No on-disk selection for {table_name} ({e}); streaming the table.")
+        return None
+    return np.unique(np.concatenate(coords)) if coords else np.array([], dtype=np.int64)
+
+def build_h5_zone_map(store, table_name, iidcol, diagcol=None, block_rows=H5_ZONE_BLOCK_ROWS, start_row=0):
+    """
+    Store a zone map for `table_name` under <table_name>_zonemap: per block of `block_rows` rows the
+    start/stop row and the min/max stored IID (and diagnosis) value. Only two columns are read.
+    With start_row, the blocks of the existing zone map up to that row are kept and only the rows
+    from start_row on are added.
+    """
+    nrows = store.get_storer(table_name).nrows
+    existing = h5_zone_map(store, table_name) if start_row else None
+    zones = []
+    for start in range(start_row, nrows, block_rows):
+        stop = min(start + block_rows, nrows)
+        zone = {"start": start, "stop": stop}
+        for name, col in (("iid", iidcol), ("diag", diagcol)):
+            if col is None:
+                continue
+            # missing values never match a request; a block of only missing values gets NaN bounds (always kept)
+            values = store.select_column(table_name, col, start=start, stop=stop).dropna()
+            zone[f"{name}_min"], zone[f"{name}_max"] = (values.min(), values.max()) if len(values) else (np.nan, np.nan)
+        zones.append(zone)
+    zone_map = pd.DataFrame(zones, columns=["start", "stop", "iid_min", "iid_max"] + (["diag_min", "diag_max"] if diagcol else []))
+    if existing is not None:
+        zone_map = pd.concat([existing[existing["stop"] <= start_row], zone_map], ignore_index=True)
+    store.put(f"{table_name}{H5_ZONE_MAP_SUFFIX}", zone_map, format="fixed")
+    return zone_map
+
+def build_h5_code_index(store, table_name, diagcol, block_rows=1_000_000, start_row=0):
+    """
+    Inverted index from stored diagnosis code to row numbers, written one block of rows at a time so
+    memory stays bounded by a block: <table_name>_codes holds the code vocabulary (a code's id is its
+    position), <table_name>_postings the row numbers of each block grouped by code, and
+    <table_name>_postings_dir one (code_id, start, stop, row_min, row_max) entry per code and block with
+    the offsets of its postings and the first/last row they hold; code_id is a data column, so the
+    entries of given codes can be selected with a where-query. With start_row, only the rows from
+    start_row on are indexed and appended; the existing postings are not read back.
+    """
+    vocab_key = f"{table_name}{H5_CODE_VOCAB_SUFFIX}"
+    postings_key = f"{table_name}{H5_POSTINGS_SUFFIX}"
+    dir_key = f"{table_name}{H5_POSTINGS_DIR_SUFFIX}"
+    nrows = store.get_storer(table_name).nrows
+    if start_row and f"/{dir_key}" in store.keys() and "row_min" in store.get_storer(dir_key).data_columns:
+        code_ids = {code: i for i, code in enumerate(store.get(vocab_key)["code"])}
+        offset = store.get_storer(postings_key).nrows if f"/{postings_key}" in store.keys() else 0
+    else:
+        # fresh build (or an index from before the current postings directory layout): start over
+        start_row, code_ids, offset = 0, {}, 0
+        for key in (postings_key, dir_key):
+            if f"/{key}" in store.keys():
+                store.remove(key)
+    for start in range(start_row, nrows, block_rows):
+        values = store.select_column(table_name, diagcol, start=start, stop=min(start + block_rows, nrows))
+        # rows without a code (read back as NaN) get no postings, rather than a "nan" code
+        present = np.flatnonzero(values.notna().to_numpy())
+        if not len(present):
+            continue
+        codes, uniques = pd.factorize(values.iloc[present].astype(str), sort=False)
+        order = present[np.argsort(codes, kind="stable")]
+        counts = np.bincount(codes, minlength=len(uniques))
+        stops = offset + np.cumsum(counts)
+        ids = np.array([code_ids.setdefault(code, len(code_ids)) for code in uniques], dtype=np.int64)
+        rows = (order + start).astype(np.int64)
+        store.append(postings_key, pd.DataFrame({"row": rows}), format="table")
+        # rows are ascending within a code, so its first and last posting bound the rows it covers
+        store.append(dir_key, pd.DataFrame({"code_id": ids, "start": stops - counts, "stop": stops,
+                                            "row_min": rows[stops - counts - offset], "row_max": rows[stops - 1 - offset]}),
+                     format="table", data_columns=["code_id", "row_min", "row_max"])
+        offset += len(order)
+    store.put(vocab_key, pd.DataFrame({"code": pd.Series(list(code_ids), dtype=object)}), format="fixed")
+    return len(code_ids)
+
+def _rows_hit_ranges(row_min, row_max, ranges):
+    """Per entry: does [row_min, row_max] overlap any of the sorted, disjoint [start, stop) `ranges`."""
+    range_starts = np.array([a for a, _ in ranges], dtype=np.int64)
+    range_stops = np.array([b for _, b in ranges], dtype=np.int64)
+    last = np.searchsorted(range_starts, row_max, side="right") - 1
+    return (last >= 0) & (range_stops[np.clip(last, 0, None)] > row_min)
+
+def h5_code_coordinates(store, table_name, compiled_diags, normalize=None, row_ranges=None):
+    """
+    Row numbers whose stored code matches `compiled_diags` (with the same `normalize` callables as
+    vocabulary_code_mask), read from the posting lists of build_h5_code_index; None without a code index.
+    Only the directory entries of the matching codes are read, and with `row_ranges` (sorted, disjoint
+    [start, stop) row ranges, e.g. the zone-map blocks of a batch's IIDs) only the postings of entries
+    covering rows in them; rows outside the ranges may still be returned.
+    """
+    vocab_key = f"/{table_name}{H5_CODE_VOCAB_SUFFIX}"
+    dir_key = f"/{table_name}{H5_POSTINGS_DIR_SUFFIX}"
+    keys = store.keys()
+    if vocab_key not in keys or dir_key not in keys:
+        return None
+    hit = vocabulary_code_mask(store.get(vocab_key)["code"], compiled_diags, normalize=normalize)
+    if not hit.any():
+        return np.array([], dtype=np.int64)
+    data_columns = store.get_storer(dir_key).data_columns
+    if "code_id" in data_columns:
+        code_ids = np.flatnonzero(hit).tolist()
+        directory = store.select(dir_key, where="code_id=code_ids")
+    else:
+        # directory written before code_id was a data column
+        directory = store.select(dir_key)
+        directory = directory[hit[directory["code_id"].to_numpy()]]
+    if row_ranges is not None and "row_min" in data_columns:
+        if not row_ranges:
+            return np.array([], dtype=np.int64)
+        directory = directory[_rows_hit_ranges(directory["row_min"].to_numpy(), directory["row_max"].to_numpy(), row_ranges)]
+    if directory.empty:
+        return np.array([], dtype=np.int64)
+    directory = directory.sort_values("start")
+    starts, stops = directory["start"].to_numpy(), directory["stop"].to_numpy()
+    # matching codes often sit next to each other within a block: read each run of adjacent slices once
+    new_run = np.concatenate(([True], starts[1:] != stops[:-1]))
+    run_starts, run_stops = starts[new_run], stops[np.append(np.flatnonzero(new_run)[1:] - 1, len(stops) - 1)]
+    parts = [store.select(f"{table_name}{H5_POSTINGS_SUFFIX}", start=int(a), stop=int(b))["row"].to_numpy()
+             for a, b in zip(run_starts, run_stops)]
+    return np.sort(np.concatenate(parts))
+
+def h5_zone_map(store, table_name):
+    """The zone map of `table_name` written by build_h5_zone_map, or None."""
+    key = f"/{table_name}{H5_ZONE_MAP_SUFFIX}"
+    return store.get(key) if key in store.keys() else None
+
+def _ranges_hit_zones(lows, highs, zone_min, zone_max, inclusive):
+    """Per zone: does any range [low, high) ([low, high] if inclusive) overlap [zone_min, zone_max]."""
+    order = np.argsort(np.asarray(lows, dtype=object), kind="stable")
+    lows = np.asarray(lows, dtype=object)[order]
+    highs_max = np.array(list(itertools.accumulate(np.asarray(highs, dtype=object)[order], max)), dtype=object)
+    hit = np.ones(len(zone_min), dtype=bool)
+    for i, (lo, hi) in enumerate(zip(zone_min, zone_max)):
+        if pd.isna(lo) or pd.isna(hi):
+            continue  # unknown bounds: keep the block
+        n = np.searchsorted(lows, hi, side="right")
+        hit[i] = n > 0 and (highs_max[n - 1] >= lo if inclusive else highs_max[n - 1] > lo)
+    return hit
+
+def zone_map_blocks(zones, iids_norm=None, compiled_diags=None):
+    """Blocks of a zone map that can hold rows of the requested IIDs and codes (see h5_candidate_coordinates)."""
+    keep = np.ones(len(zones), dtype=bool)
+    if iids_norm:
+        if all(isinstance(x, str) for x in iids_norm):
+            if zones["iid_min"].map(lambda v: isinstance(v, str) or pd.isna(v)).all():
+                keep &= _ranges_hit_zones(iids_norm, [_prefix_upper_bound(x) if x else x for x in iids_norm],
+                                          zones["iid_min"], zones["iid_max"], inclusive=False)
+        elif not zones["iid_min"].map(lambda v: isinstance(v, str)).any():
+            keep &= _ranges_hit_zones(iids_norm, iids_norm, zones["iid_min"], zones["iid_max"], inclusive=True)
+    if compiled_diags is not None and "diag_min" in zones.columns:
+        forms = _h5_code_forms(compiled_diags)
+        if forms is not None and zones["diag_min"].map(lambda v: isinstance(v, str) or pd.isna(v)).all():
+            keep &= _ranges_hit_zones(forms, [_prefix_upper_bound(f) for f in forms],
+                                      zones["diag_min"], zones["diag_max"], inclusive=False)
+    return keep
+
+# --- Retrieval function with optimized filtering order ---  
+def select_by_iid_and_diag_optimized(
+    h5_path,
+    table_name,
+    iidcol,
+    iids,
+    diagcol,
+    diags,
+    *,
+    columns=None,
+    chunksize=200_000,
+    prefix_all=False,
+):
+    """
+    Reworked optimized reader that preserves the exact dtype / normalization
+    behaviour of select_by_iid_and_diag_old while keeping the early
+    diag-based chunk skipping optimisation.
+
+    Behavioural invariants kept from the old implementation:
+    - supplied iids are coerced to the store's iid dtype (numeric vs string)
+    - chunk[iidcol] is normalized with normalize_iid_series(..., target='int')
+      (i.e. exactly like the old function) before membership checks
+    - diags==[] or iids==[] are treated as "no filter"
+    - need columns (iidcol, diagcol) are ensured in requested columns
+    """
+    def _norm_list(x):
+        if x is None:
+            return None
+        if isinstance(x, (pd.Series, pd.Index)):
+            vals = x.tolist()
+        elif isinstance(x, np.ndarray):
+            vals = x.tolist()
+        elif not hasattr(x, "__iter__") or isinstance(x, (str, bytes)):
+            vals = [x]
+        else:
+            vals = list(x)
         # drop Nones/NaNs and trim
         out = []
         for v in vals:
@@ -2805,15 +3705,14 @@ def select_by_iid_and_diag_optimized(
     if diags_list == []:
         diags_list = None
 
-    # Build diag exact/prefix sets (allow diags_list == None -> no diag filtering)
-    exact_set, prefixes = set(), []
+    # Compile diag exact/prefix patterns once (allow diags_list == None -> no diag filtering)
+    compiled_diags = None
     if diags_list is not None:
-        for d in map(str, diags_list):
-            d = d.strip()
-            if prefix_all or d.endswith("*"):
-                prefixes.append(d[:-1] if d.endswith("*") else d)
-            else:
-                exact_set.add(d)
+        compiled_diags = compile_code_patterns(map(str, diags_list), exact=not prefix_all)
+    diag_normalizers = [
+        lambda v: v.str.strip(),
+        lambda v: v.str.strip().str.replace(r"^(ICD\d{1,2}[-:]?)", "", regex=True),
+    ]
 
     # Ensure required columns are always requested from the store
     need = {iidcol, diagcol}
@@ -2844,6 +3743,7 @@ def select_by_iid_and_diag_optimized(
         logger.info(f"[select_by_iid_and_diag_optimized] Detected iid dtype: {iid_dtype}; sample dtypes: {sample_dtypes}")
 
         # Coerce supplied iids to same dtype as stored column (mirror old behavior)
+        iids_norm = None
         if iids_list is not None:
             if pd.api.types.is_integer_dtype(iid_dtype) or pd.api.types.is_float_dtype(iid_dtype):
                 iids_norm = pd.to_numeric(pd.Series(iids_list), errors="coerce").dropna().astype(iid_dtype).tolist()
@@ -2853,8 +3753,50 @@ def select_by_iid_and_diag_optimized(
         else:
             iids_set = None
 
-        # Stream chunks
-        for chunk in store.select(table_name, columns=cols, chunksize=chunksize):
+        # Skip zone-map blocks that cannot hold the requested IIDs/codes (rows past the zone map are kept)
+        zones = h5_zone_map(store, table_name)
+        block_ranges = None
+        if zones is not None and len(zones) and (iids_list is not None or compiled_diags is not None):
+            keep = zone_map_blocks(zones, iids_norm if iids_list is not None else None, compiled_diags)
+            starts, stops = zones["start"].to_numpy(), zones["stop"].to_numpy()
+            nrows = store.get_storer(table_name).nrows
+            logger.info(f"[select_by_iid_and_diag_optimized] Zone map keeps {int(keep.sum())}/{len(keep)} blocks of {h5_path}.")
+            block_ranges = []
+            for a, b, k in zip(starts, stops, keep):
+                if not k:
+                    continue
+                if block_ranges and block_ranges[-1][1] == a:
+                    block_ranges[-1] = (block_ranges[-1][0], b)
+                else:
+                    block_ranges.append((a, b))
+            if stops[-1] < nrows:
+                block_ranges.append((stops[-1], nrows))
+
+        # Read only the rows the indexed columns can match; stream everything if that is not possible.
+        # With a code index, the posting lists of the matching codes in the kept blocks give the rows directly.
+        coords = None
+        if compiled_diags is not None:
+            coords = h5_code_coordinates(store, table_name, compiled_diags, normalize=diag_normalizers, row_ranges=block_ranges)
+        coords_source = "code index posting lists"
+        if coords is None:
+            coords = h5_candidate_coordinates(store, table_name, iidcol, iids_norm if iids_list is not None else None, diagcol, compiled_diags)
+            coords_source = "indexed where-queries"
+        if coords is not None and block_ranges is not None:
+            range_starts = np.array([a for a, _ in block_ranges], dtype=np.int64)
+            range_stops = np.array([b for _, b in block_ranges], dtype=np.int64)
+            blk = np.searchsorted(range_starts, coords, side="right") - 1
+            coords = coords[(blk >= 0) & (coords < range_stops[np.clip(blk, 0, None)])]
+            block_ranges = None
+        if coords is None and block_ranges is None:
+            chunks = store.select(table_name, columns=cols, chunksize=chunksize)
+        elif coords is None:
+            chunks = (store.select(table_name, columns=cols, start=a, stop=min(a + chunksize, b))
+                      for start, b in block_ranges for a in range(int(start), int(b), chunksize))
+        else:
+            logger.info(f"[select_by_iid_and_diag_optimized] Reading {len(coords)} candidate rows of {h5_path} from {coords_source}.")
+            chunks = (store.select(table_name, where=coords[i:i + chunksize], columns=cols) for i in range(0, len(coords), chunksize))
+
+        for chunk in chunks:
             # Attempt to apply the same dtypes observed in the sample chunk to each read chunk.
             # This makes chunk column dtypes consistent with the indexed store and avoids
             # # spurious NaN/NaT created by later ad-hoc coercions.
@@ -2870,14 +3812,8 @@ def select_by_iid_and_diag_optimized(
             if diags_list is None:
                 diag_mask = pd.Series(True, index=chunk.index)
             else:
-                s = chunk[diagcol].astype("string").str.strip()
-                s_noprefix = s.str.replace(r"^(ICD\d{1,2}[-:]?)", "", regex=True)
-                dmask = pd.Series(False, index=chunk.index)
-                if exact_set:
-                    dmask |= s.isin(exact_set) | s_noprefix.isin(exact_set)
-                if prefixes:
-                    dmask |= s.str.startswith(tuple(prefixes), na=False) | s_noprefix.str.startswith(tuple(prefixes), na=False)
-                diag_mask = dmask
+                # match raw and ICD-prefix-stripped forms on the chunk's unique codes only
+                diag_mask = pd.Series(vocabulary_code_mask(chunk[diagcol], compiled_diags, normalize=diag_normalizers), index=chunk.index)
                 # s = chunk[diagcol].astype("string").str.strip()
                 # dmask = pd.Series(False, index=chunk.index)
                 # if exact_set:
@@ -3010,13 +3946,15 @@ def h5_load_df1(h5_file, iids, iidcol, flattened_pheno_requests, exact_match, Bu
             \tdiags={flattened_pheno_requests}
             \tdiagcol={diagnostic_col}
             \tdirectmapping={exact_match}""")
-    cases = get_h5_cases(
-        h5file = h5_file,
+    # one store per -f (or --f2 join) file, see h5_input_stores
+    cases = [get_h5_cases(
+        h5file = store,
         iids = iids,
         iidcol = iidcol,
         diags = flattened_pheno_requests,
         diagcol = diagnostic_col,
-        directmapping = exact_match)
+        directmapping = exact_match) for store in h5_file.split(",")]
+    cases = cases[0] if len(cases) == 1 else pd.concat(cases, ignore_index=True, sort=False)
     logger.info(f"[h5_load_df1] h5 based cases: {cases.head(5)}")
     df1 = finalize_lpr_data(df1=cases, diagnostic_col=diagnostic_col, birthdatecol=birthdatecol, ctype_col=ctype_col, verbose=verbose)
     if iidcol in df1.columns:
@@ -3162,6 +4100,22 @@ def load_mapping_rows(file_path, iidcol, target_iids, sep="\t", suffix_search=Fa
     return result
 
 
+def read_rows_with_keys(file_path, keycol, keys, sep="\t", chunksize=1_000_000, usecols=None):
+    """
+    Stream a CSV once and return the rows whose `keycol` value is one of `keys` (compared as str),
+    in file order and with all columns read as str. Each chunk is filtered with a vectorized isin
+    on the key column, so no per-line callback or line-number list is needed.
+    """
+    key_index = pd.Index(pd.unique(pd.Series(list(keys), dtype=object).astype(str)))
+    parts = []
+    for chunk in pd.read_csv(file_path, sep=sep, dtype=str, usecols=usecols, chunksize=chunksize):
+        hit = chunk[keycol].isin(key_index).to_numpy()
+        if hit.any():
+            parts.append(chunk[hit])
+    if not parts:
+        return pd.read_csv(file_path, sep=sep, dtype=str, usecols=usecols, nrows=0)
+    return pd.concat(parts, ignore_index=True)
+
 def build_temp_file(file_path, row_indices, temp_file="filtered_temp.csv", index_file=None, verbose=False):
     """
     Create a temp file with only the requested line numbers using awk.
@@ -3205,13 +4159,377 @@ def build_temp_file(file_path, row_indices, temp_file="filtered_temp.csv", index
         return ""
 
 
+# Byte-offset IID index (sidecar <file>.iidx.npz) for seeking to the rows of an IID batch in a CSV
+IID_INDEX_SUFFIX = ".iidx.npz"
+_IID_OFFSET_INDEXES = {}
+# (file, iidcol, sep) -> (size, mtime_ns) of files that could not be indexed, so no batch retries the scan
+_IID_INDEX_UNAVAILABLE = {}
+
+def _iter_line_spans(fh, start, block_size=1 << 26):
+    """Yield (starts, ends) byte arrays of the non-empty lines of an open binary file, from `start` on."""
+    fh.seek(start)
+    pos = start
+    line_start = start
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            if line_start < pos:
+                yield np.array([line_start], dtype=np.int64), np.array([pos], dtype=np.int64)
+            return
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10).astype(np.int64) + pos
+        pos += len(block)
+        if len(newlines) == 0:
+            continue
+        starts = np.concatenate(([line_start], newlines[:-1] + 1))
+        ends = newlines + 1
+        keep = (ends - starts) > 1  # pandas skips blank lines
+        yield starts[keep], ends[keep]
+        line_start = int(newlines[-1]) + 1
+
+def build_iid_offset_index(file_path, iidcol, sep=",", chunksize=2_000_000, save=True, verbose=False):
+    """
+    Scan a CSV once and record, per (normalized) IID, the byte ranges of its rows. Consecutive rows of
+    the same IID are stored as one range, so an IID-sorted file needs one range per IID.
+    The index is written next to the file as <file>.iidx.npz (if the directory is writable) together
+    with the file size/mtime it was built for. Returns None if rows and lines cannot be aligned
+    (e.g. quoted fields spanning several lines); callers then fall back to the full-scan path.
+    """
+    stat = os.stat(file_path)
+    with open(file_path, "rb") as fh:
+        header_end = len(fh.readline())
+        spans = _iter_line_spans(fh, header_end)
+        span_starts = np.empty(0, dtype=np.int64)
+        span_ends = np.empty(0, dtype=np.int64)
+        run_iids, run_starts, run_ends = [], [], []
+        n_rows = 0
+        for chunk in pd.read_csv(file_path, sep=sep, usecols=[iidcol], dtype=str, chunksize=chunksize):
+            n = len(chunk)
+            while len(span_starts) < n:
+                try:
+                    more_starts, more_ends = next(spans)
+                except StopIteration:
+                    logger.info(f"[build_iid_offset_index] {file_path}: more rows than lines; not indexing.")
+                    return None
+                span_starts = np.concatenate((span_starts, more_starts))
+                span_ends = np.concatenate((span_ends, more_ends))
+            starts, ends = span_starts[:n], span_ends[:n]
+            span_starts, span_ends = span_starts[n:], span_ends[n:]
+            keys = normalize_iid_series(chunk[iidcol], target="str").to_numpy(dtype=object, na_value=None)
+            # one range per run of identical IIDs
+            new_run = np.ones(n, dtype=bool)
+            if n > 1:
+                new_run[1:] = keys[1:] != keys[:-1]
+            run_pos = np.flatnonzero(new_run)
+            run_last = np.append(run_pos[1:], n) - 1
+            run_iids.append(keys[run_pos])
+            run_starts.append(starts[run_pos])
+            run_ends.append(ends[run_last])
+            n_rows += n
+        leftover = len(span_starts) + sum(len(s) for s, _ in spans)
+    if leftover:
+        logger.info(f"[build_iid_offset_index] {file_path}: {leftover} more lines than rows; not indexing.")
+        return None
+
+    iids = np.concatenate(run_iids) if run_iids else np.empty(0, dtype=object)
+    starts = np.concatenate(run_starts) if run_starts else np.empty(0, dtype=np.int64)
+    ends = np.concatenate(run_ends) if run_ends else np.empty(0, dtype=np.int64)
+    valid = np.array([k is not None for k in iids], dtype=bool)
+    iids, starts, ends = iids[valid].astype(str), starts[valid], ends[valid]
+    order = np.argsort(iids, kind="stable")  # stable: ranges of an IID stay in file order
+    iids, starts, ends = iids[order], starts[order], ends[order]
+    index = {
+        "iids": iids,
+        "starts": starts,
+        "ends": ends,
+        "header_end": header_end,
+        "file_size": stat.st_size,
+        "file_mtime_ns": stat.st_mtime_ns,
+        "iidcol": iidcol,
+        "sep": sep,
+    }
+    logger.info(f"[build_iid_offset_index] Indexed {n_rows} rows of {file_path} in {len(iids)} IID ranges")
+    if save:
+        # write to a temp file and rename, so concurrent readers never see a partly written sidecar
+        sidecar = file_path + IID_INDEX_SUFFIX
+        tmp = f"{sidecar}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                np.savez(fh, **index)
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            logger.info(f"[build_iid_offset_index] Could not write {sidecar} ({e}); keeping the index in memory only.")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return index
+
+def _iid_index_is_current(index, file_path, iidcol, sep):
+    stat = os.stat(file_path)
+    return (index is not None and int(index["file_size"]) == stat.st_size and int(index["file_mtime_ns"]) == stat.st_mtime_ns
+            and str(index["iidcol"]) == iidcol and str(index["sep"]) == sep)
+
+def get_iid_offset_index(file_path, iidcol, sep=",", verbose=False):
+    """Return the byte-offset IID index for a CSV: cached in memory, loaded from its sidecar, or built once."""
+    key = (os.path.abspath(file_path), iidcol, sep)
+    index = _IID_OFFSET_INDEXES.get(key)
+    if index is not None and _iid_index_is_current(index, file_path, iidcol, sep):
+        return index
+    stat = os.stat(file_path)
+    if _IID_INDEX_UNAVAILABLE.get(key) == (stat.st_size, stat.st_mtime_ns):
+        return None
+    index = None
+    sidecar = file_path + IID_INDEX_SUFFIX
+    if os.path.exists(sidecar):
+        try:
+            with np.load(sidecar, allow_pickle=False) as stored:
+                index = {k: stored[k] for k in stored.files}
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            logger.info(f"[get_iid_offset_index] Could not read {sidecar} ({e}); rebuilding.")
+            index = None
+        if index is not None and not _iid_index_is_current(index, file_path, iidcol, sep):
+            logger.info(f"[get_iid_offset_index] {sidecar} is outdated; rebuilding.")
+            index = None
+    if index is None:
+        try:
+            index = build_iid_offset_index(file_path, iidcol, sep=sep, verbose=verbose)
+        except ValueError as e:
+            logger.info(f"[get_iid_offset_index] Could not index {file_path} on {iidcol}: {e}")
+            index = None
+    if index is not None:
+        _IID_OFFSET_INDEXES[key] = index
+    else:
+        _IID_INDEX_UNAVAILABLE[key] = (stat.st_size, stat.st_mtime_ns)
+    return index
+
+def iid_offset_indexes_available(file_paths, iidcol, sep=",", verbose=False):
+    """True if every CSV of a comma-separated file list can be read through its byte-offset IID index."""
+    return all(get_iid_offset_index(path, iidcol, sep=sep, verbose=verbose) is not None for path in file_paths.split(","))
+
+def read_iid_rows(file_path, index, iids):
+    """
+    Return header + the rows of the given IIDs (in file order) as CSV bytes, by seeking to the
+    byte ranges stored in the index. Adjacent ranges are read in one go.
+    """
+    keys = index["iids"]
+    targets = np.unique(np.asarray(normalized_iid_list(iids), dtype=str))
+    lo = np.searchsorted(keys, targets, side="left")
+    hi = np.searchsorted(keys, targets, side="right")
+    positions = np.concatenate([np.arange(a, b, dtype=np.int64) for a, b in zip(lo, hi)] + [np.empty(0, dtype=np.int64)])
+    starts = index["starts"][positions]
+    ends = index["ends"][positions]
+    order = np.argsort(starts)
+    starts, ends = starts[order], ends[order]
+    parts = []
+    with open(file_path, "rb") as fh:
+        parts.append(fh.read(int(index["header_end"])))
+        i = 0
+        while i < len(starts):
+            j = i
+            while j + 1 < len(starts) and starts[j + 1] == ends[j]:
+                j += 1
+            fh.seek(int(starts[i]))
+            parts.append(fh.read(int(ends[j] - starts[i])))
+            i = j + 1
+    body = b"".join(parts)
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    return body
+
+def spill_lpr_by_iid_batch(lpr_file, iidcol, sep, iids_list, batch_size, spill_dir, block_size=1 << 26, verbose=False):
+    """
+    Stream each -f CSV once and split its rows by IID batch (the batches of prepare_iid_batches) into
+    part files <spill_dir>/batch<b>.f<i>.csv, copying the raw lines so that each part parses exactly like
+    the rows of the original file. Rows of IIDs outside iids_list are dropped.
+    Returns one entry per batch: the comma-joined part files of that batch (one per -f file, in -f order,
+    so --f2 files still pair up), or "" if the batch has no rows at all.
+    Raises ValueError if rows and lines cannot be aligned (e.g. quoted fields spanning several lines).
+    """
+    num_batches = int(np.ceil(len(iids_list) / batch_size)) if iids_list else 0
+    batch_of_iid = pd.Series(np.arange(len(iids_list), dtype=np.int64) // batch_size, index=pd.Index(iids_list, dtype=object))
+    batch_of_iid = batch_of_iid[~batch_of_iid.index.duplicated()]
+    os.makedirs(spill_dir, exist_ok=True)
+    file_paths = _split_input_paths(lpr_file)
+    rows_per_batch = np.zeros(num_batches, dtype=np.int64)
+    part_files = [[os.path.join(spill_dir, f"batch{b}.f{i}.csv") for i in range(len(file_paths))] for b in range(num_batches)]
+
+    for i, path in enumerate(file_paths):
+        logger.info(f"[spill_lpr_by_iid_batch] Splitting {path} into {num_batches} IID batches in {spill_dir}")
+        with open(path, "rb") as fh:
+            header = fh.readline()
+            if not header.endswith(b"\n"):
+                header += b"\n"
+            for b in range(num_batches):
+                with open(part_files[b][i], "wb") as out:
+                    out.write(header)
+            carry = b""
+            while True:
+                block = fh.read(block_size)
+                if not block and not carry:
+                    break
+                data = carry + block
+                if block:
+                    cut = data.rfind(b"\n") + 1
+                    if cut == 0:
+                        carry = data
+                        continue
+                    data, carry = data[:cut], data[cut:]
+                else:
+                    carry = b""
+                    if not data.endswith(b"\n"):
+                        data += b"\n"
+                newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+                starts = np.concatenate(([0], newlines[:-1] + 1))
+                ends = newlines + 1
+                keep = (ends - starts) > 1  # pandas skips blank lines
+                starts, ends = starts[keep], ends[keep]
+                iids = pd.read_csv(io.BytesIO(header + data), sep=sep, usecols=[iidcol], dtype=str)[iidcol]
+                if len(iids) != len(starts):
+                    raise ValueError(f"{path}: {len(iids)} rows but {len(starts)} lines in a block; cannot split by line")
+                batch_ids = normalize_iid_series(iids, target="str").map(batch_of_iid).fillna(-1).to_numpy(dtype=np.int64)
+                for b in np.unique(batch_ids[batch_ids >= 0]):
+                    rows = np.flatnonzero(batch_ids == b)
+                    # coalesce consecutive rows of the batch into one slice
+                    breaks = np.flatnonzero(np.diff(rows) != 1)
+                    run_first = rows[np.concatenate(([0], breaks + 1))]
+                    run_last = rows[np.append(breaks, len(rows) - 1)]
+                    with open(part_files[b][i], "ab") as out:
+                        for first, last in zip(run_first, run_last):
+                            out.write(data[starts[first]:ends[last]])
+                    rows_per_batch[b] += len(rows)
+    if verbose:
+        logger.info(f"[spill_lpr_by_iid_batch] Rows per batch: {rows_per_batch.tolist()}")
+    return [",".join(part_files[b]) if rows_per_batch[b] > 0 else "" for b in range(num_batches)]
+
+# Batch closure set up by main for the forked --lowmem batch workers (closures cannot be pickled)
+_LOWMEM_BATCH_JOB = None
+
+def measure_peak_rss(func, *args, poll_interval=0.05, **kwargs):
+    """Run func and return (result, peak RSS in bytes of this process while it ran), sampled with psutil."""
+    process = psutil.Process(os.getpid())
+    peak = [process.memory_info().rss]
+    stop = threading.Event()
+
+    def _poll():
+        while not stop.wait(poll_interval):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    poller = threading.Thread(target=_poll, daemon=True)
+    poller.start()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        stop.set()
+        poller.join()
+    peak[0] = max(peak[0], process.memory_info().rss)
+    return result, peak[0]
+
+def plan_batch_workers(requested, num_batches, per_batch_bytes, reserve_fraction=0.2):
+    """
+    Number of worker processes for the --lowmem IID batches and the memory cap per worker (bytes):
+    at most `requested` workers, one per batch and per CPU, and only as many as fit into the currently
+    available memory (psutil, minus `reserve_fraction`) at `per_batch_bytes` each.
+    """
+    budget = psutil.virtual_memory().available * (1 - reserve_fraction)
+    by_memory = int(budget // max(int(per_batch_bytes), 1))
+    workers = max(1, min(int(requested), int(num_batches), os.cpu_count() or 1, by_memory))
+    return workers, int(budget // workers)
+
+def batch_part_outfile(parts_dir, outfile, batch_num):
+    return os.path.join(parts_dir, f"batch{batch_num:06d}.{os.path.basename(outfile)}")
+
+def _limit_worker_memory(cap_bytes):
+    """Cap the address space a forked worker may add on top of what it inherited; overruns raise MemoryError."""
+    try:
+        import resource
+        inherited = psutil.Process(os.getpid()).memory_info().vms
+        resource.setrlimit(resource.RLIMIT_AS, (inherited + int(cap_bytes), resource.RLIM_INFINITY))
+    except (ImportError, ValueError, OSError) as e:
+        logger.info(f"[_limit_worker_memory] Could not set a memory cap for worker {os.getpid()}: {e}")
+
+def _run_lowmem_batch_job(batch_num, batch_outfile):
+    return _LOWMEM_BATCH_JOB(batch_num, batch_outfile, False)
+
+def merge_batch_part_outputs(part_outfiles, outfile):
+    """
+    Append per-batch part outputs (main TSV, .fgwa.pheno, .plink2.pheno) to the final outputs in batch
+    order, keeping only the first header, so the result equals a sequential run. As in the sequential
+    loop, the last batch that wrote a .pickle / sankey file provides the final one.
+    """
+    for suffix in ("", ".fgwa.pheno", ".plink2.pheno"):
+        target = outfile + suffix
+        for part in part_outfiles:
+            part_file = part + suffix
+            if not os.path.exists(part_file):
+                continue
+            has_header = os.path.exists(target) and os.path.getsize(target) > 0
+            with open(part_file, "rb") as src, open(target, "ab") as dst:
+                if has_header:
+                    src.readline()
+                shutil.copyfileobj(src, dst)
+            os.remove(part_file)
+    final_sankey = os.path.splitext(os.path.basename(outfile))[0] + ".sankey.tsv"
+    for part in part_outfiles:
+        if os.path.exists(part + ".pickle"):
+            os.replace(part + ".pickle", outfile + ".pickle")
+        part_sankey = os.path.splitext(os.path.basename(part))[0] + ".sankey.tsv"
+        if os.path.exists(part_sankey):
+            os.replace(part_sankey, final_sankey)
+
+def run_batches_in_process_pool(batch_job, batch_nums, outfile, requested_workers, per_batch_bytes):
+    """
+    Run --lowmem IID batches on a pool of forked worker processes. batch_job(batch_num, batch_outfile, append)
+    processes one batch and returns its IIDs. Each worker writes its own part files, which are appended to
+    `outfile` in batch order afterwards. Batches whose worker failed (e.g. MemoryError at its cap) are re-run
+    in this process. Falls back to running sequentially when only one worker fits or fork is unavailable.
+    Returns the set of processed IIDs.
+    """
+    global _LOWMEM_BATCH_JOB
+    batch_nums = list(batch_nums)
+    processed = set()
+    workers, cap_bytes = plan_batch_workers(requested_workers, len(batch_nums), per_batch_bytes)
+    if workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        logger.info(f"[run_batches_in_process_pool] Running {len(batch_nums)} batches sequentially")
+        for batch_num in batch_nums:
+            processed.update(batch_job(batch_num, outfile, True))
+        return processed
+
+    logger.info(f"[run_batches_in_process_pool] Running {len(batch_nums)} batches on {workers} processes "
+                f"(about {per_batch_bytes / 1024**3:.2f} GB per batch, cap {cap_bytes / 1024**3:.2f} GB per worker)")
+    if not verbose:
+        print(f"[run_batches_in_process_pool] Running {len(batch_nums)} batches on {workers} processes")
+    parts_dir = os.path.join(os.path.dirname(os.path.abspath(outfile)), f".{os.path.basename(outfile)}.parts_{uuid.uuid4().hex[:6]}")
+    os.makedirs(parts_dir, exist_ok=True)
+    part_outfiles = {batch_num: batch_part_outfile(parts_dir, outfile, batch_num) for batch_num in batch_nums}
+    _LOWMEM_BATCH_JOB = batch_job
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_limit_worker_memory, initargs=(cap_bytes,)) as pool:
+            futures = {pool.submit(_run_lowmem_batch_job, batch_num, part_outfiles[batch_num]): batch_num for batch_num in batch_nums}
+            for future in as_completed(futures):
+                batch_num = futures[future]
+                try:
+                    processed.update(future.result())
+                except Exception as e:
+                    logger.info(f"[run_batches_in_process_pool] Batch {batch_num + 1} failed in its worker ({type(e).__name__}: {e}); re-running it here.")
+                    failed.append(batch_num)
+        for batch_num in sorted(failed):
+            processed.update(batch_job(batch_num, part_outfiles[batch_num], False))
+        merge_batch_part_outputs([part_outfiles[batch_num] for batch_num in batch_nums], outfile)
+    finally:
+        _LOWMEM_BATCH_JOB = None
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return processed
+
 def batch_load_lprfile(df, lprfile, lpr_recnummer, lpr2nd_file, lpr2nd_recnummer,
                        iidcol, iid_batch, batch_num, sep,
                        potential_lpr_cols_to_read_as_date, lpr_cols_to_read_as_date,
-                       verbose, dta_input, DateFormat, diagnostic_col, diagnostic2nd_col, filter_on_diagcol=False, diags=""):
+                       verbose, dta_input, DateFormat, diagnostic_col, diagnostic2nd_col, filter_on_diagcol=False, diags="", usecols=None):
     """
-    Robust batch loader:
-     - determine df1_rows_to_keep via load_mapping_rows
+    Robust batch loader (usecols: -f columns to load, see lpr_columns_needed):
+     - Parquet -f files: push the IID (or diagnosis) filter down into the read
+     - CSV -f files filtered by IID: seek to the batch rows via the byte-offset IID index
+       (<file>.iidx.npz, built once on the first batch); no temp file, no rescan per batch
+     - otherwise (also when a file cannot be indexed) determine df1_rows_to_keep via load_mapping_rows
      - if df1_rows_to_keep is [] -> return empty DataFrame (no matches)
      - if df1_rows_to_keep is None -> skip filtering and use original file
      - otherwise create temp file and replace lprfile with it for processing
@@ -3219,7 +4537,28 @@ def batch_load_lprfile(df, lprfile, lpr_recnummer, lpr2nd_file, lpr2nd_recnummer
     if verbose:
         logger.info(f"[batch_load_lprfile] Processing batch {batch_num} for {len(iid_batch) if iid_batch is not None else 'all'} IIDs")
 
+    def _load(lpr_path, parquet_filters=None, iid_rows=None):
+        # Delegate to the main lpr parser/merger
+        return process_lpr_data(
+            lpr_file=lpr_path,
+            lpr2nd_file=lpr2nd_file,
+            dta_input=dta_input,
+            sep=sep,
+            lpr_cols_to_read_as_date=lpr_cols_to_read_as_date,
+            DateFormat=DateFormat,
+            potential_lpr_cols_to_read_as_date=potential_lpr_cols_to_read_as_date,
+            diagnostic_col=diagnostic_col,
+            diagnostic2nd_col=diagnostic2nd_col,
+            lpr_recnummer=lpr_recnummer,
+            lpr2nd_recnummer=lpr2nd_recnummer,
+            iidcol = iidcol,
+            parquet_filters=parquet_filters,
+            iid_rows=iid_rows,
+            usecols=usecols
+        )
+
     df1_rows_to_keep = None
+    has_iid_batch = iid_batch is not None and len(iid_batch) > 0
 
     advanced_detected = False
     try:
@@ -3230,6 +4569,30 @@ def batch_load_lprfile(df, lprfile, lpr_recnummer, lpr2nd_file, lpr2nd_recnummer
     except Exception:
         advanced_detected = False
 
+    # Parquet inputs: push the IID (or diagnosis) filter down into the read instead of building awk temp files
+    if all(is_parquet_path(p) for p in lprfile.split(",")):
+        parquet_filters = None
+        if filter_on_diagcol:
+            if not advanced_detected:
+                parquet_filters = {diagnostic_col: [diags] if isinstance(diags, str) else list(diags)}
+        elif has_iid_batch:
+            parquet_filters = {iidcol: [str(iid) for iid in iid_batch]}
+        df_new = _load(lprfile, parquet_filters=parquet_filters)
+        if verbose:
+            logger.info(f"[batch_load_lprfile] Loaded {len(df_new)} rows from Parquet for batch {batch_num}")
+        return df_new
+
+    # CSV inputs filtered by IID: read only the batch rows via the byte-offset IID index
+    if not filter_on_diagcol and has_iid_batch and not dta_input and iid_offset_indexes_available(lprfile, iidcol, sep=sep, verbose=verbose):
+        df_new = _load(lprfile, iid_rows=iid_batch)
+        if df_new is None or df_new.empty:
+            if verbose:
+                logger.info(f"[batch_load_lprfile] No rows to keep for batch {batch_num} -> returning empty DataFrame")
+            return pd.DataFrame()
+        if verbose:
+            logger.info(f"[batch_load_lprfile] Loaded {len(df_new)} rows for batch {batch_num}")
+        return df_new
+
     # decide which mapping to use
     if filter_on_diagcol:
         if advanced_detected:
@@ -3241,7 +4604,7 @@ def batch_load_lprfile(df, lprfile, lpr_recnummer, lpr2nd_file, lpr2nd_recnummer
             df1_rows_to_keep = load_mapping_rows(lprfile, diagnostic_col, diags, sep=sep, suffix_search=False, verbose=verbose)
     else:
         # filtering by iid for this batch
-        if iid_batch is None or len(iid_batch) == 0:
+        if not has_iid_batch:
             df1_rows_to_keep = None
         else:
             df1_rows_to_keep = load_mapping_rows(lprfile, iidcol, iid_batch, sep=sep, suffix_search=False, verbose=verbose)
@@ -3265,22 +4628,8 @@ def batch_load_lprfile(df, lprfile, lpr_recnummer, lpr2nd_file, lpr2nd_recnummer
     else:
         lprfile_to_use = lprfile
 
-    # Delegate to the main lpr parser/merger
     try:
-        df_new = process_lpr_data(
-            lpr_file=lprfile_to_use,
-            lpr2nd_file=lpr2nd_file,
-            dta_input=dta_input,
-            sep=sep,
-            lpr_cols_to_read_as_date=lpr_cols_to_read_as_date,
-            DateFormat=DateFormat,
-            potential_lpr_cols_to_read_as_date=potential_lpr_cols_to_read_as_date,
-            diagnostic_col=diagnostic_col,
-            diagnostic2nd_col=diagnostic2nd_col,
-            lpr_recnummer=lpr_recnummer,
-            lpr2nd_recnummer=lpr2nd_recnummer,
-            iidcol = iidcol
-        )
+        df_new = _load(lprfile_to_use)
     finally:
         # cleanup temp file if created
         if isinstance(df1_rows_to_keep, list) and lprfile_to_use != lprfile and os.path.exists(lprfile_to_use):
@@ -3476,6 +4825,11 @@ def build_temp_file_old(file_path, row_indices, temp_file="filtered_temp.csv", i
         os.remove(index_file)
 
 NON_ATC_EXTRA_COLUMNS = ["admissiontype", "pattype", "diagtype", "source", "register"]
+# Fixed -f column renames applied by finalize_lpr_data (applied together, so "source" -> "register" and "diag_source" -> "source" do not chain)
+LPR_COLUMN_RENAMES = {"c_pattype": "pattype", "c_indm": "admissiontype", "source": "register", "diag_source": "source"}
+# Raw -f names of NON_ATC_EXTRA_COLUMNS (renamed in finalize_lpr_data) and the -f columns merge_secondary_diagnoses reads
+LPR_RAW_EXTRA_COLUMNS = [raw for raw, name in LPR_COLUMN_RENAMES.items() if name in NON_ATC_EXTRA_COLUMNS]
+LPR_JOIN_COLUMNS = ["c_diagtype", "c_tildiag"]
 ATC_EXTRA_COLUMNS = ["apk", "packsize", "vnr"]
 STANDARD_PHENO_DETAIL_COLS = [
     "diagnoses",
@@ -3644,7 +4998,13 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                                  in_pheno_codes, pheno_requestcol, diagnostic_col, atc_diag_col, birthdatecol, atc_date_col, atc_cols_to_read_as_date, atc_file, sep, 
                                  BuildEntryExitDates, lifetime_exclusions_file, post_exclusions_file, oneYearPrior_exclusions_file, outfile, write_Plink2_format, 
                                  write_fastGWA_format, write_pickle, n_stam_iids, exclCHBcontrols, iidstatus_col, iidstatusdate, addition_information_file, sexcol, input_date_in_name, 
-                                 input_date_out_name, append, df4, icdprefix, noLeadingICD, lifetime_exclusions, oneYearPrior_exclusions, post_exclusions, covariates, lowMem, main_pheno_name, output_columns=None):
+                                 input_date_out_name, append, df4, icdprefix, noLeadingICD, lifetime_exclusions, oneYearPrior_exclusions, post_exclusions, covariates, lowMem, main_pheno_name, output_columns=None, atc_data=None):
+    """
+    Build the phenotypes, exclusions and covariates for the IIDs of df3 and write them to outfile.
+    atc_data is the ATC file as loaded once by main (load_data_file); only the rows of the current IIDs
+    are used. Without it, the ATC file is read here: for --lowmem CSV files only the batch rows, through
+    the byte-offset IID index, and for Parquet files with the IID filter pushed down.
+    """
     global extra_cols_to_keep
     df3_cols = []
     df4_cols = []
@@ -3854,12 +5214,21 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
     dbds_run = True if "CHB_DBDS" == cluster_run else False
 
     atc_diag_expect_prefix = None
+    # Compile all requested code sets once; every phenotype/exclusion/covariate below reuses the
+    # single factorized pass over df1 instead of re-scanning the diagnosis column.
+    pheno_code_matcher = build_code_matcher(df1, diagnostic_col, exact_match,
+                                            phenotype_code_sets(in_pheno_codes, lifetime_exclusions, oneYearPrior_exclusions, post_exclusions, covariates))
+    atc_code_matcher = None
 
     if (ATC_Requested == "All" or ATC_Requested == "Some"):
         if (atc_file != ""):
             if not cluster_run in DK_clusters:
                 print(f"[process_pheno_and_exclusions] WARNING: You are using ATC codes outside of our predefined and tested clusters. The stability is not yet tested.")
-            atc_df1 = load_data_file(data_file=atc_file, sep=sep, birthdatecol="", diagnostic_col=atc_diag_col, sexcol = "", stam_cols_to_read_as_date = atc_cols_to_read_as_date, iidcol=iidcol)
+            if atc_data is not None:
+                atc_df1 = atc_data[atc_data[iidcol].astype(str).isin(batch_iid_set)] if iidcol in atc_data.columns else atc_data.copy()
+            else:
+                atc_df1 = load_data_file(data_file=atc_file, sep=sep, birthdatecol="", diagnostic_col=atc_diag_col, sexcol = "", stam_cols_to_read_as_date = atc_cols_to_read_as_date, iidcol=iidcol,
+                                         parquet_filters={iidcol: batch_iid_set}, iid_rows=list(batch_iid_set) if lowMem and not dta_input else None)
             logger.info(f"[process_pheno_and_exclusions] after loading atc_df1 using load_data_file atc_df1.columns: {atc_df1.columns}\n \"birthdate\" in atc_df1.columns: {'birthdate' in atc_df1.columns}")
             if("birthdate" in atc_df1.columns):
                 atc_df1.rename(columns={"birthdate":atc_date_col},inplace=True)
@@ -3872,6 +5241,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                 atc_df1.rename(columns={"diagnosis":atc_diag_col},inplace=True)
                 logger.info(f"[process_pheno_and_exclusions] after renaming diagnosis column to {atc_diag_col} atc_df1.columns: {atc_df1.columns}")
             atc_df1 = enforce_iid_universe(atc_df1, iidcol, batch_iid_set, "atc_df1")
+            atc_df1 = categorize_code_columns(atc_df1, columns=[atc_diag_col] + CATEGORICAL_CODE_COLUMNS, verbose=verbose)
             logger.info(f"[process_pheno_and_exclusions] after finalize_lpr_data; atc_df1.columns: {atc_df1.columns}")
             logger.info(f"[process_pheno_and_exclusions] atc_df1.head(5): {atc_df1.head(5)}")
             if (qced_iids != ""):
@@ -3891,6 +5261,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                     logger.info(f"[process_pheno_and_exclusions] Detected ATC value format expects prefix: {atc_diag_expect_prefix}")
             except Exception as exc:
                 logger.info(f"[process_pheno_and_exclusions] Unable to determine ATC prefix format: {exc}")
+            atc_code_matcher = build_code_matcher(atc_df1, atc_diag_col, exact_match)
         else:
             logger.info("[process_pheno_and_exclusions] ERROR: You selected to use ATC codes but did not provide an ATC file. Skipping.")
             if not verbose:
@@ -3915,7 +5286,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                 iidcol=iidcol, input_date_in_name=atc_date_col, input_date_out_name=atc_date_col,
                 verbose=verbose, Covariates=True, Covar_Name=InclusionReason, skip_icd_update = skip_icd_update, 
                 remove_point_in_diag_request = remove_point_in_diag_request, 
-                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep
+                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep, code_matcher=atc_code_matcher
             )
             # del atc_df1
         elif ATC_Requested == "Some":
@@ -3948,7 +5319,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                     iidcol=iidcol, input_date_in_name=atc_date_col, input_date_out_name=atc_date_col,
                     verbose=verbose, Covariates=True, Covar_Name=InclusionReason, skip_icd_update = skip_icd_update, 
                     remove_point_in_diag_request = remove_point_in_diag_request, 
-                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep
+                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep, code_matcher=atc_code_matcher
                 )
                 logger.info(f"[process_pheno_and_exclusions] Identified to map only ATC codes for your phenotype {InclusionReason} and identified {str(len(filtered_df.index))} cases from atc_df1 for the following codes: {atc_values_to_match}; values_to_match {values_to_match} ")
             elif (non_atc_values_to_match and not atc_values_to_match) or atc_file == "":
@@ -3958,7 +5329,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                     iidcol=iidcol, input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name,
                     verbose=verbose, Covariates=True, Covar_Name=InclusionReason, skip_icd_update = skip_icd_update, 
                     remove_point_in_diag_request = remove_point_in_diag_request, 
-                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep
+                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep, code_matcher=pheno_code_matcher
                 )
                 logger.info(f"[process_pheno_and_exclusions] Identified to map only NON-ATC codes for your phenotype {InclusionReason} and identified {str(len(filtered_df.index))} cases from df1 for the following codes: {non_atc_values_to_match}; values_to_match {values_to_match} ")
             elif non_atc_values_to_match and atc_values_to_match and atc_file != "":
@@ -3968,7 +5339,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                     iidcol=iidcol, input_date_in_name=[input_date_in_name,atc_date_col], input_date_out_name=[input_date_out_name,atc_date_col],
                     verbose=verbose, Covariates=True, Covar_Name=InclusionReason, skip_icd_update = skip_icd_update, 
                     remove_point_in_diag_request = remove_point_in_diag_request, 
-                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep
+                    ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep, code_matcher=[pheno_code_matcher, atc_code_matcher]
                 )
                 logger.info(f"[process_pheno_and_exclusions] Identified to map NON-ATC and ATC codes for your phenotype {InclusionReason} and identified {str(len(filtered_df.index))} cases from [df1,atc_df1] for the following codes: {[non_atc_values_to_match,atc_values_to_match]}; values_to_match {values_to_match} ")
             else:
@@ -3980,7 +5351,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                 iidcol=iidcol, input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name,
                 verbose=verbose, Covariates=True, Covar_Name=InclusionReason, skip_icd_update = skip_icd_update, 
                 remove_point_in_diag_request = remove_point_in_diag_request, 
-                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep
+                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix, extra_cols_to_keep=extra_cols_to_keep, code_matcher=pheno_code_matcher
             )
             logger.info(f"[process_pheno_and_exclusions] Identified to map only NON-ATC codes and identified {str(len(filtered_df.index))} cases from df1 for the following codes: {values_to_match}")
         # Filter columns that actually exist in filtered_df
@@ -4196,7 +5567,8 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                                                     input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, diag_df=values_to_match, diag=ExclusionReason, 
                                                     exact_match=exact_match, verbose=verbose, get_earliest_date_from_data=True, dbds_run=dbds_run, extra_cols_to_keep=exclusion_extra_cols, 
                                                     skip_icd_update = skip_icd_update, remove_point_in_diag_request = remove_point_in_diag_request, ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
-                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix)
+                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix,
+                                                    code_matcher=pheno_code_matcher, atc_code_matcher=atc_code_matcher)
             casecontrol_df = enforce_iid_universe(casecontrol_df, iidcol, batch_iid_set, f"casecontrol_df after lifetime {ExclusionReason}", unique_iids=True)
             #logger.info(f"Description of {ExclusionReason}: {casecontrol_df[ExclusionReason].value_counts()}; {casecontrol_df[ExclusionReason].head(5)}")
     if (not oneYearPrior_exclusions.empty):
@@ -4209,7 +5581,8 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                                                     input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, diag_df=values_to_match, diag=ExclusionReason, 
                                                     exact_match=exact_match, verbose=verbose, get_earliest_date_from_data=True, dbds_run=dbds_run, extra_cols_to_keep=exclusion_extra_cols, 
                                                     skip_icd_update = skip_icd_update, remove_point_in_diag_request = remove_point_in_diag_request, ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
-                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix)
+                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix,
+                                                    code_matcher=pheno_code_matcher, atc_code_matcher=atc_code_matcher)
             casecontrol_df = enforce_iid_universe(casecontrol_df, iidcol, batch_iid_set, f"casecontrol_df after prior {ExclusionReason}", unique_iids=True)
             #logger.info(f"Description of {ExclusionReason}: {casecontrol_df[ExclusionReason].value_counts()}; {casecontrol_df[ExclusionReason].head(5)}")
     if (not post_exclusions.empty):
@@ -4222,7 +5595,8 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                                                     input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, diag_df=values_to_match, diag=ExclusionReason, 
                                                     exact_match=exact_match, verbose=verbose, get_earliest_date_from_data=True, dbds_run=dbds_run, extra_cols_to_keep=exclusion_extra_cols, 
                                                     skip_icd_update = skip_icd_update, remove_point_in_diag_request = remove_point_in_diag_request, ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
-                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix)
+                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix,
+                                                    code_matcher=pheno_code_matcher, atc_code_matcher=atc_code_matcher)
             casecontrol_df = enforce_iid_universe(casecontrol_df, iidcol, batch_iid_set, f"casecontrol_df after post {ExclusionReason}", unique_iids=True)
             #logger.info(f"Description of {ExclusionReason}: {casecontrol_df[ExclusionReason].value_counts()}; {casecontrol_df[ExclusionReason].head(5)}")
     if (not covariates.empty):
@@ -4235,7 +5609,8 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
                                                     input_date_in_name=input_date_in_name, input_date_out_name=input_date_out_name, diag_df=values_to_match, diag=ExclusionReason, 
                                                     exact_match=exact_match, verbose=verbose, get_earliest_date_from_data=True, dbds_run=dbds_run, extra_cols_to_keep=exclusion_extra_cols, 
                                                     skip_icd_update = skip_icd_update, remove_point_in_diag_request = remove_point_in_diag_request, ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
-                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix)
+                                                    atc_df1=locals().get("atc_df1"), atc_diag_col=atc_diag_col, atc_date_col=atc_date_col, atc_file=atc_file, atc_expect_prefix=atc_diag_expect_prefix,
+                                                    code_matcher=pheno_code_matcher, atc_code_matcher=atc_code_matcher)
             casecontrol_df = enforce_iid_universe(casecontrol_df, iidcol, batch_iid_set, f"casecontrol_df after covariate {ExclusionReason}", unique_iids=True)
             #logger.info(f"Description of {ExclusionReason}: {casecontrol_df[ExclusionReason].value_counts()}; {casecontrol_df[ExclusionReason].head(5)}")
     batch_iid_df = df3[[iidcol]].drop_duplicates().copy()
@@ -4721,7 +6096,7 @@ def process_pheno_and_exclusions(MatchFI, df3, df1, iidcol, verbose, ctype_excl,
     if missing:
         final_df = pd.concat([final_df, pd.DataFrame(missing, index=final_df.index)], axis=1)
     final_df = final_df.reindex(columns=col_order)
-    final_df = sanitize_tsv_cells(final_df)
+    final_df = sanitize_tsv_cells(format_day_list_columns(final_df))
     if len(final_df.columns) != len(col_order):
         raise ValueError(f"[process_pheno_and_exclusions] Output schema mismatch before writing: dataframe has {len(final_df.columns)} columns, schema has {len(col_order)} columns.")
     logger.info(f"[process_pheno_and_exclusions] Writing {len(final_df.index)} rows with {len(final_df.columns)} columns to {outfile}.")
@@ -4795,6 +6170,8 @@ def build_ExDEP_exclusions(
     atc_date_col: str = "",
     atc_file: str = "",
     atc_expect_prefix: Optional[bool] = None,
+    code_matcher: Optional[dict] = None,
+    atc_code_matcher: Optional[dict] = None,
 ) -> pd.DataFrame:
     """
     Build exclusions for a given disorder `diag` and merge into `casecontrol_df`.
@@ -4818,6 +6195,10 @@ def build_ExDEP_exclusions(
         return df.loc[:, cols]
 
     def _run_build(df_obj, values, diag_column, in_name, out_name):
+        if isinstance(df_obj, list):
+            matcher = [code_matcher, atc_code_matcher]
+        else:
+            matcher = atc_code_matcher if df_obj is atc_df1 else code_matcher
         return build_phenotype_cases(
             df1=df_obj,
             exact_match=exact_match,
@@ -4836,6 +6217,7 @@ def build_ExDEP_exclusions(
             noLeadingICD=noLeadingICD,
             icdprefix=icdprefix,
             extra_cols_to_keep=extra_cols_to_keep,
+            code_matcher=matcher,
         )
 
     diag_values = [str(v) for v in diag_df if str(v)]
@@ -5063,10 +6445,191 @@ def merge_IIDs(
 
     tmp_result_df = _normalize_dates(tmp_result_df)
 
+    # --- Step 3: One pass over the rows sorted by IID (first-appearance order)
+    # Dates are parsed once here; first/last/unique days are reduced on int32 day numbers, and the
+    # in/out date lists stay day numbers until the output is written (format_day_list_columns).
+    for col in ("date_in", "date_out"):
+        tmp_result_df[col] = convert_dates_once(tmp_result_df[col])
+    in_days = dates_to_day_numbers(tmp_result_df["date_in"])
+    out_days = dates_to_day_numbers(tmp_result_df["date_out"])
+
+    codes, _ = pd.factorize(tmp_result_df[iidcol])
+    has_iid = codes >= 0
+    n_groups = int(codes.max()) + 1 if has_iid.any() else 0
+    order = np.flatnonzero(has_iid)[np.argsort(codes[has_iid], kind="stable")]
+    counts = np.bincount(codes[has_iid], minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+
+    def _segment_lists(col):
+        values = tmp_result_df[col].astype(object).to_numpy()[order]
+        return [part.tolist() for part in np.split(values, starts[1:])] if n_groups else []
+
+    def _segment_days(col, days):
+        # int32 day numbers per IID, all views into one buffer; Timestamp lists where a time of day
+        # (or time zone) would otherwise be lost
+        if dates_have_time_of_day(tmp_result_df[col]):
+            return _segment_lists(col)
+        return split_day_lists(days[order], counts) if n_groups else []
+
+    def _segment_reduce(ufunc, days):
+        return ufunc.reduceat(days[order], starts) if n_groups else days[:0]
+
+    # missing in-dates sort last so they never win the minimum
+    first_day = _segment_reduce(np.minimum, np.where(in_days == DAY_NUMBER_NA, np.iinfo(np.int32).max, in_days))
+    first_day[first_day == np.iinfo(np.int32).max] = DAY_NUMBER_NA
+    summaries = {
+        "first_dx": day_numbers_to_dates(first_day).to_numpy(),
+        "last_dx": day_numbers_to_dates(_segment_reduce(np.maximum, out_days)).to_numpy(),
+    }
+    if Cases or Covariates:
+        summaries["diagnoses"] = _segment_lists(diagnostic_col)
+    summaries["in_dates"] = _segment_days("date_in", in_days)
+    summaries["out_dates"] = _segment_days("date_out", out_days)
+    # extra_cols_to_keep could be for the Danish clusters ["admissiontype", "pattype", "diagtype", "source", "register",'apk','packsize','vnr']
+    for col in extra_cols_to_keep:
+        if col in tmp_result_df.columns:
+            summaries[col] = _segment_lists(col)
+    if Cases:
+        valid_in = has_iid & (in_days != DAY_NUMBER_NA)
+        summaries["n_diags"] = np.bincount(codes[valid_in], minlength=n_groups)
+        unique_days = pd.DataFrame({"g": codes[valid_in], "d": in_days[valid_in]}).drop_duplicates()
+        summaries["n_unique_in_days"] = np.bincount(unique_days["g"].to_numpy(), minlength=n_groups)
+    id_dx_date_df = pd.DataFrame(summaries)
+    logger.info(f"[merge_IIDs] id_dx_date_df.head(5): {id_dx_date_df.head(5)}/n id_dx_date_df.columns: {id_dx_date_df.columns}")
+
+    # --- Step 4: Add Case/Control flag; one row per IID in order of first appearance
+    first_rows = tmp_result_df[[iidcol]].drop_duplicates()
+    dx_result_df = first_rows.reset_index(drop=True)
+    dx_result_df["diagnosis"] = "Case" if Cases else "Control"
+    # rows without an IID get no summaries (reindex of -1 yields NaN)
+    group_of = codes[~tmp_result_df[iidcol].duplicated(keep="first").to_numpy()]
+    dx_result_df = pd.concat([dx_result_df, id_dx_date_df.reindex(group_of).reset_index(drop=True)], axis=1)
+
+    if verbose:
+        logger.info(f"[merge_IIDs] Output shape={dx_result_df.shape}, dup IIDs? {dx_result_df[iidcol].duplicated().any()}")
+
+    # --- Step 5: Optionally merge entry/exit
+    if BuildEntryExitDates:
+        logger.info("[merge_IIDs] WARNING: BuildEntryExitDates not fully implemented here")
+        # dx_result_df = dx_result_df.merge(Entry_Exit_date_df, on=iidcol)
+
+    return dx_result_df
+
+def merge_IIDs_old(
+    tmp_result_df: pd.DataFrame,
+    diagnostic_col: str,
+    birthdatecol: str,
+    input_date_in_name: str,
+    input_date_out_name: str,
+    iidcol: str,
+    verbose: bool,
+    Cases: bool,
+    Covariates: bool = False,
+    BuildEntryExitDates: bool = False,
+    extra_cols_to_keep: list = [],
+) -> pd.DataFrame:
+    """
+    Reference version of merge_IIDs (separate groupby results joined on the IID).
+    Merge diagnoses for each IID, computing first/last diagnosis dates,
+    lists of codes and dates, and counts.
+
+    Returns a DataFrame with one row per IID.
+    """
+
+    if verbose:
+        logger.info(
+            f"[merge_IIDs] Cases={Cases}, Covariates={Covariates}, "
+            f"in={input_date_in_name}, out={input_date_out_name}, "
+            f"BuildEntryExitDates={BuildEntryExitDates}"
+        )
+
+    if tmp_result_df.empty:
+        if verbose:
+            logger.info("[merge_IIDs] Input empty → returning empty DataFrame")
+        return tmp_result_df
+
+    # --- Step 1: Pre-select relevant columns
+    cols = [iidcol, diagnostic_col, input_date_in_name, input_date_out_name]
+    if birthdatecol in tmp_result_df.columns:
+        cols.append(birthdatecol)
+    # if "pattype" in tmp_result_df.columns:
+    #     cols.append("pattype")
+    # if "admissiontype" in tmp_result_df.columns:
+    #     cols.append("admissiontype")
+    # if "diagtype" in tmp_result_df.columns:
+    #     cols.append("diagtype")
+    # if "source" in tmp_result_df.columns:
+    #     cols.append("source")
+    # if "register" in tmp_result_df.columns:
+    #     cols.append("register")
+    # extra_cols_to_keep could be for the Danish clusters ["admissiontype", "pattype", "diagtype", "source", "register",'apk','packsize','vnr']
+    if extra_cols_to_keep:
+        for col in extra_cols_to_keep:
+            if col in tmp_result_df.columns:
+                cols.append(col)
+    logger.info(f"[merge_IIDs] cols to keep:{cols}")
+    cols =  list(set(cols)) 
+    cols = [c for c in cols if c in tmp_result_df.columns]
+    tmp_result_df = tmp_result_df[cols].copy()
+
+    # --- Step 2: Normalize date_in/date_out column names
+    def _normalize_dates(df: pd.DataFrame) -> pd.DataFrame:
+        # Clean up suffixes from merges
+        if "date_in_y" in df.columns:
+            logger.info("[merge_IIDs] WARNING: dropping date_in_y")
+            df = df.drop(columns=["date_in_y"])
+        if "date_in_x" in df.columns:
+            if "date_in" not in df.columns:
+                logger.info("[merge_IIDs] WARNING: renaming date_in_x→date_in")
+                df["date_in"] = df["date_in_x"]
+            df = df.drop(columns=["date_in_x"])
+        # Ensure we have date_in
+        if input_date_in_name != "date_in" and "date_in" not in df.columns:
+            if verbose:
+                logger.info(f"[merge_IIDs] Renaming {input_date_in_name}→date_in")
+            df["date_in"] = df[input_date_in_name]
+            df = df.drop(columns=[input_date_in_name])
+        # Ensure we have date_out
+        if (
+            input_date_out_name != input_date_in_name
+            and input_date_out_name != "date_out"
+            and "date_out" not in df.columns
+        ):
+            if verbose:
+                logger.info(f"[merge_IIDs] Renaming {input_date_out_name}→date_out")
+            df["date_out"] = df[input_date_out_name]
+            df = df.drop(columns=[input_date_out_name])
+        elif "date_out" not in df.columns:
+            if verbose:
+                logger.info("[merge_IIDs] No date_out → duplicating date_in")
+            df["date_out"] = df["date_in"]
+        return df
+
+    tmp_result_df = _normalize_dates(tmp_result_df)
+
     # --- Step 3: Group by IID and compute aggregations
+    # Dates are parsed once here; first/last/unique days are reduced on int32 day numbers.
+    for col in ("date_in", "date_out"):
+        tmp_result_df[col] = convert_dates_once(tmp_result_df[col])
+    in_days = dates_to_day_numbers(tmp_result_df["date_in"])
+    out_days = dates_to_day_numbers(tmp_result_df["date_out"])
+    days_df = pd.DataFrame({
+        iidcol: tmp_result_df[iidcol].reset_index(drop=True),
+        # missing in-dates sort last so they never win the minimum
+        "in_day": np.where(in_days == DAY_NUMBER_NA, np.iinfo(np.int32).max, in_days),
+        "out_day": out_days,
+    })
+    day_groups = days_df.groupby(iidcol)
+    first_day = day_groups["in_day"].min()
+    last_day = day_groups["out_day"].max()
+    first_dates = first_day.rename("first_dx").reset_index()
+    first_dates["first_dx"] = day_numbers_to_dates(
+        np.where(first_day.to_numpy() == np.iinfo(np.int32).max, DAY_NUMBER_NA, first_day.to_numpy())
+    ).to_numpy()
+    last_dates = last_day.rename("last_dx").reset_index()
+    last_dates["last_dx"] = day_numbers_to_dates(last_day.to_numpy()).to_numpy()
+
     grouped = tmp_result_df.groupby(iidcol, group_keys=False)
-    first_dates = grouped["date_in"].min().rename("first_dx").reset_index()
-    last_dates = grouped["date_out"].max().rename("last_dx").reset_index()
 
     merges = [first_dates, last_dates]
 
@@ -5099,7 +6662,9 @@ def merge_IIDs(
     
     if Cases:
         n_diags = grouped["date_in"].count().rename("n_diags").reset_index()
-        n_unique = grouped["date_in"].nunique().rename("n_unique_in_days").reset_index()
+        valid_in = days_df[in_days != DAY_NUMBER_NA]
+        n_unique = (valid_in.groupby(iidcol)["in_day"].nunique()
+                    .reindex(first_day.index, fill_value=0).rename("n_unique_in_days").reset_index())
         merges.extend([n_diags, n_unique])
 
     # --- Step 4: Merge all summaries
@@ -5367,7 +6932,8 @@ def detect_advanced_cases(df, rule_dict, input_date_in_name, exact_match, diagco
         logger.warning('[detect_advanced_cases] Could not identify a column with diagnosis types (expected \"type\" or \"diagtype\"). Falling back to treating all rows as main diagnoses.')
         type_series = pd.Series(['A'] * len(df), index=df.index)
     else:
-        type_series = df[type_col].fillna('')
+        # missing types never match the isin() below; no fillna so categorical types work as well
+        type_series = df[type_col]
     main_df = df[type_series.isin(['A', 'G', 'C'])]
     sub_df = df[type_series.isin(['+', 'B'])]
     all_df = df.copy()
@@ -5433,7 +6999,7 @@ def detect_advanced_cases(df, rule_dict, input_date_in_name, exact_match, diagco
 
 def advanced_map_cases(values_to_match, df1, exact_match, diagnostic_col, input_date_in_name, 
                       iidcol, skip_icd_update=False, remove_point_in_diag_request=False, 
-                      ICDCM=False, noLeadingICD=False, icdprefix=False):
+                      ICDCM=False, noLeadingICD=False, icdprefix=False, code_matcher=None):
     """Handle both advanced rules and wildcard patterns."""
     
     # Check if this is an advanced rule or wildcard pattern
@@ -5461,7 +7027,7 @@ def advanced_map_cases(values_to_match, df1, exact_match, diagnostic_col, input_
         if rule_dict.get('ranges'):
             tmp_result_df = map_cases(values_to_match=rule_dict['ranges'], 
                                     exact_match=exact_match, df1=df1, 
-                                    diagcol=diagnostic_col)
+                                    diagcol=diagnostic_col, code_matcher=code_matcher)
         else:
             # Full advanced rule processing
             tmp_result_df = detect_advanced_cases(df=df1, rule_dict=rule_dict, 
@@ -5473,7 +7039,7 @@ def advanced_map_cases(values_to_match, df1, exact_match, diagnostic_col, input_
         # Standard matching
         tmp_result_df = map_cases(values_to_match=values_to_match, 
                                 exact_match=exact_match, df1=df1, 
-                                diagcol=diagnostic_col)
+                                diagcol=diagnostic_col, code_matcher=code_matcher)
     
     return tmp_result_df
 
@@ -5499,30 +7065,111 @@ def advanced_map_cases_old(values_to_match, df1, exact_match, diagnostic_col, in
                                 diagcol=diagnostic_col)
     return(tmp_result_df)
 
-def map_cases(values_to_match, exact_match, df1, diagcol, cols=None):
-        exact_set, prefixes = set(), []
+def _code_set_key(values_to_match):
+    """Hashable key for a requested code set (order and surrounding whitespace do not matter)."""
+    if values_to_match is None:
+        return None
+    return frozenset(str(v).strip() for v in values_to_match)
+
+def _vocabulary_hits(vocab, values_to_match, exact_match):
+    """Evaluate map_cases semantics on the unique (already stripped) diagnosis vocabulary."""
+    return match_compiled_codes(vocab, compile_code_patterns(map(str, values_to_match), exact=exact_match))
+
+def build_code_matcher(df1, diagcol, exact_match, code_sets=None):
+    """
+    Compile requested code sets against df1[diagcol] with a single pass over the rows.
+
+    The diagnosis column is factorized once into integer codes plus a (small) vocabulary of
+    unique values. Every code set (inclusions, exclusions, covariates) is then resolved on the
+    vocabulary only, and the per-row membership mask of a phenotype is a plain integer gather.
+    Code sets not known up front are compiled lazily on first use by code_matcher_mask.
+
+    Parameters
+    ----------
+    df1 : pd.DataFrame
+        Diagnosis data the masks refer to (positional, same row order).
+    diagcol : str
+        Diagnosis column in df1.
+    exact_match : bool
+        Same meaning as in map_cases (--eM).
+    code_sets : dict, optional
+        Mapping of phenotype name -> iterable of codes to compile up front.
+
+    Returns
+    -------
+    dict or None
+        The compiled matcher, or None if df1 does not hold diagcol.
+    """
+    if df1 is None or diagcol not in getattr(df1, "columns", []):
+        return None
+    codes, uniques = pd.factorize(df1[diagcol], sort=False)
+    vocab = pd.Series(uniques, dtype="object").astype("string").str.strip()
+    matcher = {
+        "index": df1.index,
+        "n_rows": len(df1),
+        "diagcol": diagcol,
+        "exact_match": exact_match,
+        "codes": codes,
+        "vocab": vocab,
+        "compiled": {},
+        "names": {},
+    }
+    for name, values in (code_sets or {}).items():
+        key = _code_set_key(values)
+        if key is None or key in matcher["compiled"]:
+            matcher["names"][name] = key
+            continue
+        matcher["compiled"][key] = _vocabulary_hits(vocab, key, exact_match)
+        matcher["names"][name] = key
+    logger.info(f"[build_code_matcher] Compiled {len(matcher['compiled'])} code sets for {len(matcher['names'])} phenotypes over {len(vocab)} unique codes in {len(df1)} rows of {diagcol}.")
+    return matcher
+
+def code_matcher_applies(matcher, df1, diagcol):
+    """True if `matcher` was compiled for exactly these rows of df1[diagcol]."""
+    if matcher is None or df1 is None or matcher["diagcol"] != diagcol or diagcol not in df1.columns:
+        return False
+    if len(df1) != matcher["n_rows"]:
+        return False
+    return df1.index is matcher["index"] or df1.index.equals(matcher["index"])
+
+def code_matcher_mask(matcher, values_to_match):
+    """Row-level boolean membership mask (numpy) for a code set, compiling it on first use."""
+    key = _code_set_key(values_to_match)
+    hits = matcher["compiled"].get(key)
+    if hits is None:
+        hits = _vocabulary_hits(matcher["vocab"], key, matcher["exact_match"])
+        matcher["compiled"][key] = hits
+    # factorize marks missing values with -1; append a False slot so they never match
+    return np.append(hits, False)[matcher["codes"]]
+
+def phenotype_code_sets(*tables):
+    """Collect {name: codes} from phenotype tables ('Disorder'/'Disorder Codes'), plus their non-ATC parts."""
+    code_sets = {}
+    for table in tables:
+        if table is None or not isinstance(table, pd.DataFrame) or table.empty or "Disorder Codes" not in table.columns:
+            continue
+        for disorder, codes in zip(table["Disorder"], table["Disorder Codes"]):
+            if isinstance(codes, str) or not hasattr(codes, "__iter__"):
+                continue
+            values = [str(v) for v in codes if str(v)]
+            code_sets[str(disorder)] = values
+            non_atc_values = [v for v in values if not v.startswith('ATC')]
+            if non_atc_values and len(non_atc_values) != len(values):
+                code_sets[f"{disorder}_nonATC"] = non_atc_values
+    return code_sets
+
+def map_cases(values_to_match, exact_match, df1, diagcol, cols=None, code_matcher=None):
         out = pd.DataFrame()
         try:
             if values_to_match is not None and not df1.empty:
-                for d in map(str, values_to_match):
-                    d = d.strip()
-                    if not exact_match or d.endswith("*"):
-                        prefixes.append(d[:-1] if d.endswith("*") else d)
-                    else:
-                        exact_set.add(d)
-
-                # DIAG mask
-                s = df1[diagcol].astype("string").str.strip()
-
-                if values_to_match is None:
-                    diag_mask = pd.Series(True, index=df1.index)
-                else:
-                    dmask = pd.Series(False, index=df1.index)
-                    if exact_set:
-                        dmask |= s.isin(exact_set)
-                    if prefixes:
-                        dmask |= s.str.startswith(tuple(prefixes), na=False)
-                    diag_mask = dmask
+                if code_matcher_applies(code_matcher, df1, diagcol) and code_matcher["exact_match"] == exact_match:
+                    diag_mask = pd.Series(code_matcher_mask(code_matcher, values_to_match), index=df1.index)
+                    if diag_mask.any():
+                        out = (df1.loc[diag_mask, cols if cols is not None else df1.columns])
+                    return out
+                # DIAG mask, resolved on the unique codes and mapped back to the rows
+                compiled = compile_code_patterns(map(str, values_to_match), exact=exact_match)
+                diag_mask = pd.Series(vocabulary_code_mask(df1[diagcol], compiled, normalize=lambda v: v.str.strip()), index=df1.index)
                 if diag_mask.any():
                     out = (df1.loc[diag_mask, cols if cols is not None else df1.columns])
                 return out
@@ -5556,6 +7203,7 @@ def build_phenotype_cases(
     noLeadingICD: bool = False, 
     icdprefix: str = "",
     extra_cols_to_keep: list = [],
+    code_matcher=None,
 ) -> pd.DataFrame:
     """
     Build phenotype cases or covariates from a diagnostic dataframe.
@@ -5574,6 +7222,7 @@ def build_phenotype_cases(
         Covar_Name: name of covariate
         general_results: DataFrame to merge with (for covariates)
         BuildEntryExitDates: build entry/exit dates
+        code_matcher: compiled matcher from build_code_matcher (or [noatc, atc]); optional
 
     Returns:
         DataFrame with phenotype cases or covariates.
@@ -5588,6 +7237,7 @@ def build_phenotype_cases(
         vals_noatc, vals_atc = values_to_match
         diag_noatc, diag_atc = diagnostic_col
         date_noatc, date_atc = input_date_in_name
+        matcher_noatc, matcher_atc = code_matcher if isinstance(code_matcher, list) else (code_matcher, None)
         tmp_result_df = advanced_map_cases(values_to_match=vals_noatc, 
                                 exact_match=exact_match, 
                                 df1=df_noatc, 
@@ -5595,7 +7245,8 @@ def build_phenotype_cases(
                                 input_date_in_name=date_noatc,
                                 iidcol=iidcol, skip_icd_update = skip_icd_update, 
                                 remove_point_in_diag_request = remove_point_in_diag_request, 
-                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix)
+                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
+                                code_matcher=matcher_noatc)
         # tmp_result_df = map_cases(values_to_match=vals_noatc, 
         #                           exact_match=exact_match, df1=df_noatc, 
         #                           diagcol=diag_noatc)
@@ -5606,7 +7257,8 @@ def build_phenotype_cases(
                                 input_date_in_name=date_atc,
                                 iidcol=iidcol, skip_icd_update = skip_icd_update, 
                                 remove_point_in_diag_request = remove_point_in_diag_request, 
-                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix)
+                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
+                                code_matcher=matcher_atc)
         # tmp_result_df_atc = map_cases(values_to_match=vals_atc, 
         #                               exact_match=exact_match, df1=df_atc, 
         #                               diagcol=diag_atc)
@@ -5630,7 +7282,8 @@ def build_phenotype_cases(
                                 input_date_in_name=input_date_in_name,
                                 iidcol=iidcol, skip_icd_update = skip_icd_update, 
                                 remove_point_in_diag_request = remove_point_in_diag_request, 
-                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix)
+                                ICDCM = ICDCM, noLeadingICD = noLeadingICD, icdprefix = icdprefix,
+                                code_matcher=code_matcher)
         # tmp_result_df = map_cases(values_to_match=values_to_match, 
         #                           exact_match=exact_match, 
         #                           df1=df1, 
@@ -5652,7 +7305,7 @@ def build_phenotype_cases(
 
     # --- Step 3: Convert date columns ---
     def _convert_series(s):
-        return s.apply(lambda x: convert_if_not_datetime(x) if pd.notnull(x) else pd.NaT)
+        return convert_dates_once(s)
 
     for col in [input_date_in_name, input_date_out_name, birthdatecol]:
         if isinstance(col, list):
@@ -5997,10 +7650,351 @@ def merge_secondary_diagnoses(df1, df, diagnostic_col, lpr_recnummer, lpr2nd_rec
     
     # Replace diagnostic_col entry with c_tildiag as the c_diagtype is + which means, there already exists an entry with diagnostic_col and a different c_diagtype, so that we now can replace this entry with the associated diagnosis.
     if "c_tildiag" in df1_temp.columns and "c_diagtype" in df1_temp.columns:
-        df1_temp.loc[df1_temp["c_diagtype"].str.contains("+", na=False), diagnostic_col] = df1_temp["c_tildiag"]
+        df1_temp.loc[df1_temp["c_diagtype"].str.contains("+", regex=False, na=False), diagnostic_col] = df1_temp["c_tildiag"]
     
     return pd.concat([df1, df1_temp], ignore_index=True, sort=False)
 
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+def is_parquet_path(path) -> bool:
+    return str(path).strip().lower().endswith(PARQUET_SUFFIXES)
+
+def parquet_path_for(path: str) -> str:
+    """Parquet file written by --BuildParquet for a CSV/STATA input (next to it, as for the .h5 index)."""
+    return path.rpartition('.')[0] + '.parquet'
+
+def _parquet_filter_values(field_type, values):
+    """
+    Cast filter values to the Parquet column type. Only string and integer columns are pushed down;
+    returns None for other types (the caller then filters after loading as before).
+    """
+    if pa.types.is_string(field_type) or pa.types.is_large_string(field_type):
+        return [str(v) for v in values]
+    if pa.types.is_integer(field_type):
+        out = []
+        for v in values:
+            try:
+                out.append(int(str(v).strip()))
+            except ValueError:
+                continue
+        return out
+    return None
+
+def read_parquet_input(path: str, columns: Optional[List[str]] = None, filters: Optional[Dict[str, Iterable]] = None, row_filter=None) -> pd.DataFrame:
+    """
+    Read a Parquet input file. `columns` projects the columns to load and `filters` maps a column
+    (e.g. the IID or diagnosis column) to the values to keep; with pyarrow these are pushed down
+    into the scan so non-matching row groups/rows are never materialized. Filter columns that are
+    not in the file are ignored. row_filter (DataFrame -> bool mask) is applied to each scanned
+    record batch, so only the rows it keeps are held.
+    """
+    filters = {col: list(values) for col, values in (filters or {}).items() if col and values is not None}
+    if pa_dataset is None:
+        # pandas may still read Parquet through another engine (e.g. fastparquet), just without pushdown
+        df = pd.read_parquet(path, columns=columns)
+        for col, values in filters.items():
+            if col in df.columns:
+                df = df[df[col].astype(str).isin(set(str(v) for v in values))]
+        if row_filter is not None:
+            df = df[np.asarray(row_filter(df), dtype=bool)]
+        return df.reset_index(drop=True)
+    dataset = pa_dataset.dataset(path, format="parquet")
+    expression = None
+    for col, values in filters.items():
+        if col not in dataset.schema.names:
+            continue
+        cast_values = _parquet_filter_values(dataset.schema.field(col).type, values)
+        if cast_values is None:
+            logger.info(f"[read_parquet_input] Column {col} in {path} is {dataset.schema.field(col).type}; not pushing down the filter.")
+            continue
+        condition = pa_dataset.field(col).isin(cast_values)
+        expression = condition if expression is None else expression & condition
+    if columns is not None:
+        columns = [c for c in columns if c in dataset.schema.names]
+    if row_filter is not None:
+        batches = (batch.to_pandas() for batch in dataset.to_batches(columns=columns, filter=expression))
+        df = _filter_chunks(batches, row_filter)
+        if df.empty and not len(df.columns):
+            df = dataset.schema.empty_table().to_pandas()[columns or dataset.schema.names]
+        logger.info(f"[read_parquet_input] Loaded {len(df)} rows from {path}")
+        return df
+    table = dataset.to_table(columns=columns, filter=expression)
+    logger.info(f"[read_parquet_input] Loaded {table.num_rows} rows from {path}")
+    return table.to_pandas()
+
+# On-disk cache of parsed input frames (--InputCache); set in main
+INPUT_CACHE_DIR = ""
+INPUT_CACHE_MAX_BYTES = 50 * 1024**3
+INPUT_CACHE_VERSION = 2
+INPUT_CACHE_FINGERPRINTS = "fingerprints.json"
+
+def _atomic_write_json(path, obj):
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(obj, fh)
+    os.replace(tmp, path)
+
+def _input_fingerprint(path):
+    """
+    Size, mtime and SHA-256 of an input file. The hash is remembered in the cache directory per
+    (path, size, mtime), so an unchanged file is only hashed the first time it is seen.
+    """
+    st = os.stat(path)
+    source = os.path.abspath(path)
+    fp_file = os.path.join(INPUT_CACHE_DIR, INPUT_CACHE_FINGERPRINTS)
+    try:
+        with open(fp_file) as fh:
+            known = json.load(fh)
+    except (OSError, ValueError):
+        known = {}
+    meta = known.get(source)
+    if not meta or meta.get("size") != st.st_size or meta.get("mtime_ns") != st.st_mtime_ns:
+        meta = _index_source_meta(path)
+        known[source] = meta
+        _atomic_write_json(fp_file, known)
+    return meta
+
+def input_cache_key(path, options):
+    """Cache key of `path` parsed with `options` (e.g. separator, DateFormat, DayFirst, date columns)."""
+    key = {"version": INPUT_CACHE_VERSION, **_input_fingerprint(path), **options}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def _input_cache_entries():
+    entries = []
+    for name in os.listdir(INPUT_CACHE_DIR):
+        if name.endswith((".feather", ".pkl")):
+            full = os.path.join(INPUT_CACHE_DIR, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+    return entries
+
+def _evict_input_cache(keep):
+    """Remove least recently used cache entries (hits refresh an entry's mtime) until the cache fits INPUT_CACHE_MAX_BYTES."""
+    entries = sorted(_input_cache_entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, full in entries:
+        if total <= INPUT_CACHE_MAX_BYTES:
+            break
+        if full == keep:
+            continue
+        try:
+            os.remove(full)
+            total -= size
+            logger.info(f"[input_cache] Evicted {full} ({size / 1024**2:.1f} MB)")
+        except OSError:
+            pass
+
+def _arrow_backed_dtype(arrow_type):
+    """types_mapper for read_feather_mapped: Arrow strings become string[pyarrow], everything else converts as usual."""
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.StringDtype("pyarrow")
+    return None
+
+def read_feather_mapped(path):
+    """
+    Read a Feather (Arrow IPC) cache entry through a read-only memory map. String columns stay
+    Arrow-backed (string[pyarrow]) on the mapped buffers instead of being copied into Python objects,
+    so they cost no private memory and every process that reads the entry shares the page cache.
+    Missing strings are pd.NA.
+    """
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=_arrow_backed_dtype)
+
+def read_input_cache(key):
+    """Return the cached frame for `key`, or None."""
+    for ext in (".feather", ".pkl"):
+        full = os.path.join(INPUT_CACHE_DIR, key + ext)
+        if not os.path.exists(full):
+            continue
+        try:
+            if ext == ".feather":
+                df = read_feather_mapped(full)
+                # Arrow hands back None for missing strings; the parsers give NaN
+                for c in df.select_dtypes(include=["object"]).columns:
+                    df[c] = df[c].where(df[c].notna(), np.nan)
+            else:
+                df = pd.read_pickle(full)
+        except Exception as e:
+            logger.info(f"[input_cache] Ignoring unreadable cache entry {full}: {e}")
+            continue
+        os.utime(full)
+        return df
+    return None
+
+def write_input_cache(key, df):
+    """Store `df` under `key` (Feather with pyarrow, else pickle) and evict old entries beyond the size budget."""
+    tmp = os.path.join(INPUT_CACHE_DIR, f".{key}.{uuid.uuid4().hex[:8]}.tmp")
+    full = None
+    try:
+        if pa is not None and isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1:
+            try:
+                # uncompressed, so readers can map the buffers instead of decoding a private copy
+                df.to_feather(tmp, compression="uncompressed")
+                full = os.path.join(INPUT_CACHE_DIR, key + ".feather")
+            except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError) as e:
+                logger.info(f"[input_cache] Cannot store frame as Feather ({e}); using pickle")
+        if full is None:
+            df.to_pickle(tmp)
+            full = os.path.join(INPUT_CACHE_DIR, key + ".pkl")
+        os.replace(tmp, full)
+    except OSError as e:
+        logger.info(f"[input_cache] Could not write cache entry for {key}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    _evict_input_cache(keep=full)
+
+def load_with_input_cache(path, options, loader):
+    """
+    Return loader(path), served from the on-disk input cache when --InputCache is set. Entries are
+    keyed on the file (path, size, mtime, SHA-256) and the parsing `options`, so any change to either
+    parses the file again. A freshly parsed file is returned as read back from its new entry, so hits
+    and misses give the same dtypes (string columns are string[pyarrow] for Feather entries).
+    """
+    if not INPUT_CACHE_DIR:
+        return loader(path)
+    os.makedirs(INPUT_CACHE_DIR, exist_ok=True)
+    key = input_cache_key(path, options)
+    df = read_input_cache(key)
+    if df is not None:
+        logger.info(f"[input_cache] Loaded {path} from the input cache ({key[:12]})")
+        return df
+    df = loader(path)
+    write_input_cache(key, df)
+    cached = read_input_cache(key)
+    return cached if cached is not None else df
+
+# Rows per chunk when load_data_file streams a file through a row_filter
+LOAD_CHUNK_ROWS = 1_000_000
+
+def _filter_chunks(chunks, row_filter):
+    """Concatenate the rows of each chunk that row_filter (DataFrame -> bool mask) keeps; an empty frame keeps the schema."""
+    parts, empty, seen = [], None, 0
+    for chunk in chunks:
+        seen += len(chunk)
+        keep = np.asarray(row_filter(chunk), dtype=bool)
+        if empty is None:
+            empty = chunk.iloc[:0]
+        if keep.any():
+            parts.append(chunk[keep])
+    kept = sum(len(part) for part in parts)
+    logger.info(f"[load_data_file] Kept {kept} of {seen} streamed rows.")
+    if not parts:
+        return empty if empty is not None else pd.DataFrame()
+    return pd.concat(parts, ignore_index=True, sort=False)
+
+def _read_stata_input(path, usecols=None, row_filter=None):
+    """
+    Read one Stata input for load_data_file, only the `usecols` columns it has (in file order) if given.
+    With a row_filter, the file is read in LOAD_CHUNK_ROWS chunks and only the kept rows are held.
+    """
+    columns = None
+    if usecols is not None:
+        wanted = set(usecols)
+        with pd.read_stata(path, iterator=True) as reader:
+            names = list(reader.variable_labels())
+        columns = [c for c in names if c in wanted]
+    if row_filter is None:
+        return pd.read_stata(path, columns=columns)
+    with pd.read_stata(path, columns=columns, chunksize=LOAD_CHUNK_ROWS) as reader:
+        return _filter_chunks(reader, row_filter)
+
+def _read_csv_input(path, sep, requested_dates, iidcol=None, iid_rows=None, usecols=None, row_filter=None):
+    """
+    Read one CSV input for load_data_file: inferred dtypes, robustly parsed `requested_dates` columns,
+    and only the `usecols` columns the file has if given. With a row_filter, the file is read in
+    LOAD_CHUNK_ROWS chunks and only the kept rows are held (dates are parsed on those rows only).
+    With iid_rows, only the rows of these IIDs are read via the byte-offset IID index; a file that
+    cannot be indexed is streamed and filtered on the IID column instead.
+    """
+    rows_blob = None
+    if iid_rows is not None and iidcol:
+        iid_index = get_iid_offset_index(path, iidcol, sep=sep, verbose=verbose)
+        if iid_index is not None:
+            rows_blob = read_iid_rows(path, iid_index, iid_rows)
+        else:
+            wanted_iids = set(normalized_iid_list(iid_rows))
+
+            def _iid_filter(chunk, inner=row_filter):
+                if iidcol not in chunk.columns:
+                    keep = np.ones(len(chunk), dtype=bool)
+                else:
+                    keep = normalize_iid_series(chunk[iidcol], target="str").isin(wanted_iids).to_numpy(dtype=bool)
+                return keep if inner is None else keep & np.asarray(inner(chunk), dtype=bool)
+            row_filter = _iid_filter
+    def _source(path=path, rows_blob=rows_blob):
+        return io.BytesIO(rows_blob) if rows_blob is not None else path
+    # discover columns
+    try:
+        hdr = pd.read_csv(_source(), sep=sep, nrows=0)
+    except TypeError:
+        hdr = pd.read_csv(_source(), sep=sep, nrows=0, engine="python")
+    if hdr.columns.empty:
+        logger.info(f"[load_data_file] ERROR: Could not load file header: {path}")
+        sys.exit(1)
+    if usecols is not None:
+        wanted = set(usecols)
+        usecols = [c for c in hdr.columns if c in wanted]
+        logger.info(f"[load_data_file] Loading {len(usecols)} of {len(hdr.columns)} columns of {path}: {usecols}")
+        hdr = hdr[usecols]
+
+    # intersect requested dates with present columns
+    date_cols = [c for c in requested_dates if c in hdr.columns]
+    if verbose and date_cols:
+        logger.info(f"[load_data_file] date columns in {path}: {date_cols}")
+    if date_cols:
+        logger.info(f"[load_data_file] Original cols: {requested_dates}")
+        logger.info(f"[load_data_file] date columns in {path}: {date_cols}")
+        hdr2 = pd.read_csv(_source(), sep=sep, nrows=2)
+        logger.info(f"[load_data_file] DayFirst = {DayFirst}; DateFormat = {DateFormat}\ndf3 before updating Dates: {hdr2}")
+        del(hdr2)
+
+    # read with type inference
+    if row_filter is not None:
+        with pd.read_csv(_source(), sep=sep, usecols=usecols, chunksize=LOAD_CHUNK_ROWS) as reader:
+            df = _filter_chunks(reader, row_filter)
+    else:
+        try:
+            df = pd.read_csv(_source(), sep=sep, low_memory=False, usecols=usecols)
+        except TypeError:
+            df = pd.read_csv(_source(), sep=sep, engine="python", usecols=usecols)
+
+    # robust date parsing
+    for col in date_cols:
+        df[col] = _to_datetime_series(df[col], fmt=DateFormat, dayfirst=DayFirst, cache_key=(os.path.abspath(path), col))
+    logger.info(df.head(5))
+    return df
+
+def submit_input_loads(loaders, workers=1):
+    """
+    Start independent input reads ({name: zero-argument callable}) and return {name: Future}.
+    With workers > 1 they run on a thread pool (one thread per read, up to workers), so reads that
+    are latency-bound, e.g. on a network filesystem, overlap and the caller collects each result
+    where it is needed. Otherwise every loader runs right away, in order. Either way a loader's
+    exception (including the SystemExit of a failed load) is raised by Future.result().
+    """
+    workers = max(1, min(int(workers), len(loaders)))
+    if workers <= 1:
+        futures = {}
+        for name, loader in loaders.items():
+            future = Future()
+            try:
+                future.set_result(loader())
+            except (Exception, SystemExit) as exc:
+                future.set_exception(exc)
+            futures[name] = future
+        return futures
+    logger.info(f"[submit_input_loads] Reading {list(loaders)} on {workers} threads")
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {name: pool.submit(loader) for name, loader in loaders.items()}
+    # the submitted reads keep running; the threads exit once they are done
+    pool.shutdown(wait=False)
+    return futures
+
 def load_data_file(
     data_file: str,
     sep: str,
@@ -6008,13 +8002,25 @@ def load_data_file(
     diagnostic_col: str,
     sexcol: str,
     stam_cols_to_read_as_date: Iterable[str],
-    iidcol: Optional[str] = None
+    iidcol: Optional[str] = None,
+    parquet_filters: Optional[Dict[str, Iterable]] = None,
+    iid_rows: Optional[Iterable[str]] = None,
+    usecols: Optional[Iterable[str]] = None,
+    row_filter=None
 ):
     """
-    Load 1 or more CSV/STATA files into a single DataFrame.
-    - Let pandas infer non-date dtypes.
+    Load 1 or more CSV/STATA/Parquet files into a single DataFrame.
+    - Let pandas infer non-date dtypes (Parquet files keep their stored types).
     - Parse only requested date columns (robustly).
     - Rename birthdate/diagnosis/sex to canonical names.
+    - parquet_filters ({column: values}) is pushed down into Parquet reads only; CSV/STATA
+      callers filter after loading.
+    - iid_rows restricts CSV files to the rows of these IIDs, read by seeking via the byte-offset
+      IID index (<file>.iidx.npz, built on first use).
+    - usecols limits every file type to these columns (names missing from a file are ignored);
+      None loads all columns.
+    - row_filter (DataFrame -> bool mask, e.g. from lpr_prefilter) streams every file type in
+      chunks and keeps only the rows it selects; such reads bypass the --InputCache.
     Uses globals: dta_input, DayFirst, DateFormat, verbose.
     """
     paths: List[str] = [p.strip() for p in data_file.split(",")] if "," in data_file else [data_file]
@@ -6027,39 +8033,23 @@ def load_data_file(
     requested_dates = set(stam_cols_to_read_as_date or [])
 
     for path in paths:
-        if dta_input:
-            df = pd.read_stata(path)
+        if is_parquet_path(path):
+            df = read_parquet_input(path, columns=usecols, filters=parquet_filters, row_filter=row_filter)
+            # Files written by --BuildParquet already hold parsed dates; parse any that are still text
+            for col in [c for c in requested_dates if c in df.columns]:
+                if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                    df[col] = _to_datetime_series(df[col], fmt=DateFormat, dayfirst=DayFirst, cache_key=(os.path.abspath(path), col))
+        elif iid_rows is not None and not dta_input:
+            df = _read_csv_input(path, sep, requested_dates, iidcol=iidcol, iid_rows=iid_rows, usecols=usecols, row_filter=row_filter)
+        elif row_filter is not None:
+            df = _read_stata_input(path, usecols, row_filter) if dta_input else _read_csv_input(path, sep, requested_dates, usecols=usecols, row_filter=row_filter)
         else:
-            # discover columns
-            try:
-                hdr = pd.read_csv(path, sep=sep, nrows=0)
-            except TypeError:
-                hdr = pd.read_csv(path, sep=sep, nrows=0, engine="python")
-            if hdr.columns.empty:
-                logger.info(f"[load_data_file] ERROR: Could not load file header: {path}")
-                sys.exit(1)
-
-            # intersect requested dates with present columns
-            date_cols = [c for c in requested_dates if c in hdr.columns]
-            if verbose and date_cols:
-                logger.info(f"[load_data_file] date columns in {path}: {date_cols}")
-            if date_cols:
-                logger.info(f"[load_data_file] Original cols: {requested_dates}")
-                logger.info(f"[load_data_file] date columns in {path}: {date_cols}")
-                hdr2 = pd.read_csv(path, sep=sep, nrows=2)
-                logger.info(f"[load_data_file] DayFirst = {DayFirst}; DateFormat = {DateFormat}\ndf3 before updating Dates: {hdr2}")
-                del(hdr2)
-        
-            # read with type inference
-            try:
-                df = pd.read_csv(path, sep=sep, low_memory=False)
-            except TypeError:
-                df = pd.read_csv(path, sep=sep, engine="python")
-
-            # robust date parsing
-            for col in date_cols:
-                df[col] = _to_datetime_series(df[col], fmt=DateFormat, dayfirst=DayFirst)
-            logger.info(df.head(5))
+            # whole-file reads can be served from the --InputCache
+            options = {"sep": sep, "dta": bool(dta_input), "DateFormat": DateFormat, "DayFirst": DayFirst,
+                       "dates": sorted(requested_dates), "usecols": sorted(usecols) if usecols is not None else None}
+            df = load_with_input_cache(
+                path, options,
+                lambda p: _read_stata_input(p, usecols) if dta_input else _read_csv_input(p, sep, requested_dates, usecols=usecols))
 
         frames.append(df)
 
@@ -6106,9 +8096,73 @@ def load_data_file(
 
     return df3
 
-def process_lpr_data(lpr_file, lpr2nd_file, dta_input, sep, lpr_cols_to_read_as_date, DateFormat, potential_lpr_cols_to_read_as_date, diagnostic_col, diagnostic2nd_col, lpr_recnummer, lpr2nd_recnummer, iidcol):
+def lpr_columns_needed(iidcol, diagnostic_col, input_date_in_name, input_date_out_name, ctype_col, lpr_recnummer, birthdatecol="", date_cols=(), codes=()):
+    """
+    The -f columns a run reads, from its CLI/ini settings: IID, diagnosis, in/out dates (and any other
+    date columns), diagnosis type, record number, birthdate, and the register columns kept in the output
+    (NON_ATC_EXTRA_COLUMNS, under their raw or renamed names) or used to join --f2 (LPR_JOIN_COLUMNS).
+    Returns None (read every column) if any of the requested codes is a main=/sub=/rule_out= rule:
+    detect_advanced_cases drops duplicate matches on all columns, so rows that differ only in an
+    unread column would collapse.
+    """
+    if any(key in str(code) for code in codes or [] for key in ("main=", "sub=", "rule_out=")):
+        return None
+    cols = [iidcol, diagnostic_col, input_date_in_name, input_date_out_name, ctype_col, lpr_recnummer, birthdatecol,
+            *date_cols, *LPR_RAW_EXTRA_COLUMNS, *NON_ATC_EXTRA_COLUMNS, *LPR_JOIN_COLUMNS]
+    return list(dict.fromkeys(c for c in cols if c))
+
+# Coding-system prefixes (ICD10:, ICD10-CM:, ICD8-, ...) dropped from requested codes before prefiltering
+LPR_PREFILTER_CODE_PREFIX = re.compile(r"^ICD\d{1,2}(?:-CM)?[-:]?")
+
+def compile_lpr_prefilter(codes):
     """
-    Process the LPR data sequentially, ensuring an equal number of LPR and LPR2nd files are provided.
+    Compile requested codes into a loose pattern for prefiltering -f rows while they are read.
+
+    The pattern is deliberately broader than map_cases: every code is reduced to its core (upper-cased,
+    without "*", coding-system prefix, dots and a Danish leading "D") and a row is kept if any core
+    occurs anywhere in its dot-free, upper-cased code. So every row a phenotype, exclusion or
+    covariate can match is kept, whatever prefix or --eM handling applies later.
+    Returns None if the codes cannot be prefiltered (none given, a match-all code or advanced rules).
+    """
+    cores = set()
+    for code in codes or []:
+        c = str(code).strip().upper()
+        if "=" in c or ";" in c:
+            return None
+        c = LPR_PREFILTER_CODE_PREFIX.sub("", c.rstrip("*")).replace(".", "")
+        if re.match(r"^D[A-Z]\d", c):
+            c = c[1:]
+        if not c:
+            return None
+        cores.add(c)
+    if not cores:
+        return None
+    return re.compile("|".join(re.escape(c) for c in sorted(cores)))
+
+def lpr_prefilter_mask(df, columns, pattern):
+    """Row mask of df: True where any of `columns` (missing ones are skipped) holds a code the compiled prefilter keeps."""
+    hits = np.zeros(len(df), dtype=bool)
+    for col in columns:
+        if col not in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[col], sort=False)
+        vocab = pd.Series(uniques, dtype="object").astype(str).str.upper().str.replace(".", "", regex=False)
+        keep = np.fromiter((pattern.search(v) is not None for v in vocab), dtype=bool, count=len(vocab))
+        hits |= np.append(keep, False)[codes]
+    return hits
+
+def process_lpr_data(lpr_file, lpr2nd_file, dta_input, sep, lpr_cols_to_read_as_date, DateFormat, potential_lpr_cols_to_read_as_date, diagnostic_col, diagnostic2nd_col, lpr_recnummer, lpr2nd_recnummer, iidcol, parquet_filters=None, iid_rows=None, usecols=None, prefilter=None, workers=1):
+    """
+    Process the LPR data, ensuring an equal number of LPR and LPR2nd files are provided.
+    parquet_filters and iid_rows are only applied to the -f files (the --f2 files are joined on the record number).
+    usecols (see lpr_columns_needed) limits the -f columns loaded; only the record number and diagnosis
+    columns of the --f2 files are read then, as merge_secondary_diagnoses uses no others.
+    prefilter (see compile_lpr_prefilter) streams the -f files and keeps only rows whose diagnosis (or
+    c_tildiag) can match, plus the records an --f2 diagnosis can match; the --f2 rows are then cut
+    down to the kept records before the join.
+    The per-file frames are concatenated once at the end. With workers > 1 the files (or -f/--f2 pairs)
+    are loaded by a thread pool (at most one thread per file and CPU; the CSV tokenizer and pyarrow
+    release the GIL); the frames keep the file order, so the result equals a sequential load.
     """
     file_paths = lpr_file.split(',') if ',' in lpr_file else [lpr_file]
     if lpr2nd_file != "":
@@ -6121,29 +8175,47 @@ def process_lpr_data(lpr_file, lpr2nd_file, dta_input, sep, lpr_cols_to_read_as_
         raise ValueError("[process_lpr_data] Mismatch in number of LPR and LPR2nd files. Ensure both are provided in the same order.")
         
     
-    df1 = None
     logger.info(f"[process_lpr_data] LPR files {file_paths}, and 2nd diagnosis files {secondary_paths}")
-    if (len(secondary_paths) > 0):
-        for lprfile, lpr2ndfile in zip(file_paths, secondary_paths):
-            logger.info(f"[process_lpr_data] Loading {lprfile}, and {lpr2ndfile}")
-            df_lpr = load_data_file(data_file=lprfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = lpr_cols_to_read_as_date + potential_lpr_cols_to_read_as_date, iidcol=iidcol)
-            df_lpr2nd = load_data_file(data_file=lpr2ndfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = lpr_cols_to_read_as_date + potential_lpr_cols_to_read_as_date, iidcol=iidcol)
-            df_merged = merge_secondary_diagnoses(df_lpr, df_lpr2nd, diagnostic_col, lpr_recnummer, lpr2nd_recnummer, diagnostic2nd_col)
-            
-            if df1 is None:
-                df1 = df_merged
-            else:
-                df1 = pd.concat([df1, df_merged], ignore_index=True, sort=False)
+    date_cols = lpr_cols_to_read_as_date + potential_lpr_cols_to_read_as_date
+
+    def _load_pair(lprfile, lpr2ndfile):
+        logger.info(f"[process_lpr_data] Loading {lprfile}, and {lpr2ndfile}")
+        df_lpr2nd = load_data_file(data_file=lpr2ndfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = date_cols, iidcol=iidcol,
+                                   usecols=[lpr2nd_recnummer, diagnostic2nd_col] if usecols is not None else None)
+        row_filter = None
+        if prefilter is not None:
+            hit2 = lpr_prefilter_mask(df_lpr2nd, [diagnostic2nd_col], prefilter)
+            records2 = set(df_lpr2nd.loc[hit2, lpr2nd_recnummer].astype(str))
+            def row_filter(chunk):
+                hits = lpr_prefilter_mask(chunk, [diagnostic_col, "c_tildiag"], prefilter)
+                if records2 and lpr_recnummer in chunk.columns:
+                    hits |= chunk[lpr_recnummer].astype(str).isin(records2).to_numpy()
+                return hits
+        df_lpr = load_data_file(data_file=lprfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = date_cols, iidcol=iidcol, parquet_filters=parquet_filters, iid_rows=iid_rows, usecols=usecols, row_filter=row_filter)
+        if prefilter is not None and lpr_recnummer in df_lpr.columns:
+            # inner join: --f2 rows of records dropped from -f cannot contribute
+            df_lpr2nd = df_lpr2nd[df_lpr2nd[lpr2nd_recnummer].isin(df_lpr[lpr_recnummer])]
+        return merge_secondary_diagnoses(df_lpr, df_lpr2nd, diagnostic_col, lpr_recnummer, lpr2nd_recnummer, diagnostic2nd_col)
+
+    def _load_one(lprfile):
+        logger.info(f"[process_lpr_data] Loading {lprfile}")
+        row_filter = (lambda chunk: lpr_prefilter_mask(chunk, [diagnostic_col, "c_tildiag"], prefilter)) if prefilter is not None else None
+        return load_data_file(data_file=lprfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = date_cols, iidcol=iidcol, parquet_filters=parquet_filters, iid_rows=iid_rows, usecols=usecols, row_filter=row_filter)
+
+    if len(secondary_paths) > 0:
+        load, jobs = _load_pair, list(zip(file_paths, secondary_paths))
     else:
-        for lprfile in file_paths:
-            logger.info(f"[process_lpr_data] Loading {lprfile}")
-            df_lpr = load_data_file(data_file=lprfile, sep=sep, birthdatecol="", diagnostic_col="", sexcol = "", stam_cols_to_read_as_date = lpr_cols_to_read_as_date + potential_lpr_cols_to_read_as_date, iidcol=iidcol)
-                        
-            if df1 is None:
-                df1 = df_lpr
-            else:
-                df1 = pd.concat([df1, df_lpr], ignore_index=True, sort=False)
-    return df1
+        load, jobs = _load_one, [(lprfile,) for lprfile in file_paths]
+    workers = max(1, min(int(workers), len(jobs), os.cpu_count() or 1))
+    if workers > 1:
+        logger.info(f"[process_lpr_data] Loading {len(jobs)} files on {workers} threads")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            frames = list(pool.map(lambda job: load(*job), jobs))
+    else:
+        frames = [load(*job) for job in jobs]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, sort=False)
 
 def finalize_lpr_data(df1, diagnostic_col, birthdatecol, ctype_col, verbose):
     """
@@ -6159,16 +8231,6 @@ def finalize_lpr_data(df1, diagnostic_col, birthdatecol, ctype_col, verbose):
         if verbose:
             logger.info("[finalize_lpr_data] Updated birthdatecol name to 'birthdate'.")
 
-    if "c_pattype" in df1.columns:
-        df1.rename(columns={"c_pattype": "pattype"}, inplace=True)
-        if verbose:
-            logger.info("[finalize_lpr_data] Updated c_pattype name to 'pattype'.")
-
-    if "c_indm" in df1.columns:
-        df1.rename(columns={"c_indm": "admissiontype"}, inplace=True)
-        if verbose:
-            logger.info("[finalize_lpr_data] Updated c_indm name to 'admissiontype'.")
-
     if ctype_col in df1.columns:
         df1.rename(columns={ctype_col: "diagtype"}, inplace=True)
         if verbose:
@@ -6184,18 +8246,56 @@ def finalize_lpr_data(df1, diagnostic_col, birthdatecol, ctype_col, verbose):
     #     if verbose:
     #         logger.info("[finalize_lpr_data] Updated type name to 'diagtype'.")
 
-    if "source" in df1.columns:
-        df1.rename(columns={"source": "register"}, inplace=True)
+    renames = {raw: name for raw, name in LPR_COLUMN_RENAMES.items() if raw in df1.columns}
+    if renames:
+        df1.rename(columns=renames, inplace=True)
         if verbose:
-            logger.info("[finalize_lpr_data] Updated source name to 'register'.")
+            for raw, name in renames.items():
+                logger.info(f"[finalize_lpr_data] Updated {raw} name to '{name}'.")
 
-    if "diag_source" in df1.columns:
-        df1.rename(columns={"diag_source": "source"}, inplace=True)
-        if verbose:
-            logger.info("[finalize_lpr_data] Updated diag_source name to 'source'.")
+    return df1
+
+# Low-cardinality code columns (after finalize_lpr_data renames) that are kept as categoricals
+CATEGORICAL_CODE_COLUMNS = ["diagnosis", "diagtype", "register", "source"]
 
+def categorize_code_columns(df1, columns=None, verbose=False):
+    """
+    Store low-cardinality code columns (diagnosis, diagtype, register, source, ATC column) as
+    pandas categoricals: one small dictionary of unique codes plus integer codes per row.
+    Columns holding non-string values (e.g. numeric source codes) are left untouched.
+    """
+    if df1 is None or df1.empty:
+        return df1
+    for col in dict.fromkeys(columns if columns is not None else CATEGORICAL_CODE_COLUMNS):
+        if col not in df1.columns or isinstance(df1[col].dtype, pd.CategoricalDtype):
+            continue
+        if not (pd.api.types.is_object_dtype(df1[col]) or pd.api.types.is_string_dtype(df1[col])):
+            continue
+        df1[col] = df1[col].astype("category")
+        if verbose:
+            logger.info(f"[categorize_code_columns] {col}: {len(df1[col].cat.categories)} categories for {len(df1)} rows")
     return df1
 
+def map_code_vocabulary(series, func):
+    """
+    Apply a string transformation (e.g. str.upper, stripping) to the unique codes of a series only.
+    Categoricals stay categorical (categories that collapse onto the same value are merged);
+    other dtypes are factorized, transformed on the uniques and mapped back. Non-strings are kept as is.
+    """
+    def _apply(value):
+        return func(value) if isinstance(value, str) else value
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        new_values = [_apply(c) for c in series.cat.categories]
+        inverse, new_categories = pd.factorize(pd.Series(new_values, dtype="object"), sort=False)
+        old_codes = series.cat.codes.to_numpy()
+        new_codes = np.where(old_codes >= 0, np.asarray(inverse)[old_codes], -1)
+        return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories), index=series.index, name=series.name)
+    codes, uniques = pd.factorize(series, sort=False)
+    mapped = np.array([_apply(u) for u in uniques] + [np.nan], dtype=object)
+    out = pd.Series(mapped[codes], index=series.index, name=series.name)
+    return out.astype(series.dtype) if pd.api.types.is_string_dtype(series.dtype) and series.dtype != object else out
+
 def process_entry(entry, remove_leading, eM, mode, icdprefix, remove_point, ICDCM):
     """
     Process a single ICD entry based on the settings.
@@ -6775,7 +8875,7 @@ def Exclusion_interpreter(
             out[col] = pd.Series([[] for _ in range(len(out))], dtype=object)
     # base Level2 copies
     out['Level2_diagnoses'] = out['diagnoses'].apply(_as_list).astype(object)
-    out['Level2_dates'] = out['in_dates'].apply(_as_list).astype(object)
+    out['Level2_dates'] = pd.Series([x if is_day_list(x) else _as_list(x) for x in out['in_dates']], index=out.index, dtype=object)
     if 'Level2_AgeExclusion' not in out.columns:
         out['Level2_AgeExclusion'] = "False"
 
@@ -6783,17 +8883,10 @@ def Exclusion_interpreter(
     if min_Age or max_Age:
         if verbose:
             logger.info(f"[Exclusion_interpreter] Updating Case-Diagnoses based on Age, min={min_Age}, max={max_Age}")
-        # compute age at first dx from original in_dates (robust)
-        if 'out_dates' in out.columns:
-            first_dx = min(pd.to_datetime(out['in_dates'].apply(lambda x: min(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce'),
-                           pd.to_datetime(out['out_dates'].apply(lambda x: min(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce'))
-        else:
-            first_dx = pd.to_datetime(out['in_dates'].apply(lambda x: min(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce')
+        # compute age at first dx from original in_dates (robust); earliest of in/out dates per row
+        first_dx = _first_date_per_row(out['in_dates'])
         if 'out_dates' in out.columns:
-            last_dx = min(pd.to_datetime(out['in_dates'].apply(lambda x: max(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce'),
-                           pd.to_datetime(out['out_dates'].apply(lambda x: max(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce'))
-        else:
-            last_dx = pd.to_datetime(out['in_dates'].apply(lambda x: max(_to_dt_list(x)) if _to_dt_list(x) else pd.NaT), errors='coerce')
+            first_dx = pd.concat([first_dx, _first_date_per_row(out['out_dates'])], axis=1).min(axis=1)
         birth = pd.to_datetime(out.get('birthdate', pd.NaT), errors='coerce')
         age_years = ((first_dx - birth).dt.days // 365).astype('Int64')
         out['Age_FirstDx'] = age_years
@@ -6853,13 +8946,11 @@ def Exclusion_interpreter(
         )
 
     # Compute Level2_FirstDx from Level2_dates
-    level2_first = out['Level2_dates'].apply(lambda x: _to_dt_list(x))
-    out['Level2_FirstDx'] = level2_first.apply(lambda xs: [min(xs)] if xs else [])
+    first_dx0 = _first_date_per_row(out['Level2_dates'])
+    out['Level2_FirstDx'] = pd.Series([[t] if not pd.isna(t) else [] for t in first_dx0], index=out.index, dtype=object)
 
     # Recalculate age at first diagnosis using Level2
     birth = pd.to_datetime(out.get('birthdate', pd.NaT), errors='coerce')
-    first_dx0 = out['Level2_FirstDx'].apply(lambda xs: xs[0] if isinstance(xs, list) and xs else pd.NaT)
-    first_dx0 = pd.to_datetime(first_dx0, errors='coerce')
     out['Level3_Age_FirstDx'] = ((first_dx0 - birth).dt.days // 365).fillna(0).astype(int)
 
     # Case/Control label
@@ -6889,7 +8980,156 @@ def update_DxDates_multi_exclusion(
     date_format: str = "%Y-%m-%d",
     verbose: bool = False,
 ) -> pd.DataFrame:
-    """Optimized, date-format-aware version.
+    """Long-format version of update_DxDates_multi_exclusion_old (same inputs and outputs).
+
+    - The per-row lists are exploded once into (row, position, code/day number) frames; dates that are
+      not day-number lists already are parsed once, and all date comparisons are on day numbers.
+    - 1yprior: a Level2 date is removed if an exclusion date lies 0-365 days before it (merge_asof),
+      post: Level2 dates on/after the earliest exclusion date are removed, lifetime: all are removed.
+    - Results are collapsed back to per-row lists (object dtype) only for the output columns, with
+      dates written in `date_format`.
+    """
+    diag_inflicted_codes = f"{exc_diag_inflicted_changes}_MDD_codes"
+    diag_inflicted_dates = f"{exc_diag_inflicted_changes}_MDD_dates"
+    diag_inflicted_N = f"{exc_diag_inflicted_changes}_MDD_dXnumber"
+    diag_lost_due_to_exc = f"[update_DxDates_multi_exclusion] MDD_diagnoses_in_percent_lost_due_to_{exc_diag}"
+
+    out = all_data.copy()
+
+    # Ensure list/object columns exist
+    list_cols = [
+        level2codes,
+        level2dates,
+        level2datemodifiercodes,
+        level2datemodifierdates,
+        level2datemodifierDXs,
+        "in_dates",
+        "diagnoses",
+        "Level2_ExclusionReason",
+        diag_inflicted_codes,
+        diag_inflicted_dates,
+    ]
+    for col in list_cols:
+        if col not in out.columns:
+            out[col] = pd.Series([[] for _ in range(len(out))], dtype=object)
+        elif out[col].dtype != object:
+            out[col] = out[col].astype(object)
+
+    # Ensure numeric columns
+    for col, default in {
+        diag_inflicted_N: 0,
+        exc_diag_inflicted_changes: 0,
+        diag_lost_due_to_exc: 0.0,
+    }.items():
+        if col not in out.columns:
+            out[col] = default
+
+    # Rows to process
+    mask = (out[exc_diag].astype(str) != "") & (out["diagnoses"].astype(str) != "")
+    if not mask.any():
+        if verbose:
+            logger.info(f"[update_DxDates_multi_exclusion] No rows to process for {exc_diag}.")
+        return out
+
+    row_pos = np.flatnonzero(mask.to_numpy())
+    sub = out.iloc[row_pos]
+    n = len(sub)
+    is_case = (sub["diagnosis"] == "Case").to_numpy() if "diagnosis" in sub.columns else np.zeros(n, dtype=bool)
+
+    exclusion_type_l = str(exclusion_type).lower()
+    if exclusion_type_l in ("1yprior", "post", "lifetime"):
+        exc_codes = _long_list_column(sub[exc_diag], _as_item_list)
+        exc_dates = _long_list_column(sub[exc_diag_date], _as_item_list, as_dates=True)
+        lvl2_codes = _long_list_column(sub[level2codes], _as_item_list)
+        lvl2_dates = _long_list_column(sub[level2dates], _as_item_list, as_dates=True)
+        in_diags = _long_list_column(sub["diagnoses"], _as_item_list)
+        in_dates = _long_list_column(sub["in_dates"], _as_item_list, as_dates=True)
+
+        # Flag removed Level2 dates, exclusion dates causing it, and affected original dates
+        if exclusion_type_l == "1yprior":
+            within_year = 366
+            lvl2_mod = (_nearest_date_gap(lvl2_dates, exc_dates, "backward") < within_year).to_numpy()
+            exc_mod = (_nearest_date_gap(exc_dates, lvl2_dates, "forward") < within_year).to_numpy()
+            # as in the row-wise version, the removed Level2 positions index the original lists
+            orig_keys = lvl2_dates.loc[lvl2_mod, ["row", "pos"]]
+        elif exclusion_type_l == "post":
+            earliest = exc_dates.groupby("row")["value"].min()
+            lvl2_mod = (lvl2_dates["value"] >= lvl2_dates["row"].map(earliest)).to_numpy()
+            exc_mod = (exc_dates["value"] == exc_dates["row"].map(earliest)).to_numpy()
+            orig_keys = in_dates.loc[(in_dates["value"] >= in_dates["row"].map(earliest)).to_numpy(), ["row", "pos"]]
+        else:
+            lvl2_mod = np.ones(len(lvl2_dates), dtype=bool)
+            exc_mod = np.ones(len(exc_dates), dtype=bool)
+            orig_keys = in_dates[["row", "pos"]]
+
+        # Update Level2 (keep positions; codes follow the positions of their dates)
+        kept_dates = lvl2_dates.loc[~lvl2_mod].assign(value=lambda d: _format_days(d["value"], date_format))
+        kept_codes = lvl2_codes.merge(kept_dates[["row", "pos"]], on=["row", "pos"], how="inner")
+        level2_codes_new = _collapse_long(kept_codes, n)
+        level2_dates_new = _collapse_long(kept_dates, n)
+
+        # Modifier dates/codes/DX labels to append
+        mod_exc_dates = exc_dates.loc[exc_mod].assign(value=lambda d: _format_days(d["value"], date_format))
+        mod_exc_codes = exc_codes.merge(mod_exc_dates[["row", "pos"]], on=["row", "pos"], how="inner")
+        n_mod_exc = np.bincount(mod_exc_dates["row"].to_numpy(dtype=np.int64), minlength=n)
+        mod_dates_add = _collapse_long(mod_exc_dates, n)
+        mod_codes_add = _collapse_long(mod_exc_codes, n)
+
+        # Inflicted changes on original diagnoses
+        orig_dates = in_dates.merge(orig_keys, on=["row", "pos"], how="inner").assign(value=lambda d: _format_days(d["value"], date_format))
+        orig_diags = in_diags.merge(orig_keys, on=["row", "pos"], how="inner")
+        n_orig = np.bincount(orig_keys["row"].to_numpy(dtype=np.int64), minlength=n)
+        n_in_dates = np.bincount(in_dates["row"].to_numpy(dtype=np.int64), minlength=n)
+        has_exc_diag = (sub[exc_diag].astype(str).str.strip() != "").to_numpy()
+
+        def _set_lists(col, lists):
+            values = out[col].tolist()
+            for pos, items in zip(row_pos, lists):
+                values[pos] = items
+            out[col] = pd.Series(values, index=out.index, dtype=object)
+
+        _set_lists(level2codes, level2_codes_new)
+        _set_lists(level2dates, level2_dates_new)
+        _set_lists(level2datemodifierdates, [_as_item_list(x) + add for x, add in zip(sub[level2datemodifierdates], mod_dates_add)])
+        _set_lists(level2datemodifiercodes, [_as_item_list(x) + add for x, add in zip(sub[level2datemodifiercodes], mod_codes_add)])
+        _set_lists(level2datemodifierDXs, [_as_item_list(x) + [exc_diag] * int(k) for x, k in zip(sub[level2datemodifierDXs], n_mod_exc)])
+        _set_lists(diag_inflicted_dates, _collapse_long(orig_dates, n))
+        _set_lists(diag_inflicted_codes, _collapse_long(orig_diags, n))
+
+        out.loc[mask, exc_diag_inflicted_changes] = np.where(is_case & (n_orig > 0), n_orig, 0)
+        out.loc[mask, diag_inflicted_N] = np.where(has_exc_diag & is_case, n_in_dates, 0)
+        out.loc[mask, diag_lost_due_to_exc] = np.where(n_in_dates > 0, n_orig / np.maximum(n_in_dates, 1) * 100.0, 0.0)
+        if verbose:
+            logger.info(f"[update_DxDates_multi_exclusion] Processed {n} rows for {exc_diag} ({exclusion_type_l}); "
+                        f"{int(lvl2_mod.sum())} Level2 entries removed.")
+    elif verbose:
+        logger.info(f"[update_DxDates_multi_exclusion] WARNING: unknown exclusion_type={exclusion_type}")
+
+    # Append exclusion reason
+    diagnosis_status = out.get("diagnosis", pd.Series("", index=out.index, dtype="object"))
+    sel = mask.to_numpy() & (diagnosis_status == "Case").to_numpy()
+    if sel.any():
+        out.loc[sel, "Level2_ExclusionReason"] = out.loc[sel, "Level2_ExclusionReason"].apply(lambda x: (_as_item_list(x) + [diag_excode]))
+
+    return out
+
+def update_DxDates_multi_exclusion_old(
+    all_data: pd.DataFrame,
+    exclusion_type: str,
+    exc_diag: str,
+    exc_diag_date: str,
+    exc_diag_inflicted_changes: str,
+    diag_excode: Any,
+    level2codes: str,
+    level2dates: str,
+    level2datemodifiercodes: str,
+    level2datemodifierdates: str,
+    level2datemodifierDXs: str,
+    *,
+    date_format: str = "%Y-%m-%d",
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Row-wise reference implementation (see update_DxDates_multi_exclusion). Optimized, date-format-aware version.
 
     - Accepts list or comma-separated strings in inputs; writes lists (object dtype).
     - Works with any parsable date format; output dates formatted via `date_format`.
@@ -7131,13 +9371,19 @@ if __name__ == '__main__':
     parser.add_argument('--write_Plink2_format', action='store_true', help='If you want to write the phenotype into PLINK2 format.')
     parser.add_argument('--BuildTestSet', action='store_true', help='Build the test set that can be used to see an example of the input data or to test if your setup runs smoothly'),
     parser.add_argument('--testRun', action='store_true', help='Run only on smaller test data input (only available for the test dataset)'),
-    parser.add_argument('--nthreads', default=8, help='DEPRECATED! - How many threads should be used. Default: "%(default)s"'),
-    parser.add_argument('--lowmem', action='store_true', help='Experimental! - This will devide the -f file (if not an h5 indexed file) into groups of each 100.000 individuals (change by using --batchsize), run the phenotype on them, save it to file and then run the next 100k until the end. h5 indexed input (-f) will extract all IIDs that have the requested codes but will not load the full table (see --verylowmem if you need to run it in batches). This will increase the runtime.'),
+    parser.add_argument('--nthreads', default=1, help='Experimental! - Number of parallel workers for the compute-heavy steps: the worker processes running the --lowmem IID batches of plaintext -f files (limited by the CPUs and the available memory; their outputs are merged in batch order), without --lowmem the threads loading the -f (or -f/--f2 pairs of) files, and with --BuildIndex/--UpdateIndex the -f/--atc files indexed in parallel. The -i, -j and ophold reads have their own threads (--InputThreads). Default: "%(default)s" (sequential)'),
+    parser.add_argument('--InputThreads', default=1, help='Number of threads reading the -i, -j and ophold inputs in the background while the -f and --atc files are loaded, so that reads on e.g. a network filesystem overlap. The -f files are loaded with up to --nthreads threads of their own, so at most InputThreads + nthreads files are read at once. Default: "%(default)s" (sequential)'),
+    parser.add_argument('--lowmem', action='store_true', help='Experimental! - This will devide the -f file (if not an h5 indexed file) into groups of each 100.000 individuals (change by using --batchsize), run the phenotype on them, save it to file and then run the next 100k until the end. h5 indexed input (-f) will extract all IIDs that have the requested codes but will not load the full table (see --verylowmem if you need to run it in batches). Each batch reads only its own --atc rows (CSV through the byte-offset IID index, Parquet through the pushed-down IID filter); Stata --atc files are read once and sliced per batch. This will increase the runtime.'),
     parser.add_argument('--verylowmem', action='store_true', help='Experimental! - This will only change the behaviour for h5 indexed files. Plaintext files will behave as with the --lowmem flag. In here we apply the batchloading as of --lowmem to h5 files but only load those that have an overlapping requested code. This will increase the runtime.'),
     parser.add_argument('--batchsize', required=False, default=100000, help='Experimental! - This will set the batches (when --lowmem is set) to the desired value. Default: "%(default)s"'),
+    parser.add_argument('--spill', action='store_true', help='Experimental! - With --lowmem on plaintext -f files: read the -f file(s) once and split them into one temporary part file per IID batch (next to -o, removed afterwards) instead of seeking into -f for every batch. Useful with many batches (small --batchsize).'),
     parser.add_argument('--PSYK', action='store_true', help='Experimental! - To run only based on the PSYK diagnoses.'),
     parser.add_argument('--LPR', action='store_true', help='Experimental! - To run only based on the LPR diagnoses.'),
-    parser.add_argument('--BuildIndex', action='store_true', help='Build an initial index file. This applies to -f, and --atc files. Existing Index files will be overwritten.'),
+    parser.add_argument('--BuildIndex', action='store_true', help='Build an initial index file. This applies to -f, and --atc files; --f2 files are indexed as their record number join with the -f files (<f2 name>.joined.h5). Existing Index files will be overwritten.'),
+    parser.add_argument('--UpdateIndex', action='store_true', help='Update the index files built with --BuildIndex instead of rebuilding them: unchanged -f/--atc files are skipped, files that only had rows appended get just the new rows indexed, and all other files are re-indexed.'),
+    parser.add_argument('--BuildParquet', action='store_true', help='Write a typed Parquet copy (<name>.parquet, next to the original) of the -f, --f2, --atc, -i and -j files and exit. Passing the .parquet files in later runs skips CSV parsing and loads only the needed IIDs (requires pyarrow). Existing Parquet files will be overwritten.'),
+    parser.add_argument('--InputCache', required=False, default='', help='Directory for an on-disk cache of parsed input files (-i, -j, -f, --f2, --atc and the processed ophold file; -f files that are prefiltered on the requested codes while read are not cached). Entries are keyed on the file (path, size, mtime, SHA-256) and the parsing options (separators, --DateFormat, DayFirst, date columns), so later runs on unchanged files skip parsing. Stored as uncompressed Feather with pyarrow, read through a memory map with string columns kept Arrow-backed (string[pyarrow]), so they are not copied per process and concurrent runs on a node share the page cache; else as pickle. Default: "%(default)s" (no cache)')
+    parser.add_argument('--InputCacheGB', required=False, default=50, help='Size budget of --InputCache in GB; least recently used entries are removed beyond it. Default: "%(default)s"')
     parser.add_argument('--IndexDtypes', required=False, default='{"iidcol":"int","c_pattype":"float","c_adiag":"string","c_diagtype": "string","register":"string","source":"string","d_inddto":"datetime64[ns]","d_uddto":"datetime64[ns]"}', help='Set the dtype dict for your file that should be indexed. Default: "%(default)s"')
     parser.add_argument('--verbose', action='store_true', help='Verbose output')
 
@@ -7172,9 +9418,9 @@ if __name__ == '__main__':
          args.Fyob,args.Fgender,args.verbose,args.BuildTestSet,args.testRun,args.MatchFI,args.skipICDUpdate,
          args.DateFormat,args.iidstatus,args.iidstatusdate,args.selectIIDs,args.removePointInDiagCode,args.nthreads,args.name,args.BuildEntryExitDates,
          args.BuildOphold,args.write_pickle, args.write_fastGWA_format, args.write_Plink2_format,args.fDates,args.iDates,
-         args.MinMaxAge,args.ICDCM,args.lpp, args.RegisterRun, args.lowmem, args.verylowmem, args.batchsize, args.noLeadingICD, args.f2, 
+         args.MinMaxAge,args.ICDCM,args.lpp, args.RegisterRun, args.lowmem, args.verylowmem, args.batchsize, args.spill, args.noLeadingICD, args.f2, 
          args.recnum, args.recnum2, args.f2col, args.atc, args.atccol, args.atcdatecol, args.atcDates, args.LPR, args.PSYK, 
-         args.ophsep, args.Ophold, args.ini, args.ICD8, args.ICD9, args.ICD10, args.BuildIndex, args.IndexDtypes, args.icdprefix, argstring, default_args, default_argstring)
+         args.ophsep, args.Ophold, args.ini, args.ICD8, args.ICD9, args.ICD10, args.BuildIndex, args.IndexDtypes, args.BuildParquet, args.UpdateIndex, args.InputCache, args.InputCacheGB, args.InputThreads, args.icdprefix, argstring, default_args, default_argstring)
 
 # If wantig to start it locally in python and run through it step by step
 '''
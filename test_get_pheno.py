@@ -1,6 +1,8 @@
 
 import subprocess
 import hashlib
+import io
+import os
 import pandas as pd
 import numpy as np
 import pytest
@@ -28,6 +30,17 @@ def test_match_codes_exact_and_prefix():
     assert gp.match_codes(pd.Series(["ATC:N06A", "ATC:N06AB"]), ["ATC:N06A"], exact=False).tolist() == [True, True]
 
 
+def test_compiled_code_patterns_prune_prefixes_and_match_vocabulary():
+    compiled = gp.compile_code_patterns(["F3*", "F32", "F33.1*", "G40"], exact=True)
+    # F33.1 is covered by F3 and dropped; G40 stays an exact code
+    assert compiled["prefixes"].tolist() == ["F3"]
+    assert compiled["exact"] == {"F32", "G40"}
+    s = pd.Series(["F32", "F339", "G40", "G401", None, "E3", "F3"])
+    assert gp.vocabulary_code_mask(s, compiled).tolist() == [True, True, True, False, False, False, True]
+    # a lone "*" matches every non-missing code
+    assert gp.vocabulary_code_mask(s, gp.compile_code_patterns(["*"])).tolist() == [True, True, True, True, False, True, True]
+
+
 def test_wildcards_are_allowed_with_and_without_exact_match():
     df = pd.DataFrame({
         "iid": ["a", "b", "c", "d", "e", "f"],
@@ -365,6 +378,29 @@ def test_map_cases_and_build_phenotype_cases_basic():
     assert isinstance(merged, pd.DataFrame)
 
 
+def test_code_matcher_masks_match_map_cases_for_every_phenotype():
+    df = pd.DataFrame({
+        "iid": ["a", "b", "c", "d", "e", "f", "g"],
+        "diagnosis": ["F250", " F339", "F32.2", "F32.20", None, "G40", "ATC:N06A"],
+    })
+    pheno = pd.DataFrame({
+        "Disorder": ["SCZ", "MDD", "EPI"],
+        "Disorder Codes": [["F25*"], ["F33*", "F32.2", "ATC:N06A"], ["G40"]],
+    })
+    code_sets = gp.phenotype_code_sets(pheno)
+    assert code_sets["MDD_nonATC"] == ["F33*", "F32.2"]
+    for exact in (False, True):
+        matcher = gp.build_code_matcher(df, "diagnosis", exact, code_sets)
+        assert gp.code_matcher_applies(matcher, df.copy(), "diagnosis")
+        assert not gp.code_matcher_applies(matcher, df.iloc[1:], "diagnosis")
+        for codes in code_sets.values():
+            expected = gp.map_cases(codes, exact_match=exact, df1=df, diagcol="diagnosis")
+            got = gp.map_cases(codes, exact_match=exact, df1=df, diagcol="diagnosis", code_matcher=matcher)
+            assert got["iid"].tolist() == expected["iid"].tolist()
+    # code sets that were not known up front are compiled on first use
+    assert gp.code_matcher_mask(matcher, ["F3"]).tolist() == [False] * 7
+
+
 def test_process_ophold_minimal(tmp_path):
     # Build minimal stam and ophold tables
     stam = pd.DataFrame({"pnr": ["A", "B"], "fkode": [6000, 6000], "fkode_m": [6000, 6000], "fkode_f": [6000, 6000], "birthdate": [pd.Timestamp("1990-01-01"), pd.Timestamp("1980-01-01")]})
@@ -688,5 +724,730 @@ def test_generate_readme_uses_actual_checksum_file_name():
 
     assert "sha256sum -c ./result.checksums.sha256" in readme
     assert "sha256sum -c ./checksums.sha256" not in readme
+
+
+def test_categorized_code_columns_map_vocabulary_and_keep_missing():
+    df = pd.DataFrame({
+        "diagnosis": ["f32", "F32", None, "f33"],
+        "source": [1, 2, 3, 4],
+    })
+    df = gp.categorize_code_columns(df)
+    assert isinstance(df["diagnosis"].dtype, pd.CategoricalDtype)
+    assert df["source"].dtype.kind == "i"
+
+    upper = gp.map_code_vocabulary(df["diagnosis"], str.upper)
+    assert isinstance(upper.dtype, pd.CategoricalDtype)
+    assert sorted(upper.cat.categories) == ["F32", "F33"]
+    assert list(upper.iloc[[0, 1, 3]]) == ["F32", "F32", "F33"]
+    assert pd.isna(upper.iloc[2])
+
+    stripped = gp.map_code_vocabulary(pd.Series([" a", None, "b "]), str.strip)
+    assert stripped.iloc[0] == "a" and stripped.iloc[2] == "b"
+    assert pd.isna(stripped.iloc[1])
+
+
+def test_parquet_conversion_round_trips_and_pushes_down_iid_filter(tmp_path):
+    pytest.importorskip("pyarrow")
+    csv_path = tmp_path / "lpr.csv"
+    csv_path.write_text(
+        "pnr,diag,d_inddto,recnum\n"
+        "1,F32,2001-02-03,10\n"
+        "2,F33,2002-03-04,11\n"
+        "3,F32,2003-04-05,12\n",
+        encoding="utf-8",
+    )
+
+    written = gp.convert_to_parquet(str(csv_path), ",", ["d_inddto"], iidcol="pnr")
+    assert written == [str(tmp_path / "lpr.parquet")]
+
+    from_csv = gp.load_data_file(str(csv_path), ",", "", "", "", ["d_inddto"], iidcol="pnr")
+    from_parquet = gp.load_data_file(written[0], ",", "", "", "", ["d_inddto"], iidcol="pnr")
+    pd.testing.assert_frame_equal(from_csv, from_parquet)
+
+    subset = gp.load_data_file(written[0], ",", "", "", "", ["d_inddto"], iidcol="pnr",
+                               parquet_filters={"pnr": {"1", "3"}, "missing_col": ["x"]})
+    assert subset["pnr"].tolist() == ["1", "3"]
+    assert gp._read_input_header(written[0]) == ["pnr", "diag", "d_inddto", "recnum"]
+
+
+def test_iid_offset_index_reads_batch_rows_in_file_order(tmp_path):
+    csv_path = tmp_path / "lpr.csv"
+    csv_path.write_text(
+        "pnr,diag\n"
+        "1,F32\n"
+        "1,F33\n"
+        "2,F20\n"
+        "\n"
+        "3,F32\n"
+        "1.0,F10\n",
+        encoding="utf-8",
+    )
+
+    index = gp.get_iid_offset_index(str(csv_path), "pnr", sep=",")
+    assert (tmp_path / "lpr.csv.iidx.npz").exists()
+    assert list(index["iids"]) == ["1", "1", "2", "3"]
+
+    rows = pd.read_csv(io.BytesIO(gp.read_iid_rows(str(csv_path), index, ["3", "1"])), dtype=str)
+    assert rows.values.tolist() == [["1", "F32"], ["1", "F33"], ["3", "F32"], ["1.0", "F10"]]
+
+    loaded = gp.load_data_file(str(csv_path), ",", "", "", "", [], iidcol="pnr", iid_rows=["2"])
+    assert loaded["pnr"].tolist() == ["2"]
+    assert loaded["diag"].tolist() == ["F20"]
+
+
+def test_truncated_iid_index_sidecar_is_rebuilt(tmp_path):
+    csv_path = tmp_path / "lpr.csv"
+    csv_path.write_text("pnr,diag\n1,F32\n2,F20\n", encoding="utf-8")
+    sidecar = tmp_path / "lpr.csv.iidx.npz"
+    # a sidecar cut short by an interrupted writer is a broken zip archive
+    sidecar.write_bytes(b"PK\x03\x04broken")
+
+    index = gp.get_iid_offset_index(str(csv_path), "pnr", sep=",")
+    assert list(index["iids"]) == ["1", "2"]
+    with np.load(sidecar, allow_pickle=False) as stored:
+        assert list(stored["iids"]) == ["1", "2"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["lpr.csv", "lpr.csv.iidx.npz"]
+
+def test_unindexable_csv_falls_back_to_filtering_on_iid(tmp_path):
+    csv_path = tmp_path / "lpr.csv"
+    # the quoted line break makes rows and lines disagree, so no byte-offset index can be built
+    csv_path.write_text('pnr,diag,note\n1,F32,"a\nb"\n2,F20,c\n3,F32,d\n', encoding="utf-8")
+
+    assert gp.get_iid_offset_index(str(csv_path), "pnr", sep=",") is None
+    assert not gp.iid_offset_indexes_available(str(csv_path), "pnr", sep=",")
+    assert not (tmp_path / "lpr.csv.iidx.npz").exists()
+
+    loaded = gp.load_data_file(str(csv_path), ",", "", "", "", [], iidcol="pnr", iid_rows=["3", "1"])
+    assert loaded["pnr"].astype(str).tolist() == ["1", "3"]
+    assert loaded["note"].tolist() == ["a\nb", "d"]
+
+def test_spill_lpr_by_iid_batch_splits_rows_in_one_pass(tmp_path):
+    csv_path = tmp_path / "lpr.csv"
+    csv_path.write_text(
+        "pnr,diag\n1,F32\n9,F20\n2,F33\n3,F10\n1,F41\n",
+        encoding="utf-8",
+    )
+
+    parts = gp.spill_lpr_by_iid_batch(str(csv_path), "pnr", ",", ["1", "2", "3", "4"], 2,
+                                      str(tmp_path / "spill"), block_size=7)
+
+    assert len(parts) == 2
+    first = pd.read_csv(parts[0], dtype=str)
+    second = pd.read_csv(parts[1], dtype=str)
+    assert first.values.tolist() == [["1", "F32"], ["2", "F33"], ["1", "F41"]]
+    assert second.values.tolist() == [["3", "F10"]]
+
+    empty = gp.spill_lpr_by_iid_batch(str(csv_path), "pnr", ",", ["7", "8"], 1, str(tmp_path / "spill2"))
+    assert empty == ["", ""]
+
+
+def test_batch_workers_are_capped_by_batches_and_memory():
+    workers, cap = gp.plan_batch_workers(64, 3, 1)
+    assert 1 <= workers <= 3
+    assert cap > 0
+
+    workers, _ = gp.plan_batch_workers(64, 100, 10**18)
+    assert workers == 1
+
+
+def test_merge_batch_part_outputs_appends_parts_in_batch_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    outfile = str(tmp_path / "res.tsv")
+    with open(outfile, "w") as fh:
+        fh.write("IID\tdiagnosis\n0\tCase\n")
+    parts = [gp.batch_part_outfile(str(tmp_path), outfile, b) for b in (1, 2)]
+    for batch_num, part in zip((1, 2), parts):
+        with open(part, "w") as fh:
+            fh.write(f"IID\tdiagnosis\n{batch_num}\tControl\n")
+        with open(part + ".fgwa.pheno", "w") as fh:
+            fh.write(f"FID\tIID\tCaseControl\n{batch_num}\t{batch_num}\t0\n")
+    (tmp_path / "batch000002.res.sankey.tsv").write_text("last\n")
+
+    gp.merge_batch_part_outputs(parts, outfile)
+
+    assert open(outfile).read() == "IID\tdiagnosis\n0\tCase\n1\tControl\n2\tControl\n"
+    assert open(outfile + ".fgwa.pheno").read() == "FID\tIID\tCaseControl\n1\t1\t0\n2\t2\t0\n"
+    assert (tmp_path / "res.sankey.tsv").read_text() == "last\n"
+    assert not any(os.path.exists(part) for part in parts)
+def test_vectorized_multi_exclusion_matches_row_wise_reference(tmp_path):
+    rng = np.random.default_rng(7)
+    days = pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 2000, size=400), unit="D")
+    pool = [d.strftime("%Y-%m-%d") for d in days]
+
+    def _dates(k):
+        return list(rng.choice(pool, size=k))
+
+    rows = []
+    for i in range(40):
+        n_in = int(rng.integers(0, 5))
+        n_exc = int(rng.integers(0, 4))
+        in_dates = _dates(n_in)
+        exc_dates = _dates(n_exc)
+        rows.append({
+            "diagnosis": "Case" if i % 4 else "Control",
+            "diagnoses": [f"F32.{j}" for j in range(n_in)],
+            "in_dates": in_dates,
+            "Level2_diagnoses": [f"F32.{j}" for j in range(n_in)],
+            "Level2_dates": list(in_dates),
+            "DUD": ",".join(f"F10.{j}" for j in range(n_exc)),
+            "DUD_In_Dates": ",".join(exc_dates),
+            "diagnoses_Level2_modifier": ["F20"] if i % 5 == 0 else [],
+            "date_Level2_modifier": ["2001-01-01"] if i % 5 == 0 else [],
+            "disorder_Level2_modifier": ["SCZ"] if i % 5 == 0 else [],
+            "Level2_ExclusionReason": [],
+        })
+    df = pd.DataFrame(rows, index=pd.RangeIndex(100, 140))
+    args = ("DUD", "DUD_In_Dates", "DUD_Inflicted_changes", 7, "Level2_diagnoses", "Level2_dates",
+            "diagnoses_Level2_modifier", "date_Level2_modifier", "disorder_Level2_modifier")
+    # the in-dates come from merge_IIDs: Timestamp lists before, day-number lists now
+    df_ts, df_days = df.copy(), df.copy()
+    for col in ("in_dates", "Level2_dates"):
+        df_ts[col] = pd.Series([list(pd.to_datetime(x)) for x in df[col]], index=df.index, dtype=object)
+        df_days[col] = pd.Series([gp.dates_to_day_numbers(x) for x in df_ts[col]], index=df.index, dtype=object)
+
+    def _written(frame, name):
+        # cell text as the output writer puts it into the TSV (before the reformat_to_tsv pass)
+        path = tmp_path / name
+        gp.sanitize_tsv_cells(gp.format_day_list_columns(frame)).to_csv(path, sep="\t", index=False)
+        return path.read_text()
+
+    for etype in ("1yprior", "post", "lifetime"):
+        for source, ref_source in ((df, df), (df_days, df_ts)):
+            new = gp.update_DxDates_multi_exclusion(source, etype, *args)
+            ref = gp.update_DxDates_multi_exclusion_old(ref_source, etype, *args)
+            assert list(new.columns) == list(ref.columns)
+            assert _written(new, "new.tsv") == _written(ref, "ref.tsv"), etype
+
+
+def test_merge_iids_reduces_dates_on_day_numbers():
+    days = gp.dates_to_day_numbers(pd.Series(["1970-01-02", None, "2020-02-29"]))
+    assert days.dtype == np.int32
+    assert days.tolist() == [1, gp.DAY_NUMBER_NA, 18321]
+    assert gp.day_numbers_to_dates(days).isna().tolist() == [False, True, False]
+
+    df = pd.DataFrame({
+        "pnr": ["a", "a", "a", "b"],
+        "diag": ["F32", "F33", "F32", "F33"],
+        "date_in": ["2020-01-05", "2020-01-01", "2020-01-05", None],
+        "date_out": ["2020-01-06", "2020-01-02", "2020-01-09", None],
+    })
+    out = gp.merge_IIDs(df, "diag", "birthdate", "date_in", "date_out", "pnr", False, Cases=True).set_index("pnr")
+    assert out.loc["a", "first_dx"] == pd.Timestamp("2020-01-01")
+    assert out.loc["a", "last_dx"] == pd.Timestamp("2020-01-09")
+    assert out.loc["a", "n_diags"] == 3 and out.loc["a", "n_unique_in_days"] == 2
+    assert pd.isna(out.loc["b", "first_dx"]) and out.loc["b", "n_unique_in_days"] == 0
+
+    # in/out dates stay int32 day numbers in one shared buffer until written
+    in_a, in_b = out.loc["a", "in_dates"], out.loc["b", "in_dates"]
+    assert gp.is_day_list(in_a) and in_a.tolist() == [18266, 18262, 18266]
+    assert in_a.base is not None and in_a.base is in_b.base and in_b.tolist() == [gp.DAY_NUMBER_NA]
+    written = gp.format_day_list_columns(out[["in_dates"]])["in_dates"]
+    assert written["b"] == "[NaT]" and written["a"] == str([pd.Timestamp("2020-01-05"), pd.Timestamp("2020-01-01"), pd.Timestamp("2020-01-05")])
+
+    # times of day are kept as Timestamps
+    df["date_in"] = ["2020-01-05 10:30", "2020-01-01", "2020-01-05", None]
+    out = gp.merge_IIDs(df, "diag", "birthdate", "date_in", "date_out", "pnr", False, Cases=True).set_index("pnr")
+    assert out.loc["a", "in_dates"][0] == pd.Timestamp("2020-01-05 10:30")
+
+
+def test_single_pass_merge_iids_matches_joined_groupbys():
+    rng = np.random.default_rng(3)
+    n = 60
+    dates = [None if rng.random() < 0.2 else (pd.Timestamp("2000-01-01") + pd.Timedelta(days=int(rng.integers(0, 3000)))).strftime("%Y-%m-%d")
+             for _ in range(n)]
+    df = pd.DataFrame({
+        "pnr": rng.choice(["a", "b", "c", "d", None], size=n),
+        "diag": rng.choice(["F32", "F33"], size=n),
+        "date_in": dates,
+        "date_out": dates[::-1],
+        "source": rng.choice(["x", "y"], size=n),
+    })
+    for cases, covariates in ((True, False), (False, True)):
+        kwargs = dict(Cases=cases, Covariates=covariates, extra_cols_to_keep=["source"])
+        new = gp.format_day_list_columns(gp.merge_IIDs(df.copy(), "diag", "birthdate", "date_in", "date_out", "pnr", False, **kwargs))
+        ref = gp.merge_IIDs_old(df.copy(), "diag", "birthdate", "date_in", "date_out", "pnr", False, **kwargs)
+        assert list(new.columns) == list(ref.columns)
+        assert list(new.dtypes) == list(ref.dtypes)
+        for col in new.columns:
+            assert [str(x) for x in new[col]] == [str(x) for x in ref[col]], col
+
+
+def test_h5_where_selection_matches_streaming(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    n = 3000
+    codes = np.array(["ICD10:DF32", "ICD10:DF321", "DF33", "ICD10-DF330", "F32", "ICD8:29699", "DG40", "DF329 "])
+    df = pd.DataFrame({"pnr": rng.integers(1, 300, size=n).astype(str), "c_adiag": rng.choice(codes, size=n)})
+    df.loc[::7, "pnr"] = df.loc[::7, "pnr"] + ".0"
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"])
+    h5p = str(tmp_path / "lpr.h5")
+
+    cases = [(None, ["DF32"], True), (["5", "17", "250"], ["ICD10:DF32"], False),
+             ([str(i) for i in range(100, 200)], None, False), (None, ["DF32", "ICD8:296*"], False)]
+    pushed = []
+    for iids, diags, prefix_all in cases:
+        with pd.HDFStore(h5p, "r") as store:
+            compiled = gp.compile_code_patterns(diags, exact=not prefix_all) if diags else None
+            pushed.append(gp.h5_candidate_coordinates(store, "df", "pnr", iids, "c_adiag", compiled))
+        got = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", diags, prefix_all=prefix_all)
+        with monkeypatch.context() as m:
+            m.setattr(gp, "h5_candidate_coordinates", lambda *a, **k: None)
+            expected = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", diags, prefix_all=prefix_all)
+        pd.testing.assert_frame_equal(got, expected)
+    assert all(c is not None and len(c) < n for c in pushed)
+
+
+def test_sorted_h5_index_with_zone_map_skips_blocks(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    n = 2000
+    df = pd.DataFrame({
+        "pnr": rng.integers(1, 400, size=n).astype(str),
+        "c_adiag": rng.choice(["ICD10:DF32", "ICD10:DF33", "DF331", "DG40", "DZ01"], size=n),
+        "row": np.arange(n).astype(str),
+    })
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=500, zone_block_rows=100)
+    h5p = str(tmp_path / "lpr.h5")
+    with pd.HDFStore(h5p, "r") as store:
+        stored = store.select("df")
+        zones = gp.h5_zone_map(store, "df")
+    assert len(stored) == n and list(stored.index) == list(range(n))
+    # clustered by IID, file order kept within an IID
+    assert stored["pnr"].tolist() == sorted(stored["pnr"])
+    assert (stored.groupby("pnr")["row"].apply(lambda r: r.astype(int).is_monotonic_increasing)).all()
+    assert len(zones) == 20 and zones["iid_min"].is_monotonic_increasing
+
+    iids = ["17", "18", "19"]
+    keep = gp.zone_map_blocks(zones, iids, None)
+    assert 0 < keep.sum() < len(zones)
+    got = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", None)
+    with monkeypatch.context() as m:
+        m.setattr(gp, "h5_zone_map", lambda *a, **k: None)
+        m.setattr(gp, "h5_candidate_coordinates", lambda *a, **k: None)
+        expected = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", None)
+    pd.testing.assert_frame_equal(got, expected)
+    assert sorted(got["row"].astype(int)) == sorted(df.index[df["pnr"].isin(iids)])
+
+
+def test_h5_code_index_answers_prefix_requests_from_postings(tmp_path, monkeypatch):
+    rng = np.random.default_rng(11)
+    n = 1500
+    df = pd.DataFrame({
+        "pnr": rng.integers(1, 200, size=n).astype(str),
+        "c_adiag": rng.choice(["ICD10:DF32", "ICD10:DF321", "DF33", " DF329", "ICD10-DF330", "DG40", "F32"], size=n),
+    })
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=400)
+    h5p = str(tmp_path / "lpr.h5")
+    with pd.HDFStore(h5p, "r") as store:
+        vocab = store.get("df_codes")
+        directory = store.select("df_postings_dir")
+        stored = store.select("df")
+    assert sorted(vocab["code"]) == sorted(stored["c_adiag"].unique())
+    assert int(directory["stop"].iloc[-1]) == n
+    assert (directory["start"].to_numpy()[1:] == directory["stop"].to_numpy()[:-1]).all()
+
+    def _no_range_queries(*a, **k):
+        raise AssertionError("code index should answer code requests")
+
+    for diags, prefix_all in ((["DF32"], True), (["ICD10:DF33"], False), (["DF33*", "G40"], False)):
+        with monkeypatch.context() as m:
+            m.setattr(gp, "h5_candidate_coordinates", _no_range_queries)
+            got = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", None, "c_adiag", diags, prefix_all=prefix_all)
+        with monkeypatch.context() as m:
+            for name in ("h5_code_coordinates", "h5_candidate_coordinates", "h5_zone_map"):
+                m.setattr(gp, name, lambda *a, **k: None)
+            expected = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", None, "c_adiag", diags, prefix_all=prefix_all)
+        pd.testing.assert_frame_equal(got, expected)
+
+
+def test_h5_code_coordinates_reads_only_postings_of_kept_rows(tmp_path, monkeypatch):
+    rng = np.random.default_rng(12)
+    df = pd.DataFrame({"pnr": rng.integers(1, 100, size=400).astype(str),
+                       "c_adiag": rng.choice(["DF32", "DF33", "DG40"], size=400)})
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=100, zone_block_rows=50)
+    h5p = str(tmp_path / "lpr.h5")
+    compiled = gp.compile_code_patterns(["DF33"], exact=True)
+    with pd.HDFStore(h5p, "a") as store:
+        gp.build_h5_code_index(store, "df", "c_adiag", block_rows=50)
+        assert "code_id" in store.get_storer("df_postings_dir").data_columns
+        every = gp.h5_code_coordinates(store, "df", compiled)
+        part = gp.h5_code_coordinates(store, "df", compiled, row_ranges=[(100, 150), (300, 350)])
+        assert len(gp.h5_code_coordinates(store, "df", compiled, row_ranges=[])) == 0
+    in_ranges = ((every >= 100) & (every < 150)) | ((every >= 300) & (every < 350))
+    assert part.tolist() == every[in_ranges].tolist()
+
+    # a batch of IIDs reads only the posting lists of its zone-map blocks and still finds every row
+    iids = sorted(df["pnr"].unique())[10:20]
+    got = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", ["DF33"], prefix_all=False)
+    with monkeypatch.context() as m:
+        for name in ("h5_code_coordinates", "h5_candidate_coordinates", "h5_zone_map"):
+            m.setattr(gp, name, lambda *a, **k: None)
+        expected = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", iids, "c_adiag", ["DF33"], prefix_all=False)
+    pd.testing.assert_frame_equal(got, expected)
+    assert len(got) > 0
+
+def test_h5_code_index_skips_missing_codes(tmp_path):
+    df = pd.DataFrame({"pnr": ["1", "2", "3", "4"], "c_adiag": ["DF32", None, "DG40", None]})
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], zone_block_rows=2)
+    with pd.HDFStore(str(tmp_path / "lpr.h5"), "r") as store:
+        assert sorted(store.get("df_codes")["code"]) == ["DF32", "DG40"]
+        assert sorted(store.select("df_postings")["row"]) == [0, 2]
+        assert len(gp.h5_code_coordinates(store, "df", gp.compile_code_patterns(["NAN"], exact=False))) == 0
+        zones = gp.h5_zone_map(store, "df")
+    # the zone map bounds skip missing codes as well
+    assert zones[["diag_min", "diag_max"]].values.tolist() == [["DF32", "DF32"], ["DG40", "DG40"]]
+
+def test_update_index_appends_only_new_rows(tmp_path, monkeypatch):
+    rng = np.random.default_rng(2)
+
+    def _rows(n, start):
+        return pd.DataFrame({
+            "pnr": rng.integers(1, 50, size=n).astype(str),
+            "c_adiag": rng.choice(["ICD10:DF32", "ICD10:DF33", "DG40"], size=n),
+            "row": np.arange(start, start + n).astype(str),
+        })
+
+    csvp = tmp_path / "lpr.csv"
+    h5p = str(tmp_path / "lpr.h5")
+    first = _rows(300, 0)
+    first.to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=100, zone_block_rows=50)
+
+    # unchanged source: nothing is re-read
+    monkeypatch.setattr(gp, "_index_source_meta", lambda *a, **k: pytest.fail("unchanged file was re-indexed"))
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=100, zone_block_rows=50, update=True)
+
+    # grown source: only the appended rows are parsed and added
+    more = _rows(120, 300)
+    more.to_csv(csvp, index=False, header=False, mode="a")
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=100, zone_block_rows=50, update=True)
+    with pd.HDFStore(h5p, "r") as store:
+        stored = store.select("df")
+        zones = gp.h5_zone_map(store, "df")
+        directory = store.select("df_postings_dir")
+        meta = getattr(store.get_storer("df").attrs, gp.H5_INDEX_META_ATTR)
+    assert sorted(stored["row"].astype(int)) == list(range(420))
+    assert list(stored.index) == list(range(420))
+    assert zones["stop"].iloc[-1] == 420 and int(directory["stop"].iloc[-1]) == 420
+    assert meta["size"] == os.path.getsize(csvp)
+    got = gp.select_by_iid_and_diag_optimized(h5p, "df", "pnr", ["7", "8"], "c_adiag", ["ICD10:DF33"], prefix_all=False)
+    both = pd.concat([first, more])
+    expected_rows = both[both["pnr"].isin(["7", "8"]) & (both["c_adiag"] == "ICD10:DF33")]["row"]
+    assert sorted(got["row"]) == sorted(expected_rows)
+
+    # rewritten source: re-indexed from scratch
+    monkeypatch.undo()
+    _rows(50, 0).to_csv(csvp, index=False)
+    gp.index_diag_file(str(csvp), ["pnr", "c_adiag"], chunksize=100, zone_block_rows=50, update=True)
+    with pd.HDFStore(h5p, "r") as store:
+        assert store.get_storer("df").nrows == 50
+
+
+def test_index_diag_files_parallel_matches_sequential(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    jobs = []
+    for name, diagcol in (("lpr", "c_adiag"), ("psyk", "c_adiag"), ("atc", "atc")):
+        pd.DataFrame({
+            "pnr": rng.integers(1, 40, size=200).astype(str),
+            diagcol: rng.choice(["DF32", "DF33", "N06A"], size=200),
+        }).to_csv(tmp_path / f"{name}.csv", index=False)
+        jobs.append((str(tmp_path / f"{name}.csv"), ["pnr", diagcol]))
+
+    gp.index_diag_files(jobs, workers=1, chunksize=70)
+    sequential = {}
+    for path, _ in jobs:
+        h5p = path[:-len(".csv")] + ".h5"
+        sequential[h5p] = pd.read_hdf(h5p, "df")
+        os.remove(h5p)
+
+    monkeypatch.setattr(gp.os, "cpu_count", lambda: 4)
+    gp.index_diag_files(jobs, workers=3, chunksize=70)
+    for h5p, expected in sequential.items():
+        pd.testing.assert_frame_equal(pd.read_hdf(h5p, "df"), expected)
+
+
+def test_secondary_join_index_matches_merge(tmp_path):
+    rng = np.random.default_rng(4)
+    lpr = pd.DataFrame({
+        "pnr": rng.integers(1, 30, size=150).astype(str),
+        "recnum": np.arange(150).astype(str),
+        "c_adiag": rng.choice(["DF32", "DF33", "DG40"], size=150),
+        "c_diagtype": rng.choice(["A", "B", "+"], size=150),
+        "c_tildiag": rng.choice(["DF329", "DZ00"], size=150),
+    })
+    lpr2nd = pd.DataFrame({
+        "recnum2": rng.integers(0, 200, size=300).astype(str),
+        "c_diag2": rng.choice(["DF32", "DF41", "DG40"], size=300),
+    })
+    lpr.to_csv(tmp_path / "lpr.csv", index=False)
+    lpr2nd.to_csv(tmp_path / "lpr2nd.csv", index=False)
+
+    joined_h5 = gp.build_secondary_join_index(str(tmp_path / "lpr.csv"), str(tmp_path / "lpr2nd.csv"), ",", "pnr", "c_adiag",
+                                              "recnum", "recnum2", "c_diag2", n_buckets=3, chunksize=70)
+    assert joined_h5 == gp.h5_secondary_join_path(str(tmp_path / "lpr2nd.csv"))
+    assert not os.path.exists(tmp_path / "lpr2nd.joined.csv")
+
+    merged = gp.merge_secondary_diagnoses(lpr.copy(), lpr2nd.copy(), "c_adiag", "recnum", "recnum2", "c_diag2").iloc[len(lpr):]
+    stored = pd.read_hdf(joined_h5, "df")
+    key = ["pnr", "recnum", "c_adiag"]
+    assert sorted(map(tuple, stored[key].astype(str).values)) == sorted(map(tuple, merged[key].astype(str).values))
+
+    got = gp.select_by_iid_and_diag_optimized(joined_h5, "df", "pnr", ["3", "4"], "c_adiag", ["DF41"], prefix_all=False)
+    expected = merged[merged["pnr"].isin(["3", "4"]) & (merged["c_adiag"] == "DF41")]
+    assert sorted(got["recnum"]) == sorted(expected["recnum"])
+
+
+def test_secondary_join_store_selects_by_secondary_code(tmp_path):
+    # record 0 has a requested secondary code, while its own -f code is not requested
+    lpr = pd.DataFrame({"pnr": ["1", "2"], "recnum": ["0", "1"], "c_adiag": ["DG40", "DF32"],
+                        "c_diagtype": ["A", "A"], "c_tildiag": ["DZ00", "DZ00"]})
+    lpr2nd = pd.DataFrame({"recnum2": ["0", "1"], "c_diag2": ["DF32", "DG40"]})
+    lpr.to_csv(tmp_path / "lpr.csv", index=False)
+    lpr2nd.to_csv(tmp_path / "lpr2nd.csv", index=False)
+    joined_h5 = gp.build_secondary_join_index(str(tmp_path / "lpr.csv"), str(tmp_path / "lpr2nd.csv"), ",", "pnr", "c_adiag",
+                                              "recnum", "recnum2", "c_diag2")
+
+    got = gp.get_h5_cases(h5file=joined_h5, iids=[], iidcol="pnr", diags=["DF32"], diagcol="c_adiag", directmapping=True)
+    assert got["recnum"].astype(str).tolist() == ["0"]
+
+    # the same secondary row the CSV path matches after merge_secondary_diagnoses
+    merged = gp.merge_secondary_diagnoses(lpr.copy(), lpr2nd.copy(), "c_adiag", "recnum", "recnum2", "c_diag2")
+    hits = gp.map_cases(["DF32"], True, merged, "c_adiag")
+    assert hits.loc[hits.index >= len(lpr), "recnum"].tolist() == ["0"]
+
+def test_h5_input_stores_pairs_join_stores_per_file(tmp_path):
+    lpr_files = ",".join(str(tmp_path / f) for f in ("psyk.csv", "lpr.csv"))
+    lpr2nd_files = ",".join(str(tmp_path / f) for f in ("psyk2nd.csv", "lpr2nd.csv"))
+    assert gp.h5_input_stores(lpr_files, lpr2nd_files) == ([], [])
+
+    for name in ("psyk.h5", "lpr.h5", "psyk2nd.joined.h5"):
+        (tmp_path / name).touch()
+    h5_files = [str(tmp_path / "psyk.h5"), str(tmp_path / "lpr.h5")]
+    # a missing join store means the --f2 files are read as such
+    assert gp.h5_input_stores(lpr_files, lpr2nd_files) == (h5_files, [])
+
+    (tmp_path / "lpr2nd.joined.h5").touch()
+    assert gp.h5_input_stores(lpr_files, lpr2nd_files) == (h5_files, [str(tmp_path / "psyk2nd.joined.h5"), str(tmp_path / "lpr2nd.joined.h5")])
+    assert gp.h5_input_stores(lpr_files, "") == (h5_files, [])
+
+def test_read_rows_with_keys_streams_matching_rows(tmp_path):
+    df = pd.DataFrame({"recnum": [str(i) for i in range(25)], "diag": [f"D{i % 4}" for i in range(25)]})
+    p = tmp_path / "lpr2nd.tsv"
+    df.to_csv(p, sep="\t", index=False)
+    got = gp.read_rows_with_keys(str(p), "recnum", [3, "7", 24, 99], sep="\t", chunksize=4)
+    assert got["recnum"].tolist() == ["3", "7", "24"]
+    assert got["diag"].tolist() == ["D3", "D3", "D0"]
+    empty = gp.read_rows_with_keys(str(p), "recnum", ["99"], sep="\t", chunksize=4)
+    assert empty.empty and list(empty.columns) == ["recnum", "diag"]
+
+
+def test_input_cache_skips_parsing_and_evicts(tmp_path, monkeypatch):
+    csvp = tmp_path / "stam.csv"
+    pd.DataFrame({"pnr": ["1", "2", "3"], "birthdate": ["2000-01-02", None, "1999-12-31"], "sex": ["M", None, "F"]}).to_csv(csvp, index=False)
+    monkeypatch.setattr(gp, "INPUT_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(gp, "dta_input", False, raising=False)
+    monkeypatch.setattr(gp, "DateFormat", "%Y-%m-%d", raising=False)
+    monkeypatch.setattr(gp, "DayFirst", False, raising=False)
+
+    def _load():
+        return gp.load_data_file(str(csvp), ",", "birthdate", "", "sex", ["birthdate"], iidcol="pnr")
+
+    first = _load()
+    real_read = gp._read_csv_input
+    monkeypatch.setattr(gp, "_read_csv_input", lambda *a, **k: pytest.fail("cached file was parsed again"))
+    pd.testing.assert_frame_equal(_load(), first)
+
+    # other parsing options miss the cache
+    monkeypatch.setattr(gp, "_read_csv_input", real_read)
+    gp.load_data_file(str(csvp), ",", "birthdate", "", "sex", [], iidcol="pnr")
+    entries = [f for f in os.listdir(tmp_path / "cache") if f != gp.INPUT_CACHE_FINGERPRINTS]
+    assert len(entries) == 2
+
+    # a budget below two entries keeps only the most recently written one
+    monkeypatch.setattr(gp, "INPUT_CACHE_MAX_BYTES", max(os.path.getsize(tmp_path / "cache" / f) for f in entries))
+    csvp.write_text(csvp.read_text() + "4,2001-01-01,M\n")
+    assert len(_load()) == 4
+    assert len([f for f in os.listdir(tmp_path / "cache") if f != gp.INPUT_CACHE_FINGERPRINTS]) == 1
+
+
+@pytest.mark.skipif(gp.pa is None, reason="needs pyarrow")
+def test_read_feather_mapped_keeps_strings_arrow_backed(tmp_path):
+    df = pd.DataFrame({"pnr": ["1", None, "3"], "n": [1, 2, 3], "d": pd.to_datetime(["2020-01-01", None, "2021-05-06"])})
+    path = tmp_path / "frame.feather"
+    df.to_feather(path, compression="uncompressed")
+    got = gp.read_feather_mapped(str(path))
+    assert got["pnr"].dtype == pd.StringDtype("pyarrow")
+    assert got["pnr"].tolist() == ["1", pd.NA, "3"]
+    pd.testing.assert_frame_equal(got.drop(columns="pnr"), df.drop(columns="pnr"))
+
+    # the string buffers stay in the mapped file instead of being copied into Arrow's memory pool
+    codes = pd.DataFrame({"diag": [f"DF{i:06d}" for i in range(100_000)]})
+    codes.to_feather(path, compression="uncompressed")
+    before = gp.pa.total_allocated_bytes()
+    got = gp.read_feather_mapped(str(path))
+    assert gp.pa.total_allocated_bytes() - before < 100_000
+    assert got["diag"].iloc[-1] == "DF099999"
+
+def test_load_data_file_projects_needed_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(gp, "DateFormat", "%Y-%m-%d", raising=False)
+    monkeypatch.setattr(gp, "DayFirst", False, raising=False)
+    df = pd.DataFrame({"pnr": ["1", "2"], "c_adiag": ["DF32", "DF33"], "d_inddto": ["2001-02-03", "2002-03-04"],
+                       "c_sgh": ["x", "y"], "c_afd": ["a", "b"]})
+    needed = gp.lpr_columns_needed("pnr", "c_adiag", "d_inddto", "d_uddto", "c_diagtype", "recnum")
+    assert {"pnr", "c_adiag", "d_inddto", "c_pattype", "c_tildiag"} <= set(needed)
+    # rule-based matching drops duplicate rows on all their columns, so it reads every column
+    assert gp.lpr_columns_needed("pnr", "c_adiag", "d_inddto", "d_uddto", "c_diagtype", "recnum",
+                                 codes=["F32", "main=F32;sub=F10"]) is None
+
+    csvp = tmp_path / "lpr.csv"
+    df.to_csv(csvp, index=False)
+    monkeypatch.setattr(gp, "dta_input", False, raising=False)
+    got = gp.load_data_file(str(csvp), ",", "", "", "", ["d_inddto"], iidcol="pnr", usecols=needed)
+    assert list(got.columns) == ["pnr", "c_adiag", "d_inddto"]
+    assert pd.api.types.is_datetime64_any_dtype(got["d_inddto"])
+
+    dtap = tmp_path / "lpr.dta"
+    df.to_stata(dtap, write_index=False)
+    monkeypatch.setattr(gp, "dta_input", True, raising=False)
+    got = gp.load_data_file(str(dtap), ",", "", "", "", [], iidcol="pnr", usecols=needed)
+    assert list(got.columns) == ["pnr", "c_adiag", "d_inddto"]
+
+
+def test_lpr_columns_needed_reads_every_renamed_extra_column():
+    needed = gp.lpr_columns_needed("pnr", "c_adiag", "d_inddto", "d_uddto", "c_diagtype", "recnum")
+    assert {"c_indm", "c_pattype", "source", "diag_source"} <= set(needed)
+
+    raw = pd.DataFrame({c: ["x"] for c in needed})
+    kept = gp.finalize_lpr_data(raw[needed].copy(), "c_adiag", "", "c_diagtype", False)
+    assert set(gp.NON_ATC_EXTRA_COLUMNS) <= set(kept.columns)
+    got = gp.finalize_lpr_data(pd.DataFrame({"source": ["LPR2"], "diag_source": ["A"]}), "c_adiag", "", "c_diagtype", False)
+    assert got.to_dict("records") == [{"register": "LPR2", "source": "A"}]
+
+def test_to_datetime_series_matches_robust_parser(monkeypatch):
+    rng = np.random.default_rng(5)
+    days = pd.to_datetime("1990-01-01") + pd.to_timedelta(rng.integers(0, 12000, size=400), unit="D")
+    iso = pd.Series(days.strftime("%Y-%m-%d"), dtype=object)
+    dmy = pd.Series(days.strftime("%d/%m/%Y"), dtype=object)
+    messy = dmy.copy()
+    messy.iloc[::7] = np.nan
+    messy.iloc[3::11] = days[3::11].strftime("%Y%m%d") + ".0"
+    messy.iloc[5::13] = " " + messy.iloc[5::13].astype(str) + " "
+    messy.iloc[9::17] = "unknown"
+    monkeypatch.setattr(gp, "_DATE_FORMAT_CACHE", {})
+    for col in (iso, dmy, messy):
+        for fmt, dayfirst in ((None, True), (None, False), ("%d/%m/%Y", True), ("%Y-%m-%d", False)):
+            expected = gp._to_datetime_series_robust(col, fmt=fmt, dayfirst=dayfirst)
+            got = gp._to_datetime_series(col, fmt=fmt, dayfirst=dayfirst, cache_key=("file", id(col)))
+            pd.testing.assert_series_equal(got, expected, check_names=False)
+    assert gp._DATE_FORMAT_CACHE[("file", id(dmy), None, True)] == "%d/%m/%Y"
+    assert gp._DATE_FORMAT_CACHE[("file", id(iso), "%d/%m/%Y", True)] is None
+
+
+def test_process_lpr_data_prefilter_streams_matching_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(gp, "DateFormat", "%Y-%m-%d", raising=False)
+    monkeypatch.setattr(gp, "DayFirst", False, raising=False)
+    monkeypatch.setattr(gp, "dta_input", False, raising=False)
+    monkeypatch.setattr(gp, "LOAD_CHUNK_ROWS", 2)
+    lpr = pd.DataFrame({"pnr": ["1", "1", "2", "3", "4", "5"],
+                        "recnum": [10, 11, 12, 13, 14, 15],
+                        "c_adiag": ["ICD10:DF32.1", "DJ45", "F33", "ICD10:DI10", "DZ00", "DF329"],
+                        "d_inddto": ["2001-02-03"] * 6})
+    lpr2 = pd.DataFrame({"recnum": [11, 13, 14], "c_diag2": ["DF331", "DJ45", "DE11"]})
+    lprp, lpr2p = tmp_path / "lpr.csv", tmp_path / "lpr2.csv"
+    lpr.to_csv(lprp, sep="\t", index=False)
+    lpr2.to_csv(lpr2p, sep="\t", index=False)
+
+    assert gp.compile_lpr_prefilter(["main=F32;sub=T36"]) is None
+    assert gp.compile_lpr_prefilter(["ICD10:DF3*", "*"]) is None
+    prefilter = gp.compile_lpr_prefilter(["ICD10:DF32", "ICD10-CM:F33.1"])
+    args = (str(lprp), str(lpr2p), False, "\t", ["d_inddto"], "%Y-%m-%d", [], "c_adiag", "c_diag2", "recnum", "recnum", "pnr")
+    full = gp.process_lpr_data(*args)
+    got = gp.process_lpr_data(*args, prefilter=prefilter)
+    # record 11 is kept for its --f2 code DF331; DJ45/DI10/DZ00 and the unmatched --f2 rows are dropped
+    assert sorted(got["recnum"].tolist()) == [10, 11, 11, 15]
+    matched = full[gp.lpr_prefilter_mask(full, ["c_adiag"], prefilter)]
+    keys = ["recnum", "c_adiag"]
+    pd.testing.assert_frame_equal(got[gp.lpr_prefilter_mask(got, ["c_adiag"], prefilter)].sort_values(keys).reset_index(drop=True),
+                                  matched.sort_values(keys).reset_index(drop=True))
+    assert pd.api.types.is_datetime64_any_dtype(got["d_inddto"])
+
+    if gp.pa_dataset is not None:
+        pqp = tmp_path / "lpr.parquet"
+        lpr.to_parquet(pqp, index=False)
+        got = gp.load_data_file(str(pqp), "\t", "", "", "", [], iidcol="pnr",
+                                row_filter=lambda chunk: gp.lpr_prefilter_mask(chunk, ["c_adiag"], prefilter))
+        assert got["recnum"].tolist() == [10, 15]
+
+
+def test_process_lpr_data_concurrent_shards_match_sequential(tmp_path, monkeypatch):
+    monkeypatch.setattr(gp, "DateFormat", "%Y-%m-%d", raising=False)
+    monkeypatch.setattr(gp, "DayFirst", False, raising=False)
+    monkeypatch.setattr(gp, "dta_input", False, raising=False)
+    monkeypatch.setattr(gp.os, "cpu_count", lambda: 4)
+    shards, shards2 = [], []
+    for year in range(5):
+        lpr = pd.DataFrame({"pnr": [f"{year}{i}" for i in range(4)], "recnum": [year * 10 + i for i in range(4)],
+                            "c_adiag": ["DF32", "DJ45", "DF33", "DI10"], "d_inddto": [f"20{10 + year}-01-0{i + 1}" for i in range(4)]})
+        lpr2 = pd.DataFrame({"recnum": [year * 10 + 1], "c_diag2": ["DF331"]})
+        shards.append(str(tmp_path / f"lpr{year}.csv"))
+        shards2.append(str(tmp_path / f"lpr2_{year}.csv"))
+        lpr.to_csv(shards[-1], sep="\t", index=False)
+        lpr2.to_csv(shards2[-1], sep="\t", index=False)
+    for f2 in ("", ",".join(shards2)):
+        args = (",".join(shards), f2, False, "\t", ["d_inddto"], "%Y-%m-%d", [], "c_adiag", "c_diag2", "recnum", "recnum", "pnr")
+        sequential = gp.process_lpr_data(*args)
+        concurrent = gp.process_lpr_data(*args, workers=3)
+        pd.testing.assert_frame_equal(concurrent, sequential)
+        assert len(sequential) == 20 + (5 if f2 else 0)
+
+
+def test_submit_input_loads_overlaps_reads_and_defers_errors():
+    import threading
+    barrier = threading.Barrier(3, timeout=5)
+
+    def read(name):
+        barrier.wait()  # only passes if all three reads run at the same time
+        return name.upper()
+
+    def fail():
+        raise SystemExit(1)
+
+    loads = gp.submit_input_loads({n: (lambda n=n: read(n)) for n in ("stam", "addition", "ophold")}, workers=3)
+    assert {n: f.result() for n, f in loads.items()} == {"stam": "STAM", "addition": "ADDITION", "ophold": "OPHOLD"}
+    order = []
+    loads = gp.submit_input_loads({"stam": fail, "lpr": lambda: order.append("lpr") or 1}, workers=1)
+    assert order == ["lpr"] and loads["lpr"].result() == 1
+    with pytest.raises(SystemExit):
+        loads["stam"].result()
+
+
+def test_atc_batch_rows_match_slice_of_loaded_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(gp, "DateFormat", "%Y-%m-%d", raising=False)
+    monkeypatch.setattr(gp, "DayFirst", False, raising=False)
+    monkeypatch.setattr(gp, "dta_input", False, raising=False)
+    rng = np.random.default_rng(11)
+    atc = pd.DataFrame({"pnr": rng.integers(1000, 1100, size=300).astype(str),
+                        "atc": rng.choice(["N06AB06", "N05AH03", "A10BA02"], size=300),
+                        "eksd": pd.Timestamp("2005-01-01") + pd.to_timedelta(rng.integers(0, 3000, size=300), unit="D")})
+    atc["eksd"] = atc["eksd"].dt.strftime("%Y-%m-%d")
+    path = tmp_path / "atc.csv"
+    atc.to_csv(path, index=False)
+    loaded_once = gp.load_data_file(str(path), ",", "", "atc", "", ["eksd"], iidcol="pnr")
+    for batch in ({"1003", "1050", "1099"}, {str(i) for i in range(1000, 1040)}):
+        # what process_pheno_and_exclusions does with atc_data from main, and per --lowmem batch without it
+        sliced = loaded_once[loaded_once["pnr"].astype(str).isin(batch)].reset_index(drop=True)
+        per_batch = gp.load_data_file(str(path), ",", "", "atc", "", ["eksd"], iidcol="pnr", iid_rows=list(batch))
+        pd.testing.assert_frame_equal(per_batch, sliced)
+    assert (tmp_path / "atc.csv.iidx.npz").exists()
+
+
 # Note: main() and other CLI/integration-heavy functions are not invoked here.
 # The tests above exercise logic-heavy code paths and ensure basic functionality.